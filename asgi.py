@@ -0,0 +1,5 @@
+# Serves the app with asyncio instead of a thread per request. Run python -m src.migrate once, then
+#     uvicorn --host 0.0.0.0 --port 8000 asgi:app
+# or under gunicorn with
+#     gunicorn --workers 3 --worker-class uvicorn.workers.UvicornWorker asgi:app
+from src.asgi import app
@@ -0,0 +1,115 @@
+"""
+Cost of the ingest analysis (src/analysis.py) on synthetic tracks: analysing one track, backfilling a catalogue on one process against a pool of --workers, and looking up a track's near duplicates in fingerprint indexes of different sizes. The lookup cost should stay about the same whatever the size of the index. Needs NumPy.
+
+Run from the repository root:
+    python -m benchmarks.analysis --tracks 200 --seconds 180 --workers 4
+"""
+
+import wave
+from argparse import ArgumentParser
+from json import dumps
+from os.path import join
+from sys import exit
+from tempfile import mkdtemp
+
+from .common import scratch_db, seed_songs, seed_users, summary, timed
+
+
+def synthetic_track(seed: int, seconds: int):
+    # A chord every quarter second, at random pitches and volumes
+    import numpy as np
+
+    from src.analysis import sample_rate
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(sample_rate // 4) / sample_rate
+    chords = []
+    for _ in range(seconds * 4):
+        tones = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(100, 4000, 3))
+        chords.append(tones * rng.uniform(0.05, 0.3))
+    return (np.concatenate(chords) * 32767 / 3).astype(np.int16)
+
+
+def write_wav(path: str, samples):
+    from src.analysis import sample_rate
+
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=200)
+    parser.add_argument("--seconds", type=int, default=180)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lookups", type=int, default=20)
+    args = parser.parse_args()
+
+    from src import analysis, storage
+
+    if analysis.load_numpy() is None:
+        exit("NumPy is not installed")
+    import numpy as np
+
+    database = scratch_db()
+    seed_users(database, 200)
+    seed_songs(database, args.tracks)
+    storage.store = storage.LocalStore(mkdtemp(prefix="music-bench-"))
+    scratch = mkdtemp(prefix="music-bench-")
+
+    music_ids = [row[0] for row in database.db.query("SELECT music_id FROM music")]
+    tracks = {}
+    with database.db.transaction() as con:
+        for i, music_id in enumerate(music_ids):
+            samples = synthetic_track(i, args.seconds)
+            path = join(scratch, music_id + ".wav")
+            write_wav(path, samples)
+            digest = storage.hash_file(path)
+            storage.add_media(con, music_id, path, digest, "audio/wav", "copy")
+            tracks[digest] = samples
+    digests = list(tracks)
+
+    results = {"tracks": args.tracks, "seconds_per_track": args.seconds}
+    source = storage.store.local_path(digests[0])
+    results["analyse_one"] = summary(timed(lambda: analysis.analyse(source), 5))
+
+    # The same catalogue backfilled on one process, then again on the pool
+    results["backfill_1_worker"] = analysis.backfill(1)
+    database.db.execute("DELETE FROM audio_analysis")
+    results[f"backfill_{args.workers}_workers"] = analysis.backfill(args.workers)
+    results["fingerprint_rows"] = database.db.query(
+        "SELECT COUNT(*) FROM fingerprints"
+    )[0][0]
+
+    # Lookups of a trimmed, quieter, noisy copy of the first track, as the index shrinks from every track to a tenth of them
+    rng = np.random.default_rng(0)
+    original = tracks[digests[0]][3000:]
+    copy = (original * 0.7 + rng.normal(0, 300, len(original))).astype(np.int16)
+    landmarks = analysis.fingerprint(copy)
+    lookups = {}
+    for indexed in sorted(
+        {args.tracks, args.tracks // 2, max(args.tracks // 10, 1)}, reverse=True
+    ):
+        left_out = digests[indexed:]
+        database.db.execute(
+            f"DELETE FROM fingerprints WHERE sha256 IN ({','.join('?' * len(left_out))})",
+            left_out,
+        )
+        matches = analysis.find_matches(landmarks)
+        lookups[indexed] = {
+            "found": bool(matches) and matches[0][0] == digests[0],
+            "hashes_in_common": matches[0][1] if matches else 0,
+            "lookup": summary(
+                timed(lambda: analysis.find_matches(landmarks), args.lookups)
+            ),
+        }
+    results["near_duplicate_lookup"] = lookups
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
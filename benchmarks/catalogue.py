@@ -0,0 +1,66 @@
+"""
+Throughput of the bulk catalogue import and export (src/catalogue.py) on a synthetic catalogue, written to a JSON Lines file first: importing into an empty database, importing it again with nothing to change, and exporting it as JSON Lines and as CSV. For comparison, the first --baseline rows are also inserted the way data.json used to be seeded, with insert_if_not_exists one row at a time.
+
+Run from the repository root:
+    python -m benchmarks.catalogue --songs 1000000
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from os import devnull
+from os.path import join
+from tempfile import mkdtemp
+from time import perf_counter
+
+from .common import scratch_db, seed_users, synthetic_songs
+
+COLUMNS = ("music_id", "name", "artist", "album", "genre", "year", "lyrics", "owner")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--baseline", type=int, default=20_000)
+    args = parser.parse_args()
+
+    path = join(mkdtemp(prefix="music-bench-"), "catalogue.jsonl")
+    with open(path, "w") as f:
+        for row in synthetic_songs(args.songs):
+            f.write(dumps(dict(zip(COLUMNS, row))) + "\n")
+
+    database = scratch_db()
+    seed_users(database, 200)
+    from src.catalogue import export_catalogue, import_catalogue
+
+    results = {"songs": args.songs, "batch_size": args.batch_size}
+    with open(path) as f:
+        results["import"] = import_catalogue(f, batch_size=args.batch_size)
+    with open(path) as f:
+        results["import_unchanged"] = import_catalogue(
+            f, mode="skip", batch_size=args.batch_size
+        )
+    for format in ["jsonl", "csv"]:
+        with open(devnull, "w") as f:
+            results[f"export_{format}"] = export_catalogue(
+                f, format, batch_size=args.batch_size
+            )
+
+    database = scratch_db()
+    seed_users(database, 200)
+    started = perf_counter()
+    with database.db.transaction():
+        for row in synthetic_songs(args.baseline):
+            database.db.insert_if_not_exists("music", row[0], *row[1:])
+    seconds = perf_counter() - started
+    results["row_at_a_time"] = {
+        "read": args.baseline,
+        "seconds": seconds,
+        "rows_per_second": args.baseline / seconds,
+    }
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
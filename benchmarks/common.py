@@ -0,0 +1,159 @@
+from os import environ
+from os.path import join
+from random import Random
+from statistics import mean
+from subprocess import DEVNULL, Popen
+from sys import executable
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+from urllib.request import urlopen
+
+SYLLABLES = [
+    "ka", "ri", "so", "na", "mel", "lo", "dy", "tha", "ra", "vi",
+    "sha", "ma", "dhu", "ja", "ne", "po", "li", "an", "ge", "ru",
+]  # fmt: skip
+
+GENRES = ["Pop", "Rock", "Bollywood", "Carnatic", "Jazz", "Hip Hop", "Indie", "Lofi"]
+
+
+def scratch_db():
+    """
+    Points src.database at a fresh, empty database in a temporary directory and creates the tables. Returns the database module.
+    """
+    from src import database
+
+    database.db = database.SqliteWrapper(
+        join(mkdtemp(prefix="music-bench-"), "bench.db")
+    )
+    with database.db.transaction():
+        database.create_tables()
+    return database
+
+
+def scratch_plays(**kwargs):
+    """
+    Points src.plays at a fresh plays database in a temporary directory and creates the tables. kwargs go to PlayLog. Returns the PlayLog.
+    """
+    from src import plays
+
+    plays.log = plays.PlayLog(
+        join(mkdtemp(prefix="music-bench-"), "plays.db"), **kwargs
+    )
+    with plays.log.db.transaction():
+        plays.create_tables(plays.log.db)
+    return plays.log
+
+
+def word(rng: Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def synthetic_songs(n: int, seed: int = 0, owners: int = 100):
+    """
+    Yields n reproducible rows for the music table, in the same column order as the table.
+    """
+    rng = Random(seed)
+    for i in range(n):
+        yield (
+            f"song{i:08d}",
+            " ".join(word(rng) for _ in range(rng.randint(1, 3))).title(),
+            " ".join(word(rng) for _ in range(2)).title(),
+            word(rng).title(),
+            rng.choice(GENRES),
+            rng.randint(1960, 2024),
+            " ".join(word(rng) for _ in range(30)),
+            f"creator{rng.randrange(owners)}",
+        )
+
+
+def seed_songs(database, n: int, seed: int = 0):
+    database.db.insert_many("music", synthetic_songs(n, seed))
+
+
+def synthetic_users(n: int, creators: int = 100, admins: int = 1):
+    """
+    Yields rows for the users table: admins admin0.., creators creator0.. (the owners synthetic_songs uses) and the rest listener0... Every password is "password".
+    """
+    from src.credentials import hash_password
+
+    # One hash for all of them, hashing each would take minutes at the default cost
+    password = hash_password("password")
+    for i in range(n):
+        if i < admins:
+            yield (f"admin{i}", password, f"Admin {i}", 0)
+        elif i < admins + creators:
+            yield (f"creator{i - admins}", password, f"Creator {i - admins}", 2)
+        else:
+            i -= admins + creators
+            yield (f"listener{i}", password, f"Listener {i}", 1)
+
+
+def seed_users(database, n: int, creators: int = 100):
+    database.db.insert_many("users", synthetic_users(max(n, creators + 2), creators))
+
+
+def seed_playlists(database, n: int, songs: int, listeners: int, seed: int = 0):
+    """
+    Adds n playlists of 5 to 50 songs, owned by random listeners. One in ten is public (privacy 0).
+    """
+    rng = Random(seed)
+    playlists, tracks = [], []
+    for i in range(n):
+        playlist_id = f"playlist{i:08d}"
+        playlists.append(
+            (
+                playlist_id,
+                word(rng).title(),
+                f"listener{rng.randrange(listeners)}",
+                "",
+                0 if rng.random() < 0.1 else 1,
+            )
+        )
+        for position in range(rng.randint(5, 50)):
+            tracks.append((playlist_id, position, f"song{rng.randrange(songs):08d}"))
+    database.db.insert_many("playlists", playlists)
+    database.db.insert_many("playlist_tracks", tracks)
+
+
+def start_server(command: list[str], host: str, port: int, env: dict | None = None):
+    """
+    Starts python -m command in the repository root and waits until it answers over HTTP, not just until it listens, since gunicorn listens before its workers have booted. Returns the Popen, to terminate when done.
+    """
+    server = Popen(
+        [executable, "-m"] + command,
+        env=environ | (env or {}),
+        stdout=DEVNULL,
+        stderr=DEVNULL,
+    )
+    for _ in range(600):
+        try:
+            for _ in range(10):
+                urlopen(f"http://{host}:{port}/", timeout=5).read()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError(f"{command[0]} exited with {server.returncode}")
+            sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"{command[0]} did not start on {host}:{port}")
+
+
+def timed(fn, repeat: int) -> list[float]:
+    # Returns the wall clock time of each of the repeat calls to fn, in seconds
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        samples.append(perf_counter() - start)
+    return samples
+
+
+def summary(samples: list[float]) -> dict:
+    s = sorted(samples)
+    return {
+        "n": len(s),
+        "mean_ms": mean(s) * 1000,
+        "p50_ms": s[len(s) // 2] * 1000,
+        "p95_ms": s[min(len(s) - 1, int(len(s) * 0.95))] * 1000,
+        "p99_ms": s[min(len(s) - 1, int(len(s) * 0.99))] * 1000,
+    }
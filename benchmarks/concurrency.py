@@ -0,0 +1,113 @@
+"""
+Read throughput with parallel readers while a writer keeps updating songs, for the pooled WAL SqliteWrapper and for the old setup (one shared connection, rollback journal, commit after every statement).
+
+Run from the repository root:
+    python -m benchmarks.concurrency --songs 50000 --readers 8 --seconds 5
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from random import Random
+from sqlite3 import connect
+from threading import Event, Thread
+from time import perf_counter
+
+from .common import scratch_db, seed_songs
+
+
+class LegacyWrapper:
+    # The SqliteWrapper this repo used to have, reduced to the two methods the benchmark needs
+    def __init__(self, path):
+        self.db = connect(path, check_same_thread=False)
+        assert self.db.execute("PRAGMA journal_mode=DELETE").fetchone()[0] == "delete"
+
+    def execute(self, query, *params):
+        cur = self.db.cursor()
+        cur.execute(query, *params)
+        self.db.commit()
+
+    def query(self, query, *params):
+        cur = self.db.cursor()
+        data = cur.execute(query, *params).fetchall()
+        cur.close()
+        return data
+
+
+def run(db, songs: int, readers: int, seconds: float) -> dict:
+    stop = Event()
+    reads = [0] * readers
+    writes = [0]
+
+    def reader(i):
+        rng = Random(i)
+        while not stop.is_set():
+            db.query(
+                "SELECT * FROM music WHERE music_id=?",
+                (f"song{rng.randrange(songs):08d}",),
+            )
+            db.query(
+                "SELECT * FROM music WHERE name > ? ORDER BY name, music_id LIMIT 50",
+                (chr(rng.randint(65, 90)),),
+            )
+            reads[i] += 2
+
+    def writer():
+        rng = Random(-1)
+        while not stop.is_set():
+            db.execute(
+                "UPDATE music SET year=? WHERE music_id=?",
+                (rng.randint(1960, 2024), f"song{rng.randrange(songs):08d}"),
+            )
+            writes[0] += 1
+
+    threads = [Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads.append(Thread(target=writer))
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    return {
+        "reads_per_second": sum(reads) / elapsed,
+        "writes_per_second": writes[0] / elapsed,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=50_000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    database = scratch_db()
+    seed_songs(database, args.songs)
+    path = database.db.path
+    database.db.close()
+
+    database.db = database.SqliteWrapper(path, pool_size=args.readers + 1)
+    pooled = run(database.db, args.songs, args.readers, args.seconds)
+    database.db.close()
+
+    # The legacy wrapper switches the file back to a rollback journal, so it runs last
+    legacy = run(LegacyWrapper(path), args.songs, args.readers, args.seconds)
+
+    print(
+        dumps(
+            {
+                "songs": args.songs,
+                "readers": args.readers,
+                "pooled_wal": pooled,
+                "legacy": legacy,
+            },
+            indent=4,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
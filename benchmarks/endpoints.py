@@ -0,0 +1,308 @@
+"""
+Latency percentiles and throughput of the hot endpoints (/login, /player, /search, /fetch_song_details, /admin and /stream) against a synthetic catalogue in a scratch database. Requests go through the Flask test client, or with --gunicorn through a local gunicorn run the way the Dockerfile runs it, from --concurrency threads with keep-alive connections.
+
+Prints (or writes to --output) one JSON document with the commit, the catalogue size and a summary per endpoint, so runs can be compared over time.
+
+Run from the repository root:
+    python -m benchmarks.endpoints --songs 10000 --users 1000 --playlists 1000
+    python -m benchmarks.endpoints --songs 1000000 --gunicorn --concurrency 8 --output results.json
+"""
+
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from json import dumps
+from os import environ
+from os.path import dirname, join
+from platform import python_version
+from random import Random
+from subprocess import run
+from threading import Thread
+from time import perf_counter, time
+from urllib.parse import urlencode
+
+from .common import (
+    scratch_db,
+    seed_playlists,
+    seed_songs,
+    seed_users,
+    start_server,
+    summary,
+    word,
+)
+
+# The sample songs bundled in data/, the only ones with audio to stream. seed_audio adds them to the scratch catalogue
+AUDIO = ["chaleya", "maamadhura_dhee"]
+
+
+def scenarios(songs: int) -> dict:
+    """
+    Each endpoint, as the role it is requested as and a function that makes a random request for it: (method, path, form, json, headers).
+    """
+
+    def song(rng):
+        return f"song{rng.randrange(songs):08d}"
+
+    def stream_range(rng):
+        # A player seeking: 256KB from somewhere in the first 3MB
+        start = rng.randrange(0, 3 * 1024 * 1024)
+        return (
+            "GET",
+            f"/stream/{rng.choice(AUDIO)}",
+            None,
+            None,
+            {"Range": f"bytes={start}-{start + 1024 * 256 - 1}"},
+        )
+
+    return {
+        "login": (
+            None,
+            lambda rng: (
+                "POST",
+                "/login",
+                {"username": "listener0", "pw": "password", "user_type": "1"},
+                None,
+                {},
+            ),
+        ),
+        "player": (1, lambda rng: ("GET", "/player", None, None, {})),
+        "search": (
+            1,
+            lambda rng: ("POST", "/search", {"query": word(rng)}, None, {}),
+        ),
+        "search_page": (
+            1,
+            lambda rng: ("GET", f"/search?q={word(rng)}", None, None, {}),
+        ),
+        "fetch_song_details": (
+            None,
+            lambda rng: (
+                "POST",
+                "/fetch_song_details",
+                None,
+                {"music_id": song(rng)},
+                {},
+            ),
+        ),
+        "admin": (0, lambda rng: ("GET", "/admin", None, None, {})),
+        "stream": (
+            None,
+            lambda rng: ("GET", f"/stream/{rng.choice(AUDIO)}", None, None, {}),
+        ),
+        "stream_range": (None, stream_range),
+    }
+
+
+logins = {
+    0: {"username": "admin0", "pw": "password", "user_type": "0"},
+    1: {"username": "listener0", "pw": "password", "user_type": "1"},
+}
+
+
+def seed_audio(database):
+    # Songs for the files in data/, stored the way uploads are (see storage.adopt), so /stream has something to send
+    from src import storage
+
+    database.db.insert_many(
+        "music",
+        (
+            (
+                music_id,
+                music_id.title(),
+                "Sample",
+                "Sample",
+                "Pop",
+                2023,
+                "",
+                "creator0",
+            )
+            for music_id in AUDIO
+        ),
+    )
+    storage.adopt("data", "link")
+
+
+def scratch_env(database) -> dict:
+    # The plays and sessions databases and the audio files, next to the scratch database rather than at their defaults in the repository. Set in this process's environment as well as given to gunicorn, since create_app and migrate read them from there
+    directory = dirname(database.db.path)
+    return {
+        "DATABASE_PATH": database.db.path,
+        "PLAYS_DATABASE_PATH": join(directory, "plays.db"),
+        "SESSION_DATABASE_PATH": join(directory, "sessions.db"),
+        "AUDIO_STORAGE_URL": f"file://{join(directory, 'audio')}",
+    }
+
+
+def result(samples: list[float], errors: int, wall: float) -> dict:
+    return summary(samples) | {
+        "errors": errors,
+        "throughput_rps": len(samples) / wall,
+    }
+
+
+def run_test_client(songs: int, requests: int, seed: int) -> dict:
+    from src.app import create_app
+
+    app = create_app()
+
+    clients = {None: app.test_client()}
+    for role, form in logins.items():
+        clients[role] = app.test_client()
+        clients[role].post("/login", data=form)
+
+    results = {}
+    for name, (role, make) in scenarios(songs).items():
+        client, rng = clients[role], Random(seed)
+        samples, errors = [], 0
+        started = perf_counter()
+        for _ in range(requests):
+            method, path, form, json, headers = make(rng)
+            start = perf_counter()
+            response = client.open(
+                path, method=method, data=form, json=json, headers=headers
+            )
+            response.get_data()
+            samples.append(perf_counter() - start)
+            errors += response.status_code >= 400
+        results[name] = result(samples, errors, perf_counter() - started)
+    return results
+
+
+def http_request(connection, method, path, form, json, headers, cookie):
+    headers = dict(headers)
+    body = None
+    if form is not None:
+        body = urlencode(form)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    elif json is not None:
+        body = dumps(json)
+        headers["Content-Type"] = "application/json"
+    if cookie:
+        headers["Cookie"] = cookie
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response.read()
+    return response
+
+
+def run_gunicorn(
+    env: dict, songs: int, requests: int, seed: int, concurrency: int, port: int
+) -> dict:
+    host = "127.0.0.1"
+    server = start_server(
+        [
+            "gunicorn",
+            "--bind",
+            f"{host}:{port}",
+            "--workers",
+            "3",
+            "--worker-class",
+            "gthread",
+            "--threads",
+            "4",
+            "wsgi:app",
+        ],
+        host,
+        port,
+        env=env,
+    )
+    try:
+        cookies = {None: None}
+        for role, form in logins.items():
+            connection = HTTPConnection(host, port)
+            response = http_request(connection, "POST", "/login", form, None, {}, None)
+            cookies[role] = response.getheader("Set-Cookie").split(";")[0]
+            connection.close()
+
+        results = {}
+        for name, (role, make) in scenarios(songs).items():
+            samples, errors = [], []
+
+            def worker(i):
+                rng, connection = Random(seed + i), HTTPConnection(host, port)
+                for _ in range(requests // concurrency):
+                    start = perf_counter()
+                    response = http_request(connection, *make(rng), cookies[role])
+                    samples.append(perf_counter() - start)
+                    if response.status >= 400:
+                        errors.append(response.status)
+                connection.close()
+
+            threads = [Thread(target=worker, args=(i,)) for i in range(concurrency)]
+            started = perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results[name] = result(samples, len(errors), perf_counter() - started)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--playlists", type=int, default=1_000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gunicorn", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    from src import plays, storage
+    from src.migrate import migrate
+
+    database = scratch_db()
+    env = scratch_env(database)
+    environ.update(env)
+    plays.log = plays.PlayLog(env["PLAYS_DATABASE_PATH"])
+    storage.store = storage.make_store(env["AUDIO_STORAGE_URL"])
+    migrate()
+    started = perf_counter()
+    seed_users(database, args.users)
+    seed_songs(database, args.songs, args.seed)
+    listeners = database.db.query("SELECT COUNT(*) FROM users WHERE user_type=1")
+    seed_playlists(database, args.playlists, args.songs, listeners[0][0], args.seed)
+    seed_audio(database)
+    seed_seconds = perf_counter() - started
+
+    if args.gunicorn:
+        results = run_gunicorn(
+            env,
+            args.songs,
+            args.requests,
+            args.seed,
+            args.concurrency,
+            args.port,
+        )
+    else:
+        results = run_test_client(args.songs, args.requests, args.seed)
+
+    commit = run(["git", "rev-parse", "HEAD"], capture_output=True, text=True)
+    report = {
+        "commit": commit.stdout.strip() or None,
+        "timestamp": int(time()),
+        "python": python_version(),
+        "mode": "gunicorn" if args.gunicorn else "test_client",
+        "concurrency": args.concurrency if args.gunicorn else 1,
+        "catalogue": {
+            "songs": args.songs,
+            "users": args.users,
+            "playlists": args.playlists,
+            "seed_seconds": seed_seconds,
+        },
+        "endpoints": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dumps(report, indent=4))
+    else:
+        print(dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Sustained play event throughput (src/plays.py): --threads threads record plays as fast as they can for --seconds while the background thread writes them in batches, against the same threads committing each play as it comes for the same time. Then the cost of rolling up what was written, and of the reads the dashboards make from the rollups.
+
+Run from the repository root:
+    python -m benchmarks.events --threads 8 --seconds 10
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from random import Random
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+from .common import scratch_plays, summary, timed
+
+
+def hammer(record, threads: int, seconds: float, songs: int) -> dict:
+    """
+    Calls record(username, music_id) from threads threads for seconds. Returns how many calls were made, and the latency of every hundredth.
+    """
+    stop = Event()
+    counts = [0] * threads
+    latencies = [[] for _ in range(threads)]
+
+    def run(i: int):
+        rng = Random(i)
+        while not stop.is_set():
+            sample = counts[i] % 100 == 0
+            if sample:
+                start = perf_counter()
+            record(f"listener{rng.randrange(10000)}", f"song{rng.randrange(songs):08d}")
+            if sample:
+                latencies[i].append(perf_counter() - start)
+            counts[i] += 1
+
+    workers = [Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return {
+        "recorded": sum(counts),
+        "per_second": sum(counts) / seconds,
+        "latency": summary([s for samples in latencies for s in samples]),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--songs", type=int, default=20_000)
+    args = parser.parse_args()
+
+    results = {"threads": args.threads, "seconds": args.seconds}
+
+    log = scratch_plays()
+    results["commit_per_play"] = hammer(
+        lambda username, music_id: log.db.insert(
+            "plays", (None, username, music_id, 0)
+        ),
+        args.threads,
+        args.seconds,
+        args.songs,
+    )
+
+    log = scratch_plays()
+    most_buffered = [0]
+
+    def watched(username, music_id):
+        log.record(username, music_id)
+        most_buffered[0] = max(most_buffered[0], len(log))
+
+    results["play_log"] = hammer(watched, args.threads, args.seconds, args.songs)
+    results["play_log"]["written_during"] = log.written
+    results["play_log"]["most_buffered"] = most_buffered[0]
+    started = perf_counter()
+    log.flush()
+    results["play_log"]["final_flush_ms"] = (perf_counter() - started) * 1000
+    results["play_log"]["sustained_per_second"] = log.written / (
+        args.seconds + perf_counter() - started
+    )
+
+    started = perf_counter()
+    rolled = log.roll_up()
+    seconds = perf_counter() - started
+    results["roll_up"] = {"plays": rolled, "plays_per_second": rolled / seconds}
+
+    page = [f"song{i:08d}" for i in range(50)]
+    results["dashboard"] = {
+        "version": summary(timed(log.version, 1000)),
+        "totals_for_a_page": summary(timed(lambda: log.totals(page), 1000)),
+        "plays_per_day": summary(timed(lambda: log.per_day(days=30), 1000)),
+        "song_per_day": summary(timed(lambda: log.per_day(page[0], 30), 1000)),
+        "most_played": summary(timed(log.most_played, 1000)),
+    }
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+How many listeners a local instance can stream to at once. Each listener downloads a song at a real playback rate through a small receive buffer, like a phone on a slow network, while a prober times /fetch_song_details. Runs the gunicorn deployment from the Dockerfile and the uvicorn ASGI mode one after the other, at each number of listeners.
+
+Before the load, each server is sent the same few requests (a song, a range of it, a range past its end, a conditional request, a song that does not exist, /fetch_song_details and a page), and the run exits with status 1 if the two did not give the same status, headers and body to each, since the ASGI mode is meant to answer exactly like the WSGI one.
+
+Run from the repository root, after python -m src.migrate has created music-app.db with the sample songs:
+    python -m benchmarks.listeners --listeners 10,50,200 --seconds 15
+or against a server that is already running:
+    python -m benchmarks.listeners --url http://127.0.0.1:8000 --listeners 100
+"""
+
+from argparse import ArgumentParser
+from asyncio import (
+    TimeoutError,
+    gather,
+    get_running_loop,
+    open_connection,
+    run,
+    sleep,
+    wait_for,
+)
+from hashlib import sha256
+from http.client import HTTPConnection
+from json import dumps
+from socket import SOL_SOCKET, SO_RCVBUF, socket
+from sys import exit
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from .common import start_server, summary
+
+servers = {
+    "gunicorn": "gunicorn --bind {host}:{port} --workers 3 --worker-class gthread --threads 4 wsgi:app",
+    "uvicorn": "uvicorn --host {host} --port {port} --workers 3 asgi:app",
+}
+
+
+# Set by the server and the connection rather than the app, or by the time of the request, so they may differ
+hop_headers = {
+    "date",
+    "expires",
+    "server",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+}
+
+
+def answer(host: str, port: int, method: str, path: str, body=None, headers={}):
+    # (status, headers, hash of the body)
+    connection = HTTPConnection(host, port)
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    found = (
+        response.status,
+        sorted(
+            (k.lower(), v)
+            for k, v in response.getheaders()
+            if k.lower() not in hop_headers
+        ),
+        sha256(response.read()).hexdigest(),
+    )
+    connection.close()
+    return found
+
+
+def answers(host: str, port: int, music_id: str) -> dict:
+    # The answers to the requests both servers must answer alike
+    path = f"/stream/{music_id}"
+    found = {"stream": answer(host, port, "GET", path)}
+    etag = dict(found["stream"][1]).get("etag", "")
+    found["stream_not_modified"] = answer(
+        host, port, "GET", path, headers={"If-None-Match": etag}
+    )
+    found["stream_head"] = answer(host, port, "HEAD", path)
+    found["stream_range"] = answer(
+        host, port, "GET", path, headers={"Range": "bytes=100-199"}
+    )
+    found["stream_past_end"] = answer(
+        host, port, "GET", path, headers={"Range": "bytes=1000000000-"}
+    )
+    found["stream_missing"] = answer(host, port, "GET", "/stream/no-such-song")
+    found["fetch_song_details"] = answer(
+        host,
+        port,
+        "POST",
+        "/fetch_song_details",
+        dumps({"music_id": music_id}),
+        {"Content-Type": "application/json"},
+    )
+    found["login_page"] = answer(host, port, "GET", "/login")
+    return found
+
+
+async def connect(host: str, port: int, receive_buffer: int | None = None):
+    sock = socket()
+    if receive_buffer:
+        # Otherwise the kernel buffers megabytes of a localhost download and the server is done with the listener at once
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, receive_buffer)
+    sock.setblocking(False)
+    await get_running_loop().sock_connect(sock, (host, port))
+    return await open_connection(sock=sock, limit=receive_buffer or 2**16)
+
+
+async def read_head(reader) -> int:
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in {b"\r\n", b""}:
+        pass
+    return status
+
+
+async def listener(host, port, path, bitrate, seconds, results):
+    # Plays for seconds at bitrate (bytes a second). Records the time to the first byte, or None if it never came, and whether playback kept up
+    start = perf_counter()
+    try:
+        reader, writer = await connect(host, port, receive_buffer=1024 * 16)
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+        )
+        if await wait_for(read_head(reader), seconds) != 200:
+            raise ValueError
+    except (OSError, ValueError, IndexError, TimeoutError):
+        results.append((None, False))
+        return
+    first_byte = perf_counter() - start
+
+    received, ended = 0, False
+    played_from = perf_counter()
+    while (elapsed := perf_counter() - start) < seconds:
+        try:
+            block = await wait_for(reader.read(1024 * 16), seconds - elapsed)
+        except TimeoutError:
+            break
+        if not block:
+            ended = True
+            break
+        received += len(block)
+        # Sleep until this much of the song would have been played
+        ahead = received / bitrate - (perf_counter() - played_from)
+        if ahead > 0:
+            await sleep(min(ahead, seconds - (perf_counter() - start)))
+    writer.close()
+    # Kept up if it had at least 90% of what playback needed by the end. A song that ended early counts as kept up
+    played = perf_counter() - played_from
+    results.append((first_byte, ended or received >= 0.9 * bitrate * played))
+
+
+async def prober(host, port, music_id, seconds, samples, errors):
+    body = dumps({"music_id": music_id})
+    request = (
+        f"POST /fetch_song_details HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n{body}"
+    ).encode()
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        start = perf_counter()
+        try:
+            reader, writer = await connect(host, port)
+            writer.write(request)
+            await wait_for(reader.read(), max(end - perf_counter(), 0.1))
+            writer.close()
+            samples.append(perf_counter() - start)
+        except (OSError, TimeoutError):
+            errors.append(1)
+        await sleep(0.1)
+
+
+async def load(url, music_id, listeners, bitrate, seconds) -> dict:
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    results, samples, errors = [], [], []
+    await gather(
+        prober(host, port, music_id, seconds, samples, errors),
+        *(
+            listener(host, port, f"/stream/{music_id}", bitrate, seconds, results)
+            for _ in range(listeners)
+        ),
+    )
+    first_bytes = [t for t, _ in results if t is not None]
+    return {
+        "listeners": listeners,
+        "started": len(first_bytes),
+        "kept_up": sum(1 for t, ok in results if t is not None and ok),
+        "first_byte": summary(first_bytes) if first_bytes else None,
+        "fetch_song_details": summary(samples) if samples else None,
+        "probe_errors": len(errors),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--url", help="A running server to test, instead of both")
+    parser.add_argument("--server", choices=servers, action="append")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--listeners", default="10,50,200")
+    parser.add_argument("--kbps", type=int, default=128)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--music-id", default="chaleya")
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.listeners.split(",")]
+    bitrate = args.kbps * 1000 / 8
+
+    if args.url:
+        for n in levels:
+            print(dumps(run(load(args.url, args.music_id, n, bitrate, args.seconds))))
+        return
+
+    responses = {}
+    for name in args.server or list(servers):
+        server = start_server(
+            servers[name].format(host="127.0.0.1", port=args.port).split(),
+            "127.0.0.1",
+            args.port,
+        )
+        try:
+            responses[name] = answers("127.0.0.1", args.port, args.music_id)
+            for n in levels:
+                result = run(
+                    load(
+                        f"http://127.0.0.1:{args.port}",
+                        args.music_id,
+                        n,
+                        bitrate,
+                        args.seconds,
+                    )
+                )
+                print(dumps({"server": name} | result))
+        finally:
+            server.terminate()
+            server.wait()
+
+    if len(responses) > 1:
+        first, *others = responses.items()
+        differences = [
+            f"{request}: {first[0]} gave {first[1][request]}, {name} gave {found[request]}"
+            for name, found in others
+            for request in first[1]
+            if found[request] != first[1][request]
+        ]
+        if differences:
+            print("\n".join(differences))
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
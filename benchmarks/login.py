@@ -0,0 +1,124 @@
+"""
+Login cost at different password hashing settings: the time to verify one password, logins a second from --threads concurrent logins, and the latency of a search running alongside the burst, with the hashing pool at its default size and with one hashing thread per login.
+
+Run from the repository root:
+    python -m benchmarks.login --threads 16 --seconds 3
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from threading import Event, Thread
+from time import perf_counter
+
+from src import credentials
+from src.miscellaneous import hasher
+
+from .common import scratch_db, seed_songs, summary, timed
+
+SETTINGS = [
+    ("sha256 (legacy)", None, ()),
+    ("scrypt n=2^12", "scrypt", (2**12, 8, 1)),
+    ("scrypt n=2^14", "scrypt", (2**14, 8, 1)),
+    ("scrypt n=2^15", "scrypt", (2**15, 8, 1)),
+    ("pbkdf2 100k", "pbkdf2_sha256", (100_000,)),
+    ("pbkdf2 600k", "pbkdf2_sha256", (600_000,)),
+]
+
+
+def configure(scheme: str, parameters: tuple):
+    credentials.scheme = scheme
+    if scheme == "scrypt":
+        credentials.scrypt_n, credentials.scrypt_r, credentials.scrypt_p = parameters
+    else:
+        (credentials.pbkdf2_iterations,) = parameters
+
+
+def burst(database, stored: str, threads: int, seconds: float) -> dict:
+    # threads logins at once for seconds, while one thread keeps searching the catalogue
+    stop = Event()
+    logins = [0] * threads
+    searches = []
+
+    def login(i):
+        while not stop.is_set():
+            assert credentials.on_hashing_pool(
+                credentials.verify_password, "password", stored
+            )
+            logins[i] += 1
+
+    def search():
+        while not stop.is_set():
+            start = perf_counter()
+            database.search_songs("ka", 50)
+            searches.append(perf_counter() - start)
+
+    workers = [Thread(target=login, args=(i,)) for i in range(threads)]
+    workers.append(Thread(target=search))
+    for worker in workers:
+        worker.start()
+    stop.wait(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return {
+        "logins_per_second": sum(logins) / seconds,
+        "search_during_burst": summary(searches),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--songs", type=int, default=20_000)
+    args = parser.parse_args()
+
+    database = scratch_db()
+    seed_songs(database, args.songs)
+    default_pool = credentials.hashing
+    results = {
+        "threads": args.threads,
+        "hash_workers": default_pool._max_workers,
+        "search_idle": summary(timed(lambda: database.search_songs("ka", 50), 50)),
+        "settings": {},
+    }
+
+    for name, scheme, parameters in SETTINGS:
+        if scheme is None:
+            stored = hasher("password")
+        else:
+            configure(scheme, parameters)
+            stored = credentials.hash_password("password")
+        result = {
+            "verify": summary(
+                timed(lambda: credentials.verify_password("password", stored), 5)
+            )
+        }
+        credentials.hashing = default_pool
+        result["pooled"] = burst(database, stored, args.threads, args.seconds)
+        credentials.hashing = ThreadPoolExecutor(max_workers=args.threads)
+        result["unpooled"] = burst(database, stored, args.threads, args.seconds)
+        credentials.hashing.shutdown()
+        results["settings"][name] = result
+
+    # First login of a user with a legacy hash: verify it, then rehash and store with the default settings
+    credentials.hashing = default_pool
+    configure("scrypt", (2**14, 8, 1))
+    database.create_user("legacy", "password", "Legacy", 1)
+    database.db.execute(
+        "UPDATE users SET password=? WHERE username='legacy'", (hasher("password"),)
+    )
+    database.user_cache.clear()
+    start = perf_counter()
+    assert database.check_password("legacy", "password")
+    results["legacy_first_login_ms"] = (perf_counter() - start) * 1000
+    start = perf_counter()
+    assert database.check_password("legacy", "password")
+    results["legacy_second_login_ms"] = (perf_counter() - start) * 1000
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Cost of loading the catalogue pages (/player, /creator and /admin, 100 songs a page) three ways: rendered from scratch, with the song list from the fragment cache, and revalidated by a client that already has the page (304 Not Modified).
+
+Run from the repository root:
+    python -m benchmarks.pages --songs 10000 --requests 500
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+
+from .common import scratch_db, seed_songs, seed_users, summary, timed
+
+PAGES = {
+    "player": {"username": "listener0", "pw": "password", "user_type": "1"},
+    "creator": {"username": "creator0", "pw": "password", "user_type": "2"},
+    "admin": {"username": "admin0", "pw": "password", "user_type": "0"},
+}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    database = scratch_db()
+    seed_users(database, args.users)
+    seed_songs(database, args.songs)
+
+    from src import pages
+    from src.app import create_app
+    from src.migrate import migrate
+
+    migrate()
+    app = create_app()
+
+    results = {}
+    for page, form in PAGES.items():
+        client = app.test_client()
+        client.post("/login", data=form)
+        path = f"/{page}?limit=100"
+
+        def uncached():
+            pages.fragment_cache.clear()
+            assert client.get(path).status_code == 200
+
+        def fragment_hit():
+            assert client.get(path).status_code == 200
+
+        etag = client.get(path).headers["ETag"]
+
+        def not_modified():
+            assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+        results[page] = {
+            "uncached": summary(timed(uncached, args.requests)),
+            "fragment_cached": summary(timed(fragment_hit, args.requests)),
+            "not_modified": summary(timed(not_modified, args.requests)),
+        }
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+What the sampling profiler (see metrics.Profiler) costs a request: the latency of --requests requests to the login page with it stopped, and with it started at each --intervals interval.
+
+Also checks how PROFILER_INTERVAL_MS starts it: on a worker's first request, once, so stopping it through /metrics/profile is not undone by the requests after. Exits with status 1 if it is not.
+
+Run from the repository root:
+    python -m benchmarks.profiler --requests 2000 --intervals 1 10
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from os import environ
+from os.path import dirname, join
+from sys import exit
+from time import perf_counter
+
+from .common import scratch_db, summary
+
+failures = []
+
+
+def check(ok: bool, message: str):
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1, 10])
+    args = parser.parse_args()
+
+    database = scratch_db()
+    directory = dirname(database.db.path)
+    environ["PLAYS_DATABASE_PATH"] = join(directory, "plays.db")
+    environ["SESSION_DATABASE_PATH"] = join(directory, "sessions.db")
+    environ["METRICS_TOKEN"] = "benchmark"
+    environ["PROFILER_INTERVAL_MS"] = str(args.intervals[0])
+
+    from src import metrics, plays
+    from src.app import create_app
+    from src.migrate import migrate
+
+    plays.log = plays.PlayLog(environ["PLAYS_DATABASE_PATH"])
+    migrate()
+    client = create_app().test_client()
+    token = {"Authorization": "Bearer benchmark"}
+
+    def action(name: str, **form) -> bool:
+        response = client.post(
+            "/metrics/profile", data={"action": name} | form, headers=token
+        )
+        return response.json["running"]
+
+    check(not metrics.profiler.running, "the profiler started before any request")
+    client.get("/")
+    check(metrics.profiler.running, "PROFILER_INTERVAL_MS did not start the profiler")
+    check(not action("stop"), "action=stop did not stop the profiler")
+    client.get("/")
+    check(
+        not metrics.profiler.running,
+        "a request started the profiler again after action=stop",
+    )
+
+    def requests() -> dict:
+        samples = []
+        for _ in range(args.requests):
+            start = perf_counter()
+            client.get("/")
+            samples.append(perf_counter() - start)
+        return summary(samples)
+
+    results = {"stopped": requests()}
+    for interval in args.intervals:
+        check(action("start", interval=interval), f"action=start {interval} failed")
+        results[f"every_{interval:g}ms"] = requests()
+        action("stop")
+    results["stacks_sampled"] = len(metrics.profiler.stacks)
+
+    print(dumps(results, indent=4))
+    if failures:
+        print("\n".join(failures))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Cost of recording plays and of the "up next" recommender (src/plays.py, src/recommend.py) on synthetic listening history. Songs are split into --clusters groups, and each listener mostly plays songs from two of them, so a good neighbour is a song from the same group. Measured: writing the plays through the batched PlayLog, against a commit per play for the first --baseline; training on all of them at once with SciPy and in plain Python; an incremental refresh after --new more plays; and up_next with its suggestions, against the dict lookup alone.
+
+Run from the repository root:
+    python -m benchmarks.recommend --songs 20000 --listeners 5000 --plays 1000000
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from random import Random
+from time import perf_counter
+
+from .common import scratch_db, scratch_plays, seed_songs, seed_users, summary, timed
+
+
+def synthetic_plays(n: int, songs: int, listeners: int, clusters: int, seed: int = 0):
+    """
+    Yields n (username, music_id, played_at) plays, oldest first. Each listener plays one of their two clusters 90% of the time, a track every four minutes with a day off now and then.
+    """
+    rng = Random(seed)
+    size = songs // clusters
+    tastes = [rng.sample(range(clusters), 2) for _ in range(listeners)]
+    clocks = [rng.randrange(86400) for _ in range(listeners)]
+    for _ in range(n):
+        listener = rng.randrange(listeners)
+        cluster = (
+            rng.choice(tastes[listener])
+            if rng.random() < 0.9
+            else rng.randrange(clusters)
+        )
+        clocks[listener] += 240 if rng.random() < 0.98 else 86400
+        yield (
+            f"listener{listener}",
+            f"song{cluster * size + rng.randrange(size):08d}",
+            clocks[listener],
+        )
+
+
+def same_cluster(neighbours: dict, songs: int, clusters: int) -> float:
+    # Share of all suggested neighbours that are in the same cluster as the song
+    size = songs // clusters
+    hits = total = 0
+    for music_id, others in neighbours.items():
+        cluster = int(music_id[4:]) // size
+        hits += sum(int(other[4:]) // size == cluster for other in others)
+        total += len(others)
+    return hits / total if total else 0.0
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=20_000)
+    parser.add_argument("--listeners", type=int, default=5000)
+    parser.add_argument("--plays", type=int, default=1_000_000)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--new", type=int, default=10_000)
+    parser.add_argument("--baseline", type=int, default=2000)
+    args = parser.parse_args()
+
+    from src import playback, recommend
+
+    database = scratch_db()
+    seed_users(database, 200)
+    seed_songs(database, args.songs)
+    history = sorted(
+        synthetic_plays(args.plays, args.songs, args.listeners, args.clusters),
+        key=lambda play: play[2],
+    )
+    results = {
+        "songs": args.songs,
+        "listeners": args.listeners,
+        "plays": args.plays,
+    }
+
+    log = scratch_plays()
+    started = perf_counter()
+    for play in history[: args.baseline]:
+        log.db.insert("plays", (None,) + play)
+    seconds = perf_counter() - started
+    results["commit_per_play"] = {"plays_per_second": args.baseline / seconds}
+    log.db.execute("DELETE FROM plays")
+
+    started = perf_counter()
+    for play in history[: -args.new]:
+        log.record(*play)
+    log.flush()
+    seconds = perf_counter() - started
+    results["play_log"] = {
+        "batch_size": log.batch_size,
+        "plays_per_second": (args.plays - args.new) / seconds,
+    }
+
+    if recommend.scipy_modules()[1] is not None:
+        model = recommend.CoOccurrence(vectorized=False)
+        started = perf_counter()
+        model.rank(model.add(history[: -args.new]))
+        seconds = perf_counter() - started
+        results["train_plain_python"] = {
+            "seconds": seconds,
+            "plays_per_second": (args.plays - args.new) / seconds,
+        }
+
+    model = recommend.model
+    started = perf_counter()
+    model.refresh()
+    seconds = perf_counter() - started
+    results["train"] = {
+        "seconds": seconds,
+        "plays_per_second": (args.plays - args.new) / seconds,
+        "songs_with_neighbours": len(model.neighbours),
+        "neighbours_in_same_cluster": same_cluster(
+            model.neighbours, args.songs, args.clusters
+        ),
+        "matrix_entries": (
+            model.matrix.nnz
+            if model.sparse is not None
+            else sum(map(len, model.matrix.values()))
+        ),
+    }
+
+    for play in history[-args.new :]:
+        log.record(*play)
+    log.flush()
+    started = perf_counter()
+    model.refresh()
+    results["incremental_refresh"] = {
+        "new_plays": args.new,
+        "seconds": perf_counter() - started,
+    }
+
+    # A listener with a queue of five songs from one cluster
+    music_ids = [f"song{i:08d}" for i in range(5)]
+    playback.replace_queue("listener0", music_ids)
+    rng = Random(1)
+    some = [f"song{rng.randrange(args.songs):08d}" for _ in range(10_000)]
+    samples = timed(lambda: [recommend.suggest(music_id) for music_id in some], 20)
+    results["suggest_us"] = sorted(samples)[len(samples) // 2] * 1e6 / len(some)
+    results["up_next"] = summary(timed(lambda: playback.up_next("listener0"), 200))
+    suggest = recommend.suggest
+    recommend.suggest = lambda *args: []
+    results["up_next_without_suggestions"] = summary(
+        timed(lambda: playback.up_next("listener0"), 200)
+    )
+    recommend.suggest = suggest
+
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Per-row overhead of loading songs and of inserting them, before and after the projected select, slotted Song and executemany paths.
+
+Run from the repository root:
+    python -m benchmarks.rows --songs 100000
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+from .common import scratch_db, seed_songs, synthetic_songs
+
+
+class LegacySong:
+    # The Song class this repo used to have
+    def __init__(self, db_row: list):
+        self.music_id = db_row[0]
+        self.name = db_row[1]
+        self.artist = db_row[2]
+        self.album = db_row[3]
+        self.genre = db_row[4]
+        self.year = db_row[5]
+        self.lyrics = db_row[6]
+        self.owner = db_row[7]
+        self.search_data = [
+            self.music_id.casefold(),
+            self.name.casefold(),
+            self.artist.casefold(),
+            self.album.casefold(),
+            self.genre.casefold(),
+            str(self.year),
+        ]
+
+
+def per_row(fn, rows: int) -> dict:
+    start()
+    begin = perf_counter()
+    songs = fn()
+    elapsed = perf_counter() - begin
+    peak = get_traced_memory()[1]
+    stop()
+    assert len(songs) == rows
+    return {"us_per_row": elapsed / rows * 1e6, "peak_bytes_per_row": peak / rows}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=100_000)
+    parser.add_argument("--single-inserts", type=int, default=2_000)
+    args = parser.parse_args()
+
+    database = scratch_db()
+    seed_songs(database, args.songs)
+    db = database.db
+
+    results = {
+        "songs": args.songs,
+        "load": {
+            "legacy": per_row(
+                lambda: [LegacySong(row) for row in db.fetchall("music")],
+                args.songs,
+            ),
+            "projected_slots": per_row(database.get_available_songs, args.songs),
+        },
+    }
+
+    rows = list(synthetic_songs(args.single_inserts, seed=1))
+    rows = [(f"single{i:08d}",) + row[1:] for i, row in enumerate(rows)]
+    begin = perf_counter()
+    for row in rows:
+        db.insert("music", row)
+    single = perf_counter() - begin
+
+    rows = list(synthetic_songs(args.songs, seed=2))
+    rows = [(f"bulk{i:08d}",) + row[1:] for i, row in enumerate(rows)]
+    begin = perf_counter()
+    db.insert_many("music", rows)
+    bulk = perf_counter() - begin
+
+    results["insert"] = {
+        "single_us_per_row": single / args.single_inserts * 1e6,
+        "insert_many_us_per_row": bulk / args.songs * 1e6,
+    }
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
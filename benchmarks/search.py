@@ -0,0 +1,40 @@
+"""
+Compares the music_fts index against the old per-request scan (load every row into a Song and substring match it).
+
+Run from the repository root:
+    python -m benchmarks.search --songs 100000
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+
+from .common import scratch_db, seed_songs, summary, timed
+
+QUERIES = ["ka", "mel", "sharu", "Pop", "2003", "dhu ne", "nothingmatches"]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--songs", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    database = scratch_db()
+    seed_songs(database, args.songs)
+
+    def scan(query):
+        return [s for s in database.get_available_songs() if s.search(query)][:50]
+
+    results = {"songs": args.songs, "queries": {}}
+    for query in QUERIES:
+        results["queries"][query] = {
+            "scan": summary(timed(lambda: scan(query), args.repeat)),
+            "fts": summary(
+                timed(lambda: database.search_songs(query, 50), args.repeat)
+            ),
+        }
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Per request cost of the session backends: Flask-Session's filesystem backend (what the app used before sessions.py), the SQLite store, and the Redis store (against a local fakeredis server unless --redis-url is given). Each is timed on a tiny app, for requests that only read a logged in session and for requests that change it, from --threads threads at once like a gunicorn gthread worker.
+
+Run from the repository root:
+    python -m benchmarks.sessions --requests 2000 --threads 4
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+from os import listdir
+from os.path import join
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+from flask import Flask, session
+
+from src.sessions import (
+    RedisSessionStore,
+    ServerSessionInterface,
+    SqliteSessionStore,
+    create_tables,
+)
+
+from .common import summary
+
+
+def make_app(backend: str, directory: str, redis_url: str | None) -> Flask:
+    app = Flask(__name__)
+    app.secret_key = "benchmark"
+    if backend == "filesystem":
+        from flask_session import Session
+
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config["SESSION_PERMANENT"] = False
+        app.config["SESSION_FILE_DIR"] = join(directory, "flask_session")
+        Session(app)
+    elif backend == "sqlite":
+        store = SqliteSessionStore(join(directory, "sessions.db"))
+        create_tables(store.db)
+        app.session_interface = ServerSessionInterface(store)
+    else:
+        app.session_interface = ServerSessionInterface(RedisSessionStore(redis_url))
+
+    @app.route("/login")
+    def login():
+        # The same keys /login sets
+        session["username"] = "listener0"
+        session["name"] = "Listener Zero"
+        session["user_type"] = 1
+        return ""
+
+    @app.route("/read")
+    def read():
+        return session["username"]
+
+    @app.route("/write")
+    def write():
+        session["playlist"] = session.get("playlist", [])[-99:] + ["song00000001"]
+        return ""
+
+    return app
+
+
+def run(app: Flask, path: str, requests: int, threads: int) -> dict:
+    # Every thread is its own logged in user, with its own cookie
+    samples = []
+
+    def worker():
+        client = app.test_client()
+        client.get("/login")
+        for _ in range(requests // threads):
+            start = perf_counter()
+            client.get(path).get_data()
+            samples.append(perf_counter() - start)
+
+    workers = [Thread(target=worker) for _ in range(threads)]
+    started = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summary(samples) | {
+        "throughput_rps": len(samples) / (perf_counter() - started)
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--redis-url")
+    args = parser.parse_args()
+
+    redis_url, server = args.redis_url, None
+    if redis_url is None:
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            TcpFakeServer = None
+        if TcpFakeServer is not None:
+            server = TcpFakeServer(("127.0.0.1", 0))
+            Thread(target=server.serve_forever, daemon=True).start()
+            redis_url = "redis://%s:%d" % server.server_address
+
+    results = {}
+    for backend in ["filesystem", "sqlite", "redis"]:
+        if backend == "redis" and redis_url is None:
+            continue
+        directory = mkdtemp(prefix="music-bench-")
+        app = make_app(backend, directory, redis_url)
+        results[backend] = {
+            "read": run(app, "/read", args.requests, args.threads),
+            "write": run(app, "/write", args.requests, args.threads),
+        }
+        if backend == "filesystem":
+            results[backend]["files"] = len(listdir(app.config["SESSION_FILE_DIR"]))
+    if server is not None:
+        server.shutdown()
+
+    print(dumps({"threads": args.threads, "backends": results}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Cold start of a worker: how long a fresh interpreter takes to import src.app and to run create_app, how much memory it has then, and the modules that take longest to import. Exits with status 1 if the median import takes longer than --budget-ms, or if importing created any file, so it can gate a deploy. The databases are pointed at an empty temporary directory, which importing must leave empty.
+
+With --gunicorn, also starts the Dockerfile's gunicorn command with and without --preload, and reports how long each took to answer and the proportional memory (PSS, Linux only) of its workers, which --preload should shrink by sharing the imported modules and compiled templates.
+
+Run from the repository root:
+    python -m benchmarks.startup --runs 10 --budget-ms 800
+    python -m benchmarks.startup --gunicorn
+"""
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import environ, listdir
+from os.path import join
+from subprocess import run
+from sys import executable, exit
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+from .common import start_server, summary
+
+child = """
+from json import dumps
+from resource import RUSAGE_SELF, getrusage
+from time import perf_counter
+
+start = perf_counter()
+import src.app
+
+imported = perf_counter() - start
+start = perf_counter()
+src.app.create_app()
+created = perf_counter() - start
+print(dumps([imported, created, getrusage(RUSAGE_SELF).ru_maxrss]))
+"""
+
+
+def scratch_env() -> tuple[str, dict]:
+    directory = mkdtemp(prefix="music-bench-")
+    return directory, environ | {
+        "DATABASE_PATH": join(directory, "music-app.db"),
+        "PLAYS_DATABASE_PATH": join(directory, "plays.db"),
+        "SESSION_DATABASE_PATH": join(directory, "sessions.db"),
+    }
+
+
+def cold_starts(runs: int) -> dict:
+    directory, env = scratch_env()
+    imports, creates, rss = [], [], []
+    for _ in range(runs):
+        output = run(
+            [executable, "-c", child], env=env, capture_output=True, check=True
+        )
+        imported, created, maxrss = loads(output.stdout)
+        imports.append(imported)
+        creates.append(created)
+        rss.append(maxrss)
+    return {
+        "import": summary(imports),
+        "create_app": summary(creates),
+        "max_rss_mb": max(rss) / 1024,
+        "files_created": sorted(listdir(directory)),
+    }
+
+
+def slowest_imports(n: int) -> list:
+    # (module, cumulative ms) of the n slowest top level imports of src.app, from python -X importtime
+    _, env = scratch_env()
+    output = run(
+        [executable, "-X", "importtime", "-c", "import src.app"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in output.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        # Indented by two spaces per level, so these were imported by src.app itself
+        if name.startswith("   ") and not name.startswith("     "):
+            modules.append((name.strip(), int(cumulative) / 1000))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:n]
+
+
+def worker_pss(master: int) -> float:
+    # Sum of the proportional set size of the master's children in MB, which counts pages they share once between them
+    with open(f"/proc/{master}/task/{master}/children") as f:
+        workers = f.read().split()
+    total = 0
+    for pid in workers:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1])
+    return total / 1024
+
+
+def gunicorn(preload: bool, port: int, workers: int) -> dict:
+    _, env = scratch_env()
+    run([executable, "-m", "src.migrate", "--no-seed"], env=env, check=True)
+    command = (
+        [
+            "gunicorn",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(workers),
+            "--worker-class",
+            "gthread",
+            "--threads",
+            "4",
+        ]
+        + (["--preload"] if preload else [])
+        + ["wsgi:app"]
+    )
+    started = perf_counter()
+    server = start_server(command, "127.0.0.1", port, env)
+    ready = perf_counter() - started
+    try:
+        # Every worker has had time to boot, not only the one that answered
+        sleep(2)
+        return {"ready_seconds": ready, "workers_pss_mb": worker_pss(server.pid)}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=800)
+    parser.add_argument("--gunicorn", action="store_true")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = cold_starts(args.runs)
+    results["slowest_imports_ms"] = slowest_imports(10)
+    if args.gunicorn:
+        results["gunicorn"] = gunicorn(False, args.port, args.workers)
+        results["gunicorn_preload"] = gunicorn(True, args.port, args.workers)
+    print(dumps(results, indent=4))
+
+    failures = []
+    if results["import"]["p50_ms"] > args.budget_ms:
+        failures.append(
+            f"import src.app took {results['import']['p50_ms']:.0f}ms, over the {args.budget_ms:.0f}ms budget"
+        )
+    if results["files_created"]:
+        failures.append(f"starting the app created {results['files_created']}")
+    if failures:
+        print("\n".join(failures))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Both audio stores (src/storage.py), through the calls the app makes: adding --files songs with their files, then the same files again as other songs (which must be deduplicated), checking and reading them back, presigned URLs, a sweep, and deleting the songs until no file is referenced. The S3 store runs against a local moto server, unless --s3-url is given (MinIO, say: s3://bucket/audio?endpoint=http://localhost:9000, with the bucket already made).
+
+Every step is checked as well as timed, so this is also the test of the S3 store: it exits with status 1 if any step did not do what it should.
+
+Run from the repository root:
+    python -m benchmarks.storage --files 100
+"""
+
+from argparse import ArgumentParser
+from hashlib import sha256
+from io import BytesIO
+from json import dumps
+from os import environ, urandom
+from os.path import join
+from sys import exit
+from tempfile import mkdtemp
+from time import perf_counter
+from urllib.request import urlopen
+
+from werkzeug.datastructures import FileStorage
+
+from .common import scratch_db, summary
+
+failures = []
+
+
+def check(ok: bool, message: str):
+    if not ok:
+        failures.append(message)
+
+
+def timed_each(fn, items) -> dict:
+    samples = []
+    for item in items:
+        start = perf_counter()
+        fn(item)
+        samples.append(perf_counter() - start)
+    return summary(samples)
+
+
+def exercise(name: str, files: list[bytes]) -> dict:
+    from src import database, storage
+    from src.database import Song, add_song_to_db, delete_song_from_db
+
+    store = storage.store
+
+    def refcount(digest: str) -> int | None:
+        row = database.db.query(
+            "SELECT refcount FROM audio_blobs WHERE sha256=?", (digest,)
+        )
+        return row[0][0] if row else None
+
+    def add(prefix: str):
+        def add_one(i: int):
+            song = Song(
+                (f"{prefix}{i}", "Song", "Artist", "Album", "Pop", 2024, "", "creator0")
+            )
+            ok = add_song_to_db(song, FileStorage(BytesIO(b"ID3" + files[i])))
+            check(ok, f"{name}: adding {prefix}{i} failed")
+
+        return add_one
+
+    results = {"files": len(files), "bytes_each": len(files[0])}
+    # ID3 makes them guessed as audio/mpeg, so the digest is of the bytes as stored
+    digests = [sha256(b"ID3" + data).hexdigest() for data in files]
+    indexes = range(len(files))
+
+    results["add"] = timed_each(add("first"), indexes)
+    check(
+        all(store.exists(digest) for digest in digests),
+        f"{name}: a stored file is missing",
+    )
+    results["add_duplicate"] = timed_each(add("second"), indexes)
+    check(
+        all(refcount(digest) == 2 for digest in digests),
+        f"{name}: duplicates were not counted as one file with two references",
+    )
+    stored = {digest for digest, _ in store.list()}
+    check(
+        stored == set(digests),
+        f"{name}: the store lists {len(stored)} files, not {len(digests)}",
+    )
+    check(
+        storage.media("first0") == (digests[0], "audio/mpeg"),
+        f"{name}: media() does not match what was stored",
+    )
+
+    scratch = mkdtemp(prefix="music-bench-")
+
+    def read(i: int):
+        destination = join(scratch, digests[i])
+        store.get(digests[i], destination)
+        with open(destination, "rb") as f:
+            check(
+                f.read() == b"ID3" + files[i], f"{name}: {digests[i]} read back wrong"
+            )
+
+    results["get"] = timed_each(read, indexes)
+    results["exists"] = timed_each(lambda i: store.exists(digests[i]), indexes)
+
+    url = store.url(digests[0], "audio/mpeg")
+    if url is not None:
+        results["url"] = timed_each(
+            lambda i: store.url(digests[i], "audio/mpeg"), indexes
+        )
+        with urlopen(url) as response:
+            check(
+                response.read() == b"ID3" + files[0],
+                f"{name}: the presigned URL does not serve the file",
+            )
+
+    check(storage.sweep(0) == 0, f"{name}: sweep deleted a file that is in use")
+
+    results["delete_first"] = timed_each(
+        lambda i: delete_song_from_db(f"first{i}"), indexes
+    )
+    check(
+        all(store.exists(digest) and refcount(digest) == 1 for digest in digests),
+        f"{name}: a file still used by another song was deleted",
+    )
+    results["delete_last"] = timed_each(
+        lambda i: delete_song_from_db(f"second{i}"), indexes
+    )
+    check(
+        not any(store.exists(digest) for digest in digests),
+        f"{name}: a file no song uses was left in the store",
+    )
+    check(
+        not database.db.query("SELECT 1 FROM audio_blobs"),
+        f"{name}: audio_blobs still has rows",
+    )
+    return results
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    parser.add_argument("--s3-url")
+    args = parser.parse_args()
+
+    from src import storage
+
+    files = [urandom(args.size) for _ in range(args.files)]
+    results = {}
+
+    scratch_db()
+    storage.store = storage.LocalStore(mkdtemp(prefix="music-bench-"))
+    results["local"] = exercise("local", files)
+
+    s3_url, server = args.s3_url, None
+    if s3_url is None:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            ThreadedMotoServer = None
+        if ThreadedMotoServer is not None:
+            server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+            server.start()
+            host, port = server.get_host_and_port()
+            # moto takes any credentials, but boto3 will not sign without some
+            for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+                environ.setdefault(key, "benchmark")
+            environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            s3_url = f"s3://benchmark/audio?endpoint=http://{host}:{port}"
+    if s3_url is not None:
+        scratch_db()
+        storage.store = storage.make_store(s3_url)
+        if server is not None:
+            storage.store.client.create_bucket(Bucket=storage.store.bucket)
+        results["s3"] = exercise("s3", files)
+        if server is not None:
+            server.stop()
+
+    print(dumps(results, indent=4))
+    if failures:
+        print("\n".join(failures))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
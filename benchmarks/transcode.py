@@ -0,0 +1,44 @@
+"""
+Bytes served per rendition of the bundled sample tracks, against the originals. Needs ffmpeg (or FFMPEG pointing at it).
+
+Run from the repository root:
+    python -m benchmarks.transcode
+"""
+
+from json import dumps
+from os import listdir
+from os.path import getsize, join
+from sys import exit
+from tempfile import mkdtemp
+from time import perf_counter
+
+from src import transcode
+
+audio_folder = "data"
+
+
+def main():
+    if transcode.ffmpeg is None:
+        exit("ffmpeg not found, set FFMPEG to its path")
+
+    scratch = mkdtemp(prefix="music-bench-")
+    results = {}
+    for music_id in sorted(listdir(audio_folder)):
+        source = join(audio_folder, music_id)
+        original = getsize(source)
+        results[music_id] = {"original_bytes": original}
+        for rendition, bitrate in transcode.renditions.items():
+            destination = join(scratch, f"{music_id}-{rendition}.m4a")
+            start = perf_counter()
+            transcode.encode(source, destination, bitrate)
+            size = getsize(destination)
+            results[music_id][rendition] = {
+                "bytes": size,
+                "saved_percent": round((1 - size / original) * 100, 1),
+                "encode_seconds": round(perf_counter() - start, 2),
+            }
+    print(dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
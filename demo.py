@@ -1,16 +1,11 @@
 from random import randint
 from faker import Faker
-from src.database import db
+from src.database import create_user, fetch_user_details
 
+# Adds 100 fake listeners and creators, all with the password "password", to a database made by python -m src.migrate
 for i in range(100):
     name = Faker().name()
-    _id = randint(0, 1)
+    _id = randint(1, 2)
     username = Faker().email()
-    if not db.exists("users", (username,)):
-        db.insert(
-            "users",
-            username,
-            name,
-            _id,
-        )
-    print(db.fetchone("users", (username,)))
+    create_user(username, "password", name, _id)
+    print(fetch_user_details(username))
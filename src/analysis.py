@@ -0,0 +1,360 @@
+import wave
+from argparse import ArgumentParser
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cache
+from itertools import repeat
+from logging import basicConfig, getLogger
+from math import log10
+from operator import mul
+from os import getenv
+from subprocess import run
+from sys import byteorder
+from time import perf_counter, time
+
+from . import database, storage
+from .transcode import ffmpeg
+
+logger = getLogger(__name__)
+
+# The ingest stage. Every stored file is decoded once, to mono at sample_rate, and from the samples are worked out:
+#     - peaks, the loudest sample in each of peak_count slices of the track, one byte each, for the player to draw the waveform with
+#     - the duration, and the loudness (gated like EBU R 128, without its K-weighting)
+#     - a landmark fingerprint: pairs of spectral peaks hashed as (frequency, frequency, time between them), with the frame each starts at. Re-encoding a track keeps most of its spectral peaks where they were, so a re-encoded or trimmed copy of a track shares many hashes with it at one constant frame offset
+# Uploads are analysed on the job pool before they are stored, and `python -m src.analysis backfill` analyses the files stored before, on a process pool. The DSP is vectorized with NumPy, imported by the first analysis rather than at the top, so a worker that never analyses a file does not spend its startup importing it. Without it peaks, duration and loudness are worked out in plain Python, and there is no fingerprint
+
+sample_rate = 11025
+peak_count = 1000
+# Loudness is measured over blocks this long
+block_seconds = 0.4
+# Spectrogram frames for the fingerprint, about 93 ms long, every 46 ms
+frame_size = 1024
+hop_size = 512
+# A spectral peak is the largest value within this many frames and bins either side of it
+peak_reach = (8, 12)
+# Each peak is paired with the next fan_out peaks that start at most max_pair_frames (6 bits) after it
+fan_out = 5
+max_pair_frames = 63
+# A file is a near duplicate of another if at least this many of its hashes line up with the other's at one offset
+min_matches = 20
+
+
+@cache
+def load_numpy():
+    # NumPy, or None if it is not installed
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def decode(source: str):
+    """
+    The track at source (a path, or a URL for ffmpeg to fetch) as mono 16 bit samples at sample_rate: a NumPy array, or without NumPy an array.array. Decoded with ffmpeg, or without it WAV files only. ValueError if it cannot be decoded.
+    """
+    if ffmpeg is not None:
+        out = run(
+            [
+                ffmpeg,
+                "-v",
+                "error",
+                "-i",
+                source,
+                "-vn",
+                "-ac",
+                "1",
+                "-ar",
+                str(sample_rate),
+                "-f",
+                "s16le",
+                "-",
+            ],
+            capture_output=True,
+            timeout=600,
+        )
+        if out.returncode != 0:
+            raise ValueError(out.stderr.decode(errors="replace") or "Cannot decode")
+        pcm = out.stdout
+    else:
+        pcm = decode_wav(source)
+
+    np = load_numpy()
+    if np is not None:
+        return np.frombuffer(pcm, dtype="<i2")
+    samples = array("h")
+    samples.frombytes(pcm)
+    if byteorder == "big":
+        samples.byteswap()
+    return samples
+
+
+def decode_wav(source: str) -> bytes:
+    # Without ffmpeg, 16 bit WAV files can still be read. Mixing them down and resampling them takes NumPy, unless they are mono at sample_rate already
+    try:
+        with wave.open(source, "rb") as f:
+            channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+            pcm = f.readframes(f.getnframes())
+    except (wave.Error, EOFError):
+        raise ValueError("ffmpeg is needed to decode this file")
+    if width != 2:
+        raise ValueError("ffmpeg is needed to decode WAV files that are not 16 bit")
+    if (channels, rate) == (1, sample_rate):
+        return pcm
+    np = load_numpy()
+    if np is None:
+        raise ValueError("ffmpeg or NumPy is needed to resample this file")
+    samples = np.frombuffer(pcm, dtype="<i2").reshape(-1, channels).mean(axis=1)
+    positions = np.arange(len(samples) * sample_rate // rate) * (rate / sample_rate)
+    resampled = np.interp(positions, np.arange(len(samples)), samples)
+    return resampled.astype("<i2").tobytes()
+
+
+def peaks(samples, count: int = peak_count) -> bytes:
+    # The loudest sample in each of count equal slices of the track, from 0 to 255
+    if len(samples) == 0:
+        return bytes(count)
+    np = load_numpy()
+    if np is not None:
+        starts = np.linspace(0, len(samples), count + 1).astype(np.int64)[:-1]
+        loudest = np.maximum.reduceat(np.abs(samples.astype(np.int32)), starts)
+        return (loudest * 255 // 32768).astype(np.uint8).tobytes()
+    loudest = []
+    for i in range(count):
+        part = samples[i * len(samples) // count : (i + 1) * len(samples) // count]
+        loudest.append(max(max(part), -min(part)) * 255 // 32768 if part else 0)
+    return bytes(loudest)
+
+
+def loudness(samples) -> float | None:
+    """
+    Loudness in dB relative to full scale, from the mean square of block_seconds blocks. Blocks below -70 dB are left out, then blocks more than 10 dB below the mean of the rest, as EBU R 128 gates them. None for silence.
+    """
+    block = int(sample_rate * block_seconds)
+    blocks = max(len(samples) // block, 1 if len(samples) else 0)
+    np = load_numpy()
+    if np is not None:
+        scaled = samples[: blocks * block if len(samples) >= block else None] / 32768
+        energies = np.mean(np.square(scaled).reshape(blocks, -1), axis=1).tolist()
+    else:
+        energies = []
+        for i in range(blocks):
+            part = samples[
+                i * block : (i + 1) * block if len(samples) >= block else None
+            ]
+            energies.append(sum(map(mul, part, part)) / len(part) / 32768**2)
+
+    energies = [energy for energy in energies if energy > 1e-7]
+    if not energies:
+        return None
+    mean = sum(energies) / len(energies)
+    energies = [energy for energy in energies if energy > mean / 10]
+    return round(10 * log10(sum(energies) / len(energies)), 2)
+
+
+def running_max(values, reach: int, axis: int):
+    # Each value replaced by the largest within reach of it along axis
+    np = load_numpy()
+    out = values.copy()
+    for shift in range(1, reach + 1):
+        ahead = [slice(None)] * values.ndim
+        behind = [slice(None)] * values.ndim
+        ahead[axis], behind[axis] = slice(shift, None), slice(None, -shift)
+        ahead, behind = tuple(ahead), tuple(behind)
+        np.maximum(out[ahead], values[behind], out=out[ahead])
+        np.maximum(out[behind], values[ahead], out=out[behind])
+    return out
+
+
+def fingerprint(samples) -> tuple | None:
+    """
+    The landmark hashes of the track and the frame each starts at, as two NumPy arrays. None without NumPy, or for a track too short to have any.
+    """
+    np = load_numpy()
+    if np is None or len(samples) < frame_size:
+        return None
+    frames = np.lib.stride_tricks.sliding_window_view(
+        samples.astype(np.float32), frame_size
+    )[::hop_size]
+    # Bins 1 to 511, so a bin fits in 9 bits. 0 is the DC offset
+    spectrum = np.log1p(
+        np.abs(np.fft.rfft(frames * np.hanning(frame_size), axis=1))[:, :512]
+    )
+    spectrum[:, 0] = 0
+
+    neighbourhood = running_max(
+        running_max(spectrum, peak_reach[1], 1), peak_reach[0], 0
+    )
+    # Peaks in quiet passages are mostly noise, and would not survive re-encoding
+    loud = spectrum > spectrum.mean() + spectrum.std()
+    times, bins = np.nonzero((spectrum == neighbourhood) & loud)
+
+    hashes, starts = [], []
+    for step in range(1, fan_out + 1):
+        gap = times[step:] - times[:-step]
+        pair = (gap > 0) & (gap <= max_pair_frames)
+        hashes.append((bins[:-step][pair] << 15) | (bins[step:][pair] << 6) | gap[pair])
+        starts.append(times[:-step][pair])
+    hashes, starts = np.concatenate(hashes), np.concatenate(starts)
+    return (hashes, starts) if len(hashes) else None
+
+
+def analyse(source: str) -> dict:
+    """
+    Decodes the track at source and works everything out from it. Runs on the job pool for uploads, and in the process pool for backfills, so it does not touch the database.
+    """
+    samples = decode(source)
+    return {
+        "duration": len(samples) / sample_rate,
+        "loudness": loudness(samples),
+        "peaks": peaks(samples),
+        "fingerprint": fingerprint(samples),
+    }
+
+
+def find_matches(landmarks, exclude: str | None = None, batch_size: int = 500) -> list:
+    """
+    The stored files that a fingerprint (from fingerprint()) has at least min_matches hashes in common with at one frame offset, best first, as (sha256, hashes in common). exclude is left out, e.g. the file the fingerprint is of.
+    """
+    if landmarks is None:
+        return []
+    hashes, starts = landmarks
+    starts_by_hash = defaultdict(list)
+    for hash, start in zip(hashes.tolist(), starts.tolist()):
+        starts_by_hash[hash].append(start)
+
+    # Votes for (file, offset). A copy of the track lines up at one offset, chance matches spread out over many
+    votes = Counter()
+    unique = list(starts_by_hash)
+    for i in range(0, len(unique), batch_size):
+        batch = unique[i : i + batch_size]
+        for hash, digest, frame in database.db.query(
+            f"SELECT hash, sha256, frame FROM fingerprints WHERE hash IN ({','.join('?' * len(batch))})",
+            batch,
+        ):
+            if digest != exclude:
+                for start in starts_by_hash[hash]:
+                    votes[digest, frame - start] += 1
+
+    best = Counter()
+    for (digest, _), count in votes.items():
+        best[digest] = max(best[digest], count)
+    return [
+        (digest, count) for digest, count in best.most_common() if count >= min_matches
+    ]
+
+
+def save(digest: str, result: dict) -> bool:
+    """
+    Saves what analyse() worked out for the stored file digest, replacing what was saved before. Returns False if the file is no longer stored.
+    """
+    with database.db.transaction() as con:
+        if not con.execute(
+            "SELECT 1 FROM audio_blobs WHERE sha256=?", (digest,)
+        ).fetchone():
+            return False
+        con.execute(
+            "INSERT OR REPLACE INTO audio_analysis VALUES (?,?,?,?,?)",
+            (
+                digest,
+                result["duration"],
+                result["loudness"],
+                result["peaks"],
+                int(time()),
+            ),
+        )
+        con.execute("DELETE FROM fingerprints WHERE sha256=?", (digest,))
+        if result["fingerprint"] is not None:
+            hashes, starts = result["fingerprint"]
+            con.executemany(
+                "INSERT INTO fingerprints VALUES (?,?,?)",
+                zip(hashes.tolist(), repeat(digest), starts.tolist()),
+            )
+    return True
+
+
+def songs_using(digests: list[str]) -> list[str]:
+    if not digests:
+        return []
+    return [
+        music_id
+        for (music_id,) in database.db.query(
+            f"SELECT music_id FROM song_media WHERE sha256 IN ({','.join('?' * len(digests))}) ORDER BY music_id",
+            digests,
+        )
+    ]
+
+
+def fetch(digest: str) -> dict | None:
+    row = database.db.fetchone("audio_analysis", (digest,))
+    if row is None:
+        return None
+    return {"duration": row[1], "loudness": row[2], "peaks": list(row[3])}
+
+
+def backfill(workers: int = 4) -> dict:
+    """
+    Analyses every stored file that has not been, workers at a time in a process pool. The results are saved by this process as they come in.
+    """
+    pending = database.db.query(
+        """SELECT audio_blobs.sha256, MAX(song_media.mimetype) FROM audio_blobs
+            JOIN song_media ON song_media.sha256 = audio_blobs.sha256
+            LEFT JOIN audio_analysis ON audio_analysis.sha256 = audio_blobs.sha256
+            WHERE audio_analysis.sha256 IS NULL
+            GROUP BY audio_blobs.sha256
+        """
+    )
+    counts = {"pending": len(pending), "analysed": 0, "failed": 0}
+    started = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            # Files in an object store are fetched by ffmpeg from a presigned URL
+            pool.submit(
+                analyse,
+                storage.store.local_path(digest) or storage.store.url(digest, mimetype),
+            ): digest
+            for digest, mimetype in pending
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except (ValueError, OSError) as e:
+                logger.warning("Could not analyse %s: %s", futures[future], e)
+                counts["failed"] += 1
+                continue
+            save(futures[future], result)
+            counts["analysed"] += 1
+    seconds = perf_counter() - started
+    return counts | {
+        "seconds": seconds,
+        "files_per_second": counts["analysed"] / seconds if seconds else 0,
+    }
+
+
+def main():
+    basicConfig(
+        level=getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    parser = ArgumentParser(prog="python -m src.analysis")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser(
+        "backfill", help="Analyse the stored files that have not been"
+    )
+    command.add_argument("--workers", type=int, default=4)
+    command = commands.add_parser(
+        "duplicates", help="List the songs whose audio is a near duplicate of a file"
+    )
+    command.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        logger.info("%s", backfill(args.workers))
+    else:
+        for digest, count in find_matches(fingerprint(decode(args.path))):
+            logger.info("%s (%d hashes): %s", digest, count, songs_using([digest]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+from gzip import compress as gzip
+
+from flask import Blueprint, current_app, make_response
+from flask import request as r
+from flask import session as sesh
+
+from . import analysis, pages, plays
+from .database import (
+    fetch_songs,
+    get_available_playlists,
+    list_songs,
+    load_playlist_music,
+    search_songs,
+    song_columns,
+    song_listing_columns,
+)
+from .storage import media
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Version 1 of the JSON API, for the player and other clients. Every song is sent with only the fields asked for (?fields=name,artist, everything but the lyrics by default), so listings do not carry lyrics nobody reads. GET responses have ETags derived from the catalogue version (see pages.py), so a client revalidating a response that has not changed gets a 304 without the database being read. Responses are gzip or brotli compressed when the client accepts it, and encoded as MessagePack instead of JSON when it asks for application/msgpack and the msgpack package is installed
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Most music_ids one lookup can ask for
+max_batch = 500
+# Smaller responses are sent uncompressed, since compressing them saves less than it costs
+min_compress_size = 1024
+default_fields = song_listing_columns
+
+
+class ApiError(Exception):
+    def __init__(self, msg: str, status: int = 400):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(e: ApiError):
+    return {"msg": e.msg}, e.status
+
+
+def requested_fields() -> tuple:
+    # The song fields asked for with ?fields=, in song_columns order. music_id is always sent
+    if "fields" not in r.args:
+        return default_fields
+    fields = set(filter(None, r.args["fields"].split(","))) | {"music_id"}
+    if not fields.issubset(song_columns):
+        raise ApiError(
+            f"Unknown fields {', '.join(sorted(fields - set(song_columns)))}"
+        )
+    return tuple(column for column in song_columns if column in fields)
+
+
+def representation() -> tuple[str, str | None]:
+    # The (mimetype, content encoding) to answer with, out of what the client accepts and this server can produce
+    mimetypes = ["application/json"] + (["application/msgpack"] if msgpack else [])
+    mimetype = r.accept_mimetypes.best_match(mimetypes) or "application/json"
+    if brotli is not None and r.accept_encodings["br"]:
+        return mimetype, "br"
+    if r.accept_encodings["gzip"]:
+        return mimetype, "gzip"
+    return mimetype, None
+
+
+def encode(
+    payload: dict, mimetype: str, encoding: str | None
+) -> tuple[bytes, str | None]:
+    # The body, and the Content-Encoding it was compressed with if any
+    if mimetype == "application/msgpack":
+        body = msgpack.packb(payload)
+    else:
+        body = current_app.json.dumps(payload).encode("utf-8")
+    if encoding is None or len(body) < min_compress_size:
+        return body, None
+    if encoding == "br":
+        return brotli.compress(body, quality=5), "br"
+    return gzip(body, compresslevel=6), "gzip"
+
+
+def respond(payload: dict, etag: str | None = None, private: bool = False):
+    mimetype, encoding = representation()
+    body, encoding = encode(payload, mimetype, encoding)
+    response = make_response(body)
+    response.mimetype = mimetype
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.update(
+        ["Accept", "Accept-Encoding"] + (["Cookie"] if private else [])
+    )
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = (
+            "private, no-cache" if private else "public, no-cache"
+        )
+    return response
+
+
+def conditional(version_names: tuple, build, private: bool = False, key=None):
+    """
+    Answers a GET with build(), or with 304 Not Modified, before build() does any work, if the client already has the response for the current versions of the data (see pages.versions). The ETag covers the versions, the URL, the representation, key (for data the versions do not cover) and, for private responses, who is asking.
+    """
+    etag = pages.etag(
+        r.full_path,
+        pages.versions(*version_names),
+        representation(),
+        key,
+        sesh.get("username") if private else None,
+    )
+    if r.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.vary.update(
+            ["Accept", "Accept-Encoding"] + (["Cookie"] if private else [])
+        )
+        return response
+    return respond(build(), etag, private)
+
+
+def lookup(music_ids, fields: tuple) -> dict:
+    if not isinstance(music_ids, list) or not all(
+        isinstance(music_id, str) for music_id in music_ids
+    ):
+        raise ApiError("ids must be a list of music_ids")
+    if len(music_ids) > max_batch:
+        raise ApiError(f"At most {max_batch} music_ids can be looked up at once")
+    songs = fetch_songs(music_ids, fields)
+    found = {song.music_id for song in songs}
+    return {
+        "songs": [song.to_json(fields) for song in songs],
+        "missing": [music_id for music_id in music_ids if music_id not in found],
+    }
+
+
+@api.route("/songs", methods=["GET"])
+def songs():
+    """
+    With ?ids=a,b,c, those songs. Otherwise a page of the catalogue, filtered and sorted like /player (genre, year, sort, limit), with the cursor of the next page in next.
+    """
+    fields = requested_fields()
+    if "ids" in r.args:
+        music_ids = list(filter(None, r.args["ids"].split(",")))
+        return conditional(("catalogue",), lambda: lookup(music_ids, fields))
+
+    def page():
+        sort = r.args.get("sort", "name")
+        try:
+            songs, next_cursor = list_songs(
+                genre=r.args.get("genre"),
+                year=r.args.get("year", type=int),
+                sort=sort,
+                cursor=r.args.get("cursor"),
+                limit=min(max(r.args.get("limit", 50, type=int), 1), max_batch),
+                # The cursor is made from the sort key, so it is selected even if not asked for
+                columns=tuple(
+                    c for c in song_columns if c in fields or c in {sort, "name"}
+                ),
+            )
+        except ValueError:
+            raise ApiError("Malformed cursor")
+        return {
+            "songs": [song.to_json(fields) for song in songs],
+            "next": next_cursor,
+        }
+
+    return conditional(("catalogue",), page)
+
+
+@api.route("/songs/lookup", methods=["POST"])
+def songs_lookup():
+    """
+    Like GET /songs?ids=, for more music_ids than fit in a URL: {"ids": [...], "fields": [...]}.
+    """
+    d = r.get_json(silent=True)
+    if not isinstance(d, dict):
+        raise ApiError("Malformed request")
+    fields = d.get("fields", list(default_fields))
+    if not isinstance(fields, list) or not all(
+        field in song_columns for field in fields
+    ):
+        raise ApiError("fields must be a list of song fields")
+    fields = tuple(c for c in song_columns if c in fields or c == "music_id")
+    return respond(lookup(d.get("ids"), fields))
+
+
+@api.route("/songs/<music_id>", methods=["GET"])
+def song(music_id: str):
+    fields = requested_fields()
+
+    def build():
+        found = fetch_songs([music_id], fields)
+        if not found:
+            raise ApiError("No such song", 404)
+        return found[0].to_json(fields)
+
+    return conditional(("catalogue",), build)
+
+
+@api.route("/songs/<music_id>/waveform", methods=["GET"])
+def waveform(music_id: str):
+    """
+    What the player draws the song's waveform from: peaks (analysis.peak_count values from 0 to 255, the loudest point of each slice of the track), duration and loudness.
+    """
+    found = media(music_id)
+    if found is None:
+        raise ApiError("No such song", 404)
+
+    def build():
+        analysed = analysis.fetch(found[0])
+        if analysed is None:
+            raise ApiError("Not analysed yet", 404)
+        return analysed
+
+    # Worked out from the file alone, so the file's hash identifies it
+    return conditional((), build, key=found[0])
+
+
+@api.route("/songs/<music_id>/plays", methods=["GET"])
+def song_plays(music_id: str):
+    """
+    How many times the song has been played in all, and on each of the last ?days= days it was played (30 by default, at most 366), as of the last rollup (see plays.py).
+    """
+    days = min(max(r.args.get("days", 30, type=int), 1), 366)
+
+    def build():
+        if not fetch_songs([music_id], ("music_id",)):
+            raise ApiError("No such song", 404)
+        return {
+            "music_id": music_id,
+            "plays": plays.log.totals([music_id]).get(music_id, 0),
+            "days": [
+                {"day": day * plays.day, "plays": count}
+                for day, count in plays.log.per_day(music_id, days)
+            ],
+        }
+
+    return conditional(("catalogue", "plays"), build)
+
+
+@api.route("/search", methods=["GET"])
+def search():
+    """Search the catalogue, best matches first: ?q=...&limit=&offset="""
+    fields = requested_fields()
+    limit = min(max(r.args.get("limit", 50, type=int), 1), 100)
+    offset = max(r.args.get("offset", 0, type=int), 0)
+    return conditional(
+        ("catalogue",),
+        lambda: {
+            "songs": [
+                song.to_json(fields)
+                for song in search_songs(r.args.get("q", ""), limit, offset, fields)
+            ]
+        },
+    )
+
+
+@api.route("/playlists", methods=["GET"])
+def playlists():
+    """
+    The playlists the logged in user can see, with their music_ids. With ?expand=songs, with their songs too (with the listing fields, lyrics are not available here).
+    """
+    if "username" not in sesh:
+        raise ApiError("Not logged in", 401)
+    fields = tuple(c for c in requested_fields() if c in song_listing_columns)
+    expand = r.args.get("expand") == "songs"
+
+    def build():
+        available = get_available_playlists(sesh["username"])
+        if expand:
+            load_playlist_music(available)
+        return {
+            "playlists": [
+                {
+                    "playlist_id": playlist.playlist_id,
+                    "name": playlist.name,
+                    "owner": playlist.owner,
+                    "privacy": playlist.privacy,
+                    "music_ids": playlist.music_ids,
+                }
+                | (
+                    {"songs": [song.to_json(fields) for song in playlist.music]}
+                    if expand
+                    else {}
+                )
+                for playlist in available
+            ]
+        }
+
+    return conditional(("catalogue", "playlists", "users"), build, private=True)
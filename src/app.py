@@ -1,53 +1,129 @@
-from os import getenv
-from os.path import splitext
+from hmac import compare_digest
+from logging import basicConfig, getLogger
+from os import getenv, getpid
+from os.path import basename, isfile, relpath, splitext
 from uuid import uuid4
 
 from dotenv import load_dotenv
-from flask import Flask, flash, get_flashed_messages, jsonify, redirect, render_template
+from flask import (
+    Flask,
+    before_render_template,
+    flash,
+    get_flashed_messages,
+    jsonify,
+    redirect,
+    make_response,
+    render_template,
+    send_file,
+    template_rendered,
+    url_for,
+)
 from flask import request as r
 from flask import session as sesh
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
 
-from flask_session import Session
-
 from .database import (
     Song,
-    add_song_to_db,
     add_to_blacklist,
-    check_password,
-    check_user_exists,
+    cache_stats,
+    check_credentials,
     create_user,
     delete_song_from_db,
     fetch_song_details_from_db,
-    fetch_user_details,
+    fetch_user_row,
     get_available_playlists,
-    get_available_songs,
-    get_number_of_creators,
-    get_number_of_listeners,
+    list_songs,
+    pool_stats,
+    scan_catalogue_for_blacklisted,
+    search_songs,
+    song_exists,
+    song_listing_columns,
     update_song_details_in_db,
 )
+from . import metrics, pages, playback, plays, stats, storage
+from .api import api
+from .sessions import make_session_interface
+from .transcode import cache_folder as rendition_cache_folder
+from .transcode import choose_rendition, get_rendition
+from .uploads import (
+    UploadError,
+    begin_upload,
+    complete_upload,
+    job_status,
+    save_upload,
+    upload_status,
+    write_chunk,
+)
+from .uploads import chunk_size as upload_chunk_size
 
 load_dotenv()
 
-# Initialize Flask app
+basicConfig(
+    level=getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = getLogger(__name__)
+
+# Routes are registered on this at import, everything else is set up by create_app
 app = Flask("Music Streaming App")
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SESSION_COOKIE_HTTPONLY"] = True
-app.config["UPLOAD_EXTENSIONS"] = [
-    ".mp3",
-    ".mp4",
-    ".ogg",
-    ".wav",
-    ".flac",
-    ".aac",
-    ".wma",
-    ".m4a",
-]
-app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024 * 10
 
 
-Session(app)
+def create_app() -> Flask:
+    """
+    Configures the app from the environment and returns it. Importing this module does no I/O, so gunicorn --preload can import it and call this once in the master, and fork workers that share the compiled templates and imported modules with it. The databases must have been created first, with python -m src.migrate.
+    """
+    if "api" in app.blueprints:
+        # Already set up, by wsgi.py or asgi.py
+        return app
+    app.jinja_options = app.jinja_options | {"bytecode_cache": pages.bytecode_cache()}
+    app.config["SESSION_COOKIE_HTTPONLY"] = True
+    app.config["UPLOAD_EXTENSIONS"] = [
+        ".mp3",
+        ".mp4",
+        ".ogg",
+        ".wav",
+        ".flac",
+        ".aac",
+        ".wma",
+        ".m4a",
+    ]
+    app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024 * 10
+    # How /stream hands audio to the client. "" streams it from the worker (with sendfile under gunicorn), "x-sendfile" lets Apache/lighttpd send it, and "x-accel-redirect" lets nginx send it from an internal location at AUDIO_ACCEL_PREFIX
+    app.config["AUDIO_OFFLOAD"] = str(getenv("AUDIO_OFFLOAD", "")).casefold()
+    app.config["AUDIO_ACCEL_PREFIX"] = getenv("AUDIO_ACCEL_PREFIX", "/internal/audio/")
+    app.config["RENDITION_ACCEL_PREFIX"] = getenv(
+        "RENDITION_ACCEL_PREFIX", "/internal/renditions/"
+    )
+    app.config["USE_X_SENDFILE"] = app.config["AUDIO_OFFLOAD"] == "x-sendfile"
+    # Requests slower than this, or that run one statement this many times, are logged with where their time went
+    app.config["SLOW_REQUEST_SECONDS"] = float(getenv("SLOW_REQUEST_MS", 500)) / 1000
+    app.config["REPEATED_QUERY_WARNING"] = int(getenv("REPEATED_QUERY_WARNING", 20))
+    # Adds a Server-Timing header with the database and rendering time to every response
+    app.config["SERVER_TIMING"] = str(getenv("SERVER_TIMING")).casefold() in {
+        "y",
+        "yes",
+        "true",
+    }
+    # Lets a scraper read /metrics with an Authorization: Bearer header. Admins can read it either way
+    app.config["METRICS_TOKEN"] = getenv("METRICS_TOKEN")
+    # Started by each worker's first request rather than here, since a thread started in a --preload master does not survive the fork. Only by the first, see start_span
+    app.config["PROFILER_INTERVAL"] = (
+        max(float(getenv("PROFILER_INTERVAL_MS")), 1) / 1000
+        if getenv("PROFILER_INTERVAL_MS")
+        else None
+    )
+
+    app.register_blueprint(api)
+
+    # Compiled once here, so no request pays for it. Part of every page's ETag, see conditional_page
+    app.config["TEMPLATE_HASH"] = pages.warm_templates(app.jinja_env)
+
+    # Sessions are kept in SQLite, or in Redis if SESSION_URL is set. See sessions.py
+    app.session_interface = make_session_interface(
+        getenv("SESSION_URL"), getenv("SESSION_DATABASE_PATH", "sessions.db")
+    )
+    return app
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -67,10 +143,10 @@ def login():
         if not {"username", "pw", "user_type"}.issubset(f.keys()):
             return {"msg": "Malformed request"}, 400
 
-        elif check_user_exists(f["username"]):
-            if check_password(f["username"], f["pw"]):
+        elif row := fetch_user_row(f["username"]):
+            if check_credentials(row, f["pw"]):
                 user_type = int(f["user_type"])
-                if user_type == fetch_user_details(f["username"])[3]:
+                if user_type == row[3]:
                     # Password is correct, starting session
                     sesh["username"] = f["username"]
                     sesh["user_type"] = user_type
@@ -139,7 +215,7 @@ def logout():
 
 @app.route("/upload_song", methods=["GET", "POST"])
 def upload_song():
-    """accept and process a music file sent by the user, and send it to the add_song_to_db function. Return a success or failure message the"""
+    """accept a music file sent by the user in one request, and queue it for processing like a chunked upload. Return a success or failure message"""
 
     # Check admin or creator
     if not (check_logged_in(sesh, 2) or check_logged_in(sesh, 0)):
@@ -166,27 +242,267 @@ def upload_song():
     if not {"name", "artist", "album", "genre", "year", "lyrics"}.issubset(f.keys()):
         return {"msg": "Malformed request. Missing keys"}, 400
 
-    if add_song_to_db(
-        Song(
-            [
-                str(uuid4()),
-                f["name"],
-                f["artist"],
-                f["album"],
-                f["genre"],
-                f["year"],
-                f["lyrics"],
-                sesh["username"],
-            ],
-        ),
-        music_file,
-    ):
-        flash("Song uploaded successfully")
+    try:
+        save_upload(sesh["username"], music_file, song_from_form(f))
+    except UploadError as e:
+        flash(f"Could not upload song. {e.msg}")
         return redirect("/creator")
-    flash("Could not upload song")
+    flash("Song uploaded successfully. It will show up once it has been processed")
     return redirect("/creator")
 
 
+def song_from_form(f) -> Song:
+    return Song(
+        [
+            str(uuid4()),
+            f["name"],
+            f["artist"],
+            f["album"],
+            f["genre"],
+            f["year"],
+            f["lyrics"],
+            sesh["username"],
+        ],
+    )
+
+
+@app.route("/uploads", methods=["POST"])
+def start_upload():
+    """Start a chunked upload. Takes the size of the file in bytes, and optionally its sha256 to verify it against"""
+
+    if not (check_logged_in(sesh, 2) or check_logged_in(sesh, 0)):
+        return {"msg": "Not allowed"}, 403
+
+    f = r.form
+    if "size" not in f or not f["size"].isdigit():
+        return {"msg": "Malformed request"}, 400
+    if "filename" in f and (
+        splitext(secure_filename(f["filename"]))[1]
+        not in app.config["UPLOAD_EXTENSIONS"]
+    ):
+        return {"msg": "Invalid file extension"}, 400
+
+    try:
+        upload_id = begin_upload(sesh["username"], int(f["size"]), f.get("sha256"))
+    except UploadError as e:
+        return {"msg": e.msg}, e.status
+    return {"upload_id": upload_id, "chunk_size": upload_chunk_size}, 201
+
+
+@app.route("/uploads/<upload_id>", methods=["GET", "PUT"])
+def upload_chunk(upload_id: str):
+    """PUT the next chunk of an upload, with a Content-Range header saying where it starts. GET how much has been received, to resume an upload"""
+
+    if "username" not in sesh:
+        return {"msg": "Not allowed"}, 403
+
+    try:
+        if r.method == "GET":
+            return upload_status(upload_id, sesh["username"])
+
+        content_range = r.headers.get("Content-Range", "")
+        if not content_range.startswith("bytes ") or "-" not in content_range:
+            return {"msg": "Missing Content-Range"}, 400
+        start = content_range[6:].split("-")[0]
+        if not start.isdigit():
+            return {"msg": "Malformed Content-Range"}, 400
+
+        received = write_chunk(upload_id, sesh["username"], int(start), r.stream)
+    except UploadError as e:
+        return {"msg": e.msg}, e.status
+    return {"upload_id": upload_id, "received": received}
+
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+def finish_upload(upload_id: str):
+    """Finish a chunked upload with the details of the song. Returns the job that processes it"""
+
+    if "username" not in sesh:
+        return {"msg": "Not allowed"}, 403
+
+    f = r.form
+    if not {"name", "artist", "album", "genre", "year", "lyrics"}.issubset(f.keys()):
+        return {"msg": "Malformed request. Missing keys"}, 400
+
+    try:
+        job_id = complete_upload(upload_id, sesh["username"], song_from_form(f))
+    except UploadError as e:
+        return {"msg": e.msg}, e.status
+    return {"job_id": job_id}, 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job(job_id: str):
+    """Poll the status of a background job"""
+
+    if "username" not in sesh:
+        return {"msg": "Not allowed"}, 403
+
+    try:
+        return job_status(job_id, sesh["username"])
+    except UploadError as e:
+        return {"msg": e.msg}, e.status
+
+
+@app.route("/stream/<music_id>", methods=["GET"])
+def stream(music_id: str):
+    """
+    Stream an audio file. Handles Range and If-Range (206 Partial Content, so seeking only fetches the part being played), and ETag and Last-Modified validation (304 Not Modified).
+
+    Sends a smaller AAC rendition instead of the original when ?quality= or the client hints ask for one (see transcode.choose_rendition) and it has been encoded. If it has not, it is queued and the original is sent this time.
+    """
+    found = storage.media(music_id)
+    if found is None:
+        return {"msg": "No such song"}, 404
+    digest, mimetype = found
+    path = storage.store.local_path(digest)
+    if path is None:
+        # In an object store, the client fetches it from there instead of through a worker
+        return redirect(storage.store.url(digest, mimetype))
+    if not isfile(path):
+        return {"msg": "No such song"}, 404
+
+    accel_path = app.config["AUDIO_ACCEL_PREFIX"] + storage.shard(digest)
+    rendition = choose_rendition(r.headers, r.args, mimetype)
+    if rendition is not None:
+        rendition_path = get_rendition(digest, path, rendition)
+        if rendition_path is not None:
+            path, mimetype = rendition_path, "audio/mp4"
+            accel_path = app.config["RENDITION_ACCEL_PREFIX"] + relpath(
+                rendition_path, rendition_cache_folder
+            )
+
+    if app.config["AUDIO_OFFLOAD"] == "x-accel-redirect":
+        # nginx does the range handling and the sending, the worker is free immediately
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = accel_path
+        response.headers["Content-Type"] = mimetype
+    else:
+        # send_file wraps the file in wsgi.file_wrapper, which gunicorn sends with sendfile(2) without copying it through Python
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            conditional=True,
+            # Files are named by their content, so the name is all the ETag needs
+            etag=splitext(basename(path))[0],
+            max_age=86400,
+        )
+        # Tell the browser up front that it can seek with Range requests
+        response.headers["Accept-Ranges"] = "bytes"
+    response.vary.update(["Save-Data", "ECT", "Downlink"])
+    return response
+
+
+@app.after_request
+def ask_for_client_hints(response):
+    # Chromium only sends the ECT and Downlink hints that /stream picks renditions by to sites that ask for them
+    response.headers["Accept-CH"] = "Save-Data, ECT, Downlink"
+    return response
+
+
+# The process PROFILER_INTERVAL last started the profiler in. Once per process, so a profiler stopped through /metrics/profile stays stopped rather than being started again by the next request
+profiler_started_in = None
+
+
+@app.before_request
+def start_span():
+    global profiler_started_in
+    if app.config["PROFILER_INTERVAL"] and profiler_started_in != getpid():
+        profiler_started_in = getpid()
+        metrics.profiler.start(app.config["PROFILER_INTERVAL"])
+    metrics.start_request(r.endpoint or "unmatched", r.method)
+
+
+@app.after_request
+def record_status(response):
+    span = metrics.current.get()
+    if span is not None:
+        span.status = response.status_code
+        if app.config["SERVER_TIMING"]:
+            response.headers["Server-Timing"] = metrics.server_timing(span)
+    return response
+
+
+@app.teardown_request
+def finish_span(exc):
+    # Runs after unhandled exceptions too, which are left at status 500
+    span = metrics.current.get()
+    if span is not None:
+        metrics.finish_request(
+            span,
+            app.config["SLOW_REQUEST_SECONDS"],
+            app.config["REPEATED_QUERY_WARNING"],
+        )
+
+
+@before_render_template.connect_via(app)
+def start_render(sender, **extra):
+    metrics.start_render()
+
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, **extra):
+    metrics.finish_render(template.name)
+
+
+def metrics_allowed() -> bool:
+    # No exception for requests from localhost: behind nginx, every request is one
+    token = app.config["METRICS_TOKEN"]
+    if token and compare_digest(
+        r.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()
+    ):
+        return True
+    return check_logged_in(sesh, 0)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Request, database, template and cache metrics of this worker, in the Prometheus text format"""
+
+    if not metrics_allowed():
+        return {"msg": "Not allowed"}, 403
+    return (
+        metrics.render(
+            cache_stats()
+            + [app.session_interface.cache.stats(), pages.fragment_cache.stats()],
+            pool_stats(),
+            plays.log.stats(),
+        ),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@app.route("/metrics/profile", methods=["GET", "POST"])
+def profile_samples():
+    """
+    POST action=start (with an optional interval in ms) or action=stop to turn the sampling profiler of this worker on or off. GET the samples so far as collapsed stacks, for flamegraph.pl or speedscope. ?clear=1 starts over afterwards
+    """
+
+    if not metrics_allowed():
+        return {"msg": "Not allowed"}, 403
+
+    if r.method == "POST":
+        match r.form.get("action"):
+            case "start":
+                interval = r.form.get("interval", 10, type=float)
+                # Not positive would have the sampler spin without sleeping
+                if not interval > 0:
+                    return {"msg": "Malformed request"}, 400
+                metrics.profiler.start(max(interval, 1) / 1000)
+            case "stop":
+                metrics.profiler.stop()
+            case _:
+                return {"msg": "Malformed request"}, 400
+        return {"running": metrics.profiler.running}
+
+    return (
+        metrics.profiler.dump(clear=r.args.get("clear") == "1"),
+        200,
+        {"Content-Type": "text/plain; charset=utf-8"},
+    )
+
+
 @app.route("/fetch_song_details", methods=["POST"])
 def fetch_song_details():
     """Fetch song details from the database"""
@@ -197,7 +513,7 @@ def fetch_song_details():
         return {"msg": "Malformed request"}, 400
     song_details = fetch_song_details_from_db(d["music_id"])
 
-    return jsonify(song_details.__dict__)
+    return jsonify(song_details.to_json())
 
 
 @app.route("/blacklist", methods=["GET", "POST"])
@@ -222,22 +538,194 @@ def blacklist():
     return render_template("blacklist.html")
 
 
+@app.route("/blacklist/scan", methods=["GET"])
+def scan_blacklist():
+    """Scan the whole catalogue against the blacklist, and list the songs that match"""
+
+    if not check_logged_in(sesh, 0):
+        flash(
+            "You are not allowed to access that page. Try logging in with a different account"
+        )
+        return redirect("/logout")
+
+    return {
+        "flagged": {
+            music_id: sorted(terms)
+            for music_id, terms in scan_catalogue_for_blacklisted().items()
+        }
+    }
+
+
 @app.route("/add_to_playlist", methods=["GET", "POST"])
 def add_to_playlist():
-    if "p" not in sesh:
-        sesh["playlist"] = [r.form["music_id"]]
-    else:
-        sesh["playlist"].append(r.form["music_id"])
+    """Add a song to the end of the user's play queue"""
+
+    if not check_logged_in(sesh):
+        flash(
+            "You are not allowed to access that page. Try logging in with a different account"
+        )
+        return redirect("/logout")
+    if "music_id" not in r.form:
+        return {"msg": "Malformed request"}, 400
+    playback.append_to_queue(sesh["username"], [r.form["music_id"]])
     return redirect("/player")
 
 
+def queue_response(username: str):
+    """
+    The next tracks of the user's queue as JSON (see playback.up_next), with a Link header for the tracks to pre-buffer, for clients that act on those instead.
+    """
+    data = playback.up_next(username, min(max(r.args.get("n", 5, type=int), 1), 50))
+    response = jsonify(data)
+    if data["prefetch"]:
+        response.headers["Link"] = ", ".join(
+            f"<{url}>; rel=prefetch; as=audio" for url in data["prefetch"]
+        )
+    return response
+
+
+@app.route("/queue", methods=["GET", "POST"])
+def queue():
+    """
+    The user's play queue. GET returns the current track and the next ones with their details, and where in the current one playback was left. POST replaces the queue with {"music_ids": [...], "start": i}, or adds to its end with {"music_ids": [...], "append": true}, and returns the same.
+    """
+    if not check_logged_in(sesh):
+        return {"msg": "Not logged in"}, 401
+
+    if r.method == "POST":
+        d = r.get_json(silent=True)
+        if (
+            not isinstance(d, dict)
+            or not isinstance(d.get("music_ids"), list)
+            or not all(isinstance(music_id, str) for music_id in d["music_ids"])
+        ):
+            return {"msg": "Malformed request"}, 400
+        if d.get("append"):
+            playback.append_to_queue(sesh["username"], d["music_ids"])
+        else:
+            start = d.get("start", 0)
+            if not isinstance(start, int):
+                return {"msg": "Malformed request"}, 400
+            playback.replace_queue(sesh["username"], d["music_ids"], start)
+
+    return queue_response(sesh["username"])
+
+
+@app.route("/queue/position", methods=["POST"])
+def queue_position():
+    """
+    Saves where the user is. {"position": p, "seconds": s} saves how far into the track at position p they are, which the player sends every few seconds and on pause, and answers with no content. {"step": 1} (or -1) moves to the next (or previous) track and answers like GET /queue.
+    """
+    if not check_logged_in(sesh):
+        return {"msg": "Not logged in"}, 401
+
+    d = r.get_json(silent=True)
+    if not isinstance(d, dict):
+        return {"msg": "Malformed request"}, 400
+    if "step" in d:
+        if not isinstance(d["step"], int):
+            return {"msg": "Malformed request"}, 400
+        playback.move(sesh["username"], d["step"])
+        return queue_response(sesh["username"])
+    if not isinstance(d.get("position"), int) or not isinstance(
+        d.get("seconds"), (int, float)
+    ):
+        return {"msg": "Malformed request"}, 400
+    playback.save_seconds(sesh["username"], d["position"], d["seconds"])
+    return "", 204
+
+
+@app.route("/plays", methods=["POST"])
+def record_play():
+    """
+    Counts a play of {"music_id": ...} by the user, which the player sends once a track has played for a while. Buffered and written in batches (see plays.py), so most plays cost no database write.
+    """
+    if not check_logged_in(sesh):
+        return {"msg": "Not logged in"}, 401
+
+    d = r.get_json(silent=True)
+    if not isinstance(d, dict) or not isinstance(d.get("music_id"), str):
+        return {"msg": "Malformed request"}, 400
+    if not song_exists(d["music_id"]):
+        return {"msg": "No such song"}, 404
+    plays.log.record(sesh["username"], d["music_id"])
+    return "", 204
+
+
+def song_page(owner: str | None = None) -> dict:
+    """
+    Fetches the page of songs asked for in the query string (genre, year, sort, cursor and limit), and returns the template variables for it: the songs, and the URL of the next page if there is one.
+    """
+    filters = {k: r.args[k] for k in ("genre", "year", "sort", "limit") if k in r.args}
+    try:
+        songs, next_cursor = list_songs(
+            owner=owner,
+            genre=r.args.get("genre"),
+            year=r.args.get("year", type=int),
+            sort=r.args.get("sort", "name"),
+            cursor=r.args.get("cursor"),
+            limit=min(max(r.args.get("limit", 50, type=int), 1), 100),
+        )
+    except ValueError:
+        # Stale or tampered cursor, start from the first page
+        songs, next_cursor = list_songs(owner=owner, limit=50)
+    return {
+        "available_songs": songs,
+        "next_page": (
+            url_for(r.endpoint, cursor=next_cursor, **filters) if next_cursor else None
+        ),
+    }
+
+
+def with_plays(page: dict) -> dict:
+    # Adds how many times each song on the page has been played, as of the last rollup
+    page["plays"] = plays.log.totals(
+        [song.music_id for song in page["available_songs"]]
+    )
+    return page
+
+
+def song_list(template: str, version, context, owner: str | None = None):
+    """
+    The list of songs on a page, rendered with template and the variables context() returns, from pages.fragment_cache unless what it shows has changed since. version is the version of that (see pages.versions), or a tuple of them. owner is whose songs the list shows, the only thing besides the URL a list differs by between users.
+    """
+    return pages.fragment_cache.get_or_set(
+        (template, version, owner, r.full_path),
+        lambda: Markup(render_template(template, **context())),
+    )
+
+
+def conditional_page(version_names: tuple, render):
+    """
+    Returns render(versions), the page rendered for the current versions of the data it shows (see pages.versions), or 304 Not Modified without rendering anything if the client already has that page. The ETag covers the versions, who is asking, the URL and the templates. Pages with flashed messages waiting are always rendered, since those are shown only once.
+    """
+    versions = pages.versions(*version_names)
+    if "_flashes" in sesh:
+        response = make_response(render(versions))
+    else:
+        etag = pages.etag(
+            r.full_path, sesh.get("username"), versions, app.config["TEMPLATE_HASH"]
+        )
+        if r.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(render(versions))
+        response.set_etag(etag)
+    # Revalidated on every load, and never stored by shared caches since pages differ by user
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 @app.route("/player", methods=["GET", "POST"])
 def player():
     if check_logged_in(sesh, 1):
-        return render_template(
-            "player.html",
-            available_songs=get_available_songs(),
-            available_playlists=get_available_playlists(sesh["username"]),
+        return conditional_page(
+            ("catalogue", "playlists"),
+            lambda versions: render_template(
+                "player.html",
+                songs=song_list("fragments/player_songs.html", versions[0], song_page),
+                available_playlists=get_available_playlists(sesh["username"]),
+            ),
         )
 
     flash(
@@ -250,13 +738,19 @@ def player():
 @app.route("/creator", methods=["GET", "POST"])
 def creator():
     if check_logged_in(sesh, 2):
-        available_songs = list(
-            filter(
-                lambda song: song.owner == sesh["username"],
-                get_available_songs(),
+        owner = sesh["username"]
+        return conditional_page(
+            ("catalogue", "plays"),
+            lambda versions: render_template(
+                "creator.html",
+                songs=song_list(
+                    "fragments/creator_songs.html",
+                    versions,
+                    lambda: with_plays(song_page(owner=owner)),
+                    owner,
+                ),
             ),
         )
-        return render_template("creator.html", available_songs=available_songs)
     flash(
         "You are not allowed to access that page. Try logging in with a different account"
     )
@@ -278,7 +772,7 @@ def edit_song_details(music_id: str):
                 f.keys()
             ):
                 return {"msg": "Malformed request. Not all required keys present"}, 400
-            print(f["name"])
+            logger.debug("Updating song %s to %s", music_id, f["name"])
             if update_song_details_in_db(
                 music_id,
                 f["name"],
@@ -314,17 +808,25 @@ def delete_song(music_id: str):
 @app.route("/admin", methods=["GET", "POST"])
 def admin():
     if check_logged_in(sesh, 0):
-        num_songs = len(get_available_songs())
-        num_listeners = get_number_of_listeners()
-        num_creators = get_number_of_creators()
-        num_playlists = len(get_available_playlists(sesh["username"]))
-        return render_template(
-            "admin.html",
-            available_songs=get_available_songs(),
-            num_songs=num_songs,
-            num_listeners=num_listeners,
-            num_creators=num_creators,
-            num_playlists=num_playlists,
+        return conditional_page(
+            ("catalogue", "users", "playlists", "plays"),
+            lambda versions: render_template(
+                "admin.html",
+                songs=song_list(
+                    "fragments/admin_songs.html",
+                    (versions[0], versions[3]),
+                    lambda: with_plays(song_page()),
+                ),
+                num_songs=stats.number_of_songs(),
+                num_listeners=stats.number_of_listeners(),
+                num_creators=stats.number_of_creators(),
+                num_playlists=stats.number_of_playlists(),
+                songs_per_genre=stats.songs_per_genre(),
+                songs_per_year=stats.songs_per_year(),
+                uploads_per_creator=stats.uploads_per_creator(),
+                plays_per_day=stats.plays_per_day(),
+                most_played=stats.most_played(),
+            ),
         )
     flash(
         "You are not allowed to access that page. Try logging in with a different account"
@@ -342,24 +844,41 @@ def profile():
     return redirect("/logout")
 
 
-@app.route("/search", methods=["POST"])
-@app.route("/search?q=<query>", methods=["GET"])
-def search(query: str):
-    check_logged_in(sesh)
+@app.route("/search", methods=["GET", "POST"])
+def search():
+    if not check_logged_in(sesh):
+        flash(
+            "You are not allowed to access that page. Try logging in with a different account"
+        )
+        return redirect("/logout")
+
+    limit = min(max(r.args.get("limit", 50, type=int), 1), 100)
+    offset = max(r.args.get("offset", 0, type=int), 0)
+
     if r.method == "POST":
+        if "query" not in r.form:
+            return {"msg": "Malformed request"}, 400
         return jsonify(
             list(
                 map(
-                    lambda x: x.to_json(),
-                    filter(
-                        lambda song: song.search(r.form["query"]), get_available_songs()
-                    ),
+                    lambda x: x.to_json(song_listing_columns),
+                    search_songs(r.form["query"], limit, offset),
                 )
             )
         )
-    return render_template(
-        "player.html",
-        results=filter(lambda song: song.search(query), get_available_songs()),
+    return conditional_page(
+        ("catalogue", "playlists"),
+        lambda versions: render_template(
+            "player.html",
+            songs=song_list(
+                "fragments/player_songs.html",
+                versions[0],
+                lambda: {
+                    "available_songs": search_songs(r.args.get("q", ""), limit, offset)
+                },
+            ),
+            available_playlists=get_available_playlists(sesh["username"]),
+        ),
     )
 
 
@@ -383,4 +902,8 @@ debug = str(getenv("DEBUG")).casefold() in {
     "true",
 }
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=port, debug=debug)
+    from .migrate import migrate, seed
+
+    migrate()
+    seed()
+    create_app().run(host="0.0.0.0", port=port, debug=debug)
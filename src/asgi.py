@@ -0,0 +1,143 @@
+from asyncio import Event, Semaphore, create_task, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from io import BytesIO
+from os import getenv
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.http import parse_content_range_header
+from werkzeug.wsgi import FileWrapper
+
+from .app import create_app
+
+flask_app = create_app()
+
+# ASGI serving mode, for uvicorn (see asgi.py in the repository root). Every request is handled by the Flask app, through asgiref's WSGI adapter, so the responses are the ones the WSGI mode gives. The one difference is how /stream sends the file: once the Flask route has answered with the status and headers, the file is read in blocks on file_reads and each block sent when the client has taken the last one, so a listener downloading a song slowly costs a coroutine instead of a whole worker thread
+
+# Flask requests being handled at once. Each runs on a thread of its own (asgiref's ThreadSensitiveContext), rather than all on asgiref's one shared thread
+flask_slots = Semaphore(int(getenv("ASGI_WSGI_WORKERS", 16)))
+flask_calls = ThreadPoolExecutor(
+    max_workers=int(getenv("ASGI_WSGI_WORKERS", 16)), thread_name_prefix="asgi-wsgi"
+)
+file_reads = ThreadPoolExecutor(
+    max_workers=int(getenv("ASGI_FILE_WORKERS", 16)), thread_name_prefix="asgi-file"
+)
+
+stream_block_size = 1024 * 256
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] in {"GET", "HEAD"} and scope["path"].startswith("/stream/"):
+        return await stream(scope, receive, send)
+    async with flask_slots, ThreadSensitiveContext():
+        await wsgi_app(scope, receive, send)
+
+
+async def run(pool, fn, *args):
+    return await get_running_loop().run_in_executor(pool, copy_context().run, fn, *args)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for pool in (flask_calls, file_reads):
+                pool.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def call_flask(scope) -> tuple:
+    """
+    Runs a bodiless request through the Flask app, on flask_calls. Returns the status, the headers, the response body, and the file it sends if it is a file response (send_file), whose body is then left for the caller to send and close.
+    """
+    adapter = WsgiToAsgiInstance(flask_app)
+    # build_environ reads the headers from the instance's scope
+    adapter.scope = scope
+    environ = adapter.build_environ(scope, BytesIO())
+    opened = []
+
+    def file_wrapper(f, buffer_size: int = 8192):
+        opened.append(f)
+        return FileWrapper(f, buffer_size)
+
+    environ["wsgi.file_wrapper"] = file_wrapper
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [int(status.split(" ", 1)[0]), headers]
+
+    body = flask_app(environ, start_response)
+    if opened and response[0] in {200, 206} and scope["method"] == "GET":
+        return response[0], response[1], body, opened[0]
+    try:
+        return response[0], response[1], b"".join(body), None
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+async def stream(scope, receive, send):
+    """
+    /stream, with the status and headers of the Flask route, which is run to get them.
+    """
+    async with flask_slots:
+        status, headers, body, f = await run(flask_calls, call_flask, scope)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers
+            ],
+        }
+    )
+    if f is None:
+        return await send({"type": "http.response.body", "body": body})
+
+    try:
+        headers = dict((k.lower(), v) for k, v in headers)
+        start, remaining = 0, int(headers["content-length"])
+        if status == 206:
+            start = parse_content_range_header(headers["content-range"]).start
+        elif "http.response.pathsend" in scope.get("extensions", {}):
+            # The server can send the whole file itself, with sendfile(2) if it has it
+            return await send({"type": "http.response.pathsend", "path": f.name})
+
+        disconnected = Event()
+
+        async def watch_for_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = create_task(watch_for_disconnect())
+        try:
+            await run(file_reads, f.seek, start)
+            while remaining > 0 and not disconnected.is_set():
+                block = await run(file_reads, f.read, min(stream_block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                # Returns once the server has room for the block, so the pace is set by the client
+                await send(
+                    {"type": "http.response.body", "body": block, "more_body": True}
+                )
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            # The client went away mid send
+            pass
+        finally:
+            watcher.cancel()
+    finally:
+        # Closes the file too
+        await run(file_reads, body.close)
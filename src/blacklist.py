@@ -0,0 +1,97 @@
+from collections import deque
+from threading import Lock
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton over a set of terms. search() finds every term that occurs anywhere in a text in one pass over the text, however many terms there are. Matching is case insensitive.
+    """
+
+    def __init__(self, terms=()):
+        # Node 0 is the root. goto[node] maps a character to the next node, fail[node] is the node for the longest proper suffix that is also in the trie, own[node] is the term spelt by the path to node (if it is one), and out[node] every term that ends at node, through fail links included
+        self.goto = [{}]
+        self.fail = [0]
+        self.own = [None]
+        self.out = [()]
+        self.terms = set()
+        for term in terms:
+            self.insert(term)
+        self.build()
+
+    def insert(self, term: str) -> bool:
+        term = term.casefold()
+        if not term or term in self.terms:
+            return False
+        self.terms.add(term)
+        node = 0
+        for ch in term:
+            next_node = self.goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][ch] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.own.append(None)
+                self.out.append(())
+            node = next_node
+        self.own[node] = term
+        return True
+
+    def build(self):
+        # Breadth first, so a node's fail link is always computed before its children's
+        queue = deque()
+        for node in self.goto[0].values():
+            self.fail[node] = 0
+            self.out[node] = (self.own[node],) if self.own[node] else ()
+            queue.append(node)
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                self.fail[child] = fail
+                own = (self.own[child],) if self.own[child] else ()
+                self.out[child] = own + self.out[fail]
+                queue.append(child)
+
+    def search(self, text: str) -> set[str]:
+        if not self.terms:
+            return set()
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        node = 0
+        for ch in text.casefold():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class Blacklist:
+    """
+    Thread safe holder of the automaton for the blacklist table, so it is built once per worker rather than queried per upload.
+    """
+
+    def __init__(self):
+        self.automaton = Automaton()
+        # The version of the blacklist table (its counter, see database.create_tables) the automaton was built from, None until it is first loaded
+        self.version = None
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.automaton.terms)
+
+    def load(self, terms, version: int):
+        automaton = Automaton(terms)
+        with self.lock:
+            self.automaton = automaton
+            self.version = version
+
+    def search(self, *texts: str) -> set[str]:
+        # Fields are joined with a character no term can contain, so a match cannot span two fields
+        with self.lock:
+            return self.automaton.search("\0".join(map(str, texts)))
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from pickle import dumps, loads
+from threading import Lock
+from time import monotonic
+
+# Returned by get() when a key is not cached, since None is a value worth caching (e.g. "this user does not exist")
+MISSING = object()
+
+
+class LRUCache:
+    """
+    A bounded, thread safe cache local to this process. Holds at most maxsize entries, evicting the least recently used, and each entry expires ttl seconds after it was set. get_or_set caches a None from its loader for miss_ttl seconds instead, if given.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 4096,
+        ttl: float = 300,
+        miss_ttl: float | None = None,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.miss_ttl = ttl if miss_ttl is None else miss_ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return MISSING
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        with self.lock:
+            self.data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def size(self) -> int:
+        return len(self.data)
+
+    def get_or_set(self, key, loader):
+        # Read through: on a miss, loader() is called and its result cached
+        value = self.get(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value, self.miss_ttl if value is None else None)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self.size(),
+        }
+
+
+class RedisCache(LRUCache):
+    """
+    Same interface as LRUCache, but stored in a Redis compatible server, so every gunicorn worker sees the same entries and an invalidation in one worker applies to all of them. Eviction is left to the server's maxmemory policy. Hit and miss counts are per process.
+    """
+
+    def __init__(
+        self, name: str, url: str, ttl: float = 300, miss_ttl: float | None = None
+    ):
+        super().__init__(name, ttl=ttl, miss_ttl=miss_ttl)
+        self.redis = redis_client(url, "CACHE_URL")
+        self.prefix = f"music-app:{name}:"
+
+    def get(self, key):
+        data = self.redis.get(self.prefix + key)
+        if data is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return loads(data)
+
+    def set(self, key, value, ttl: float | None = None):
+        self.redis.set(
+            self.prefix + key,
+            dumps(value),
+            ex=max(1, round(self.ttl if ttl is None else ttl)),
+        )
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.redis.scan_iter(self.prefix + "*"):
+            self.redis.delete(key)
+
+    def size(self) -> int:
+        return sum(1 for _ in self.redis.scan_iter(self.prefix + "*"))
+
+
+def redis_client(url: str, setting: str):
+    # Imported here rather than at the top, so that processes without a Redis server configured never import the client
+    try:
+        from redis import Redis
+    except ImportError:
+        raise RuntimeError(
+            f"{setting} is set, but the redis package is not installed"
+        ) from None
+    return Redis.from_url(url)
+
+
+def make_cache(
+    name: str,
+    url: str | None,
+    maxsize: int = 4096,
+    ttl: float = 300,
+    miss_ttl: float | None = None,
+):
+    # A RedisCache when a server URL is configured, otherwise a per process LRUCache
+    if url:
+        return RedisCache(name, url, ttl, miss_ttl)
+    return LRUCache(name, maxsize, ttl, miss_ttl)
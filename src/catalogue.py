@@ -0,0 +1,392 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader, DictWriter
+from itertools import islice
+from json import JSONDecodeError, JSONDecoder, dumps, loads
+from logging import basicConfig, getLogger
+from os import getenv
+from os.path import exists, getsize, join
+from sys import stdin, stdout
+from time import perf_counter
+
+from werkzeug.utils import secure_filename
+
+from . import database, metrics, storage
+from .database import blacklist, blacklisted_terms, song_cache, song_columns
+from .miscellaneous import guess_audio_mimetype
+
+logger = getLogger(__name__)
+
+# Bulk import and export of the song catalogue, as JSON Lines, CSV or a JSON array:
+#     python -m src.catalogue import songs.jsonl --audio-dir /mnt/audio --link
+#     python -m src.catalogue export songs.csv
+# Files are read and written a row at a time, so a catalogue of any size takes the same memory. Imported rows are validated, then inserted batch_size at a time with one executemany in one transaction per batch, and their audio files (named by music_id in --audio-dir) are hashed and copied or hard linked into the audio store (see storage.py) on a thread pool
+
+# Rows are read from files by these names too, for files written before the column was called owner
+aliases = {"added_by": "owner"}
+
+
+class RowError(ValueError):
+    pass
+
+
+class Unparsable(str):
+    # A JSON Lines row that is not JSON, as the line it was read from. validate() rejects it with error, like any other bad row, instead of the whole import stopping part way
+    def __new__(cls, line: str, error: str):
+        row = super().__new__(cls, line.rstrip("\r\n"))
+        row.error = error
+        return row
+
+
+def detect_format(path: str) -> str:
+    for suffix, format in [(".jsonl", "jsonl"), (".ndjson", "jsonl"), (".csv", "csv")]:
+        if path.endswith(suffix):
+            return format
+    return "json"
+
+
+def read_json_array(f, chunk_size: int = 1 << 16):
+    """
+    Yields the items of a JSON array one at a time, reading f chunk_size characters at a time instead of loading the whole document.
+    """
+    decoder = JSONDecoder()
+    buffer, eof, started = "", False, False
+    while True:
+        buffer = buffer.lstrip()
+        if not started and buffer:
+            if buffer[0] != "[":
+                raise ValueError("Expected a JSON array")
+            buffer, started = buffer[1:], True
+            continue
+        if started:
+            buffer = buffer.lstrip(", \t\r\n")
+            if buffer.startswith("]"):
+                return
+            if buffer:
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    # Most likely the item goes on into the next chunk
+                    if eof:
+                        raise
+                else:
+                    yield item
+                    buffer = buffer[end:]
+                    continue
+        if eof:
+            raise ValueError("Unexpected end of the JSON array")
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+
+def read_rows(f, format: str):
+    # Yields (line or item number, dict) for each row of f
+    if format == "jsonl":
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield number, loads(line)
+                except JSONDecodeError as e:
+                    yield number, Unparsable(line, f"Not valid JSON: {e}")
+    elif format == "csv":
+        # Line 1 is the header
+        yield from enumerate(DictReader(f), 2)
+    else:
+        yield from enumerate(read_json_array(f), 1)
+
+
+def validate(row, owners: dict) -> tuple:
+    """
+    The row as a tuple for the music table, or RowError saying what is wrong with it. owners caches which usernames are creators or admins, since a catalogue has far fewer owners than songs. Call blacklisted_terms() before a batch of these, to pick up terms other workers have added.
+    """
+    if isinstance(row, Unparsable):
+        raise RowError(row.error)
+    if not isinstance(row, dict):
+        raise RowError("Not an object")
+    row = {aliases.get(key, key): value for key, value in row.items()}
+    missing = [column for column in song_columns if column not in row]
+    if missing:
+        raise RowError(f"Missing {', '.join(missing)}")
+
+    values = []
+    for column in song_columns:
+        value = row[column]
+        if column == "year":
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise RowError(f"year {value!r} is not a number")
+            if not 1000 <= value <= 9999:
+                raise RowError(f"year {value} is out of range")
+        elif not isinstance(value, str):
+            raise RowError(f"{column} is not text")
+        elif column != "lyrics" and not value.strip():
+            raise RowError(f"{column} is empty")
+        values.append(value)
+
+    music_id, owner = values[0], values[-1]
+    if secure_filename(music_id) != music_id:
+        raise RowError(f"music_id {music_id!r} is not a safe file name")
+    if owner not in owners:
+        user = database.fetch_user_details(owner)
+        owners[owner] = bool(user) and user[3] in {0, 2}
+    if not owners[owner]:
+        raise RowError(f"owner {owner!r} is not a creator")
+    if terms := blacklist.search(*values[1:4], values[6]):
+        raise RowError(f"Blacklisted: {', '.join(sorted(terms))}")
+    return tuple(values)
+
+
+def upsert_sql(mode: str) -> str:
+    sql = f"INSERT INTO music ({', '.join(song_columns)}) VALUES ({','.join('?' * len(song_columns))}) ON CONFLICT (music_id) DO "
+    if mode == "skip":
+        return sql + "NOTHING"
+    return (
+        sql
+        + "UPDATE SET "
+        + ", ".join(f"{column}=excluded.{column}" for column in song_columns[1:])
+    )
+
+
+def import_catalogue(
+    f,
+    format: str = "jsonl",
+    mode: str = "upsert",
+    batch_size: int = 5000,
+    audio_dir: str | None = None,
+    hard_link: bool = False,
+    workers: int = 8,
+    rejects=None,
+) -> dict:
+    """
+    Imports the songs in f. mode "upsert" replaces songs that exist, "skip" leaves them as they are. With audio_dir, every song's file audio_dir/<music_id> is stored first (see storage.py), and songs whose file cannot be are rejected. Rejected rows are written to rejects (if given) as JSON Lines with the reason. Returns counts and timings.
+    """
+    sql = upsert_sql(mode)
+    owners = {}
+    counts = {"read": 0, "imported": 0, "unchanged": 0, "rejected": 0}
+    started = perf_counter()
+    rows = read_rows(f, format)
+
+    def reject(number, row, error: str):
+        counts["rejected"] += 1
+        if counts["rejected"] <= 10:
+            logger.warning("Row %d rejected: %s", number, error)
+        if rejects is not None:
+            rejects.write(dumps({"row": number, "error": error, "data": row}) + "\n")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while batch := list(islice(rows, batch_size)):
+            counts["read"] += len(batch)
+            blacklisted_terms()
+            valid = []
+            for number, row in batch:
+                try:
+                    valid.append((number, row, validate(row, owners)))
+                except RowError as e:
+                    reject(number, row, str(e))
+
+            placed = {}
+            if audio_dir is not None:
+                if mode == "skip":
+                    # Songs that exist are left as they are, their audio included
+                    existing = {
+                        song.music_id
+                        for song in database.fetch_songs(
+                            [values[0] for _, _, values in valid], ("music_id",)
+                        )
+                    }
+                    music_ids = [
+                        values[0] for _, _, values in valid if values[0] not in existing
+                    ]
+                else:
+                    music_ids = [values[0] for _, _, values in valid]
+                # Once per music_id, so two rows for one song do not store its file twice
+                music_ids = list(dict.fromkeys(music_ids))
+                placed = dict(
+                    zip(
+                        music_ids,
+                        pool.map(
+                            lambda music_id: import_audio(
+                                music_id, audio_dir, hard_link
+                            ),
+                            music_ids,
+                        ),
+                    )
+                )
+                kept = []
+                for number, row, values in valid:
+                    if isinstance(placed.get(values[0]), str):
+                        reject(number, row, placed[values[0]])
+                    else:
+                        kept.append((number, row, values))
+                valid = kept
+                placed = {
+                    music_id: stored
+                    for music_id, stored in placed.items()
+                    if not isinstance(stored, str)
+                }
+
+            with database.db.transaction() as con, metrics.QuerySpan(sql):
+                # Rows skipped in skip mode are not counted as changes
+                changed = con.executemany(
+                    sql, [values for _, _, values in valid]
+                ).rowcount
+                if placed:
+                    con.executemany(
+                        storage.media_upsert_sql,
+                        [
+                            (music_id, size, digest, mimetype, None, None)
+                            for music_id, (digest, mimetype, size, _) in placed.items()
+                        ],
+                    )
+                    # A file stored above but deleted since, by the last song using it being deleted, is stored again. Checked under the write lock, so it cannot be deleted again before this commits
+                    sources = {
+                        digest: source for digest, _, _, source in placed.values()
+                    }
+                    for digest, source in sources.items():
+                        if not storage.store.exists(digest):
+                            storage.store.put(source, digest, "copy")
+                    # The files of songs whose audio was replaced, if nothing else uses them
+                    storage.release_unreferenced(con)
+            for _, _, values in valid:
+                song_cache.delete(values[0])
+            counts["imported"] += changed
+            counts["unchanged"] += len(valid) - changed
+
+    seconds = perf_counter() - started
+    return counts | {
+        "seconds": seconds,
+        "rows_per_second": counts["read"] / seconds if seconds else 0,
+    }
+
+
+def import_audio(music_id: str, audio_dir: str, hard_link: bool) -> tuple | str:
+    # Stores the song's file from audio_dir. Returns (sha256, mimetype, size, source), or why it could not be stored
+    source = join(audio_dir, music_id)
+    if not exists(source):
+        return f"No audio file {source}"
+    try:
+        digest = storage.hash_file(source)
+        mimetype = guess_audio_mimetype(source)
+        storage.store.put(source, digest, "link" if hard_link else "copy", mimetype)
+    except OSError as e:
+        return f"Could not store audio file: {e}"
+    return digest, mimetype, getsize(source), source
+
+
+def export_catalogue(
+    f,
+    format: str = "jsonl",
+    batch_size: int = 5000,
+    audio_dir: str | None = None,
+    hard_link: bool = False,
+    workers: int = 8,
+) -> dict:
+    """
+    Writes every song to f, batch_size rows per query in rowid order (so the database is never asked for the whole table at once). With audio_dir, their audio files are copied (or hard linked) there too.
+    """
+    started = perf_counter()
+    count, last = 0, 0
+    if format == "csv":
+        writer = DictWriter(f, song_columns)
+        writer.writeheader()
+    elif format == "json":
+        f.write("[")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while rows := database.db.query(
+            f"""SELECT music.rowid, {', '.join(f'music.{c}' for c in song_columns)}, song_media.sha256 FROM music
+                LEFT JOIN song_media ON song_media.music_id = music.music_id
+                WHERE music.rowid>? ORDER BY music.rowid LIMIT ?
+            """,
+            (last, batch_size),
+        ):
+            last = rows[-1][0]
+            for row in rows:
+                song = dict(zip(song_columns, row[1:-1]))
+                if format == "csv":
+                    writer.writerow(song)
+                elif format == "json":
+                    f.write(("," if count else "") + "\n" + dumps(song))
+                else:
+                    f.write(dumps(song) + "\n")
+                count += 1
+            if audio_dir is not None:
+                # list() so that a failure is raised here
+                list(
+                    pool.map(
+                        lambda row: storage.store.get(
+                            row[-1], join(audio_dir, row[1]), hard_link
+                        ),
+                        [row for row in rows if row[-1] is not None],
+                    )
+                )
+
+    if format == "json":
+        f.write("\n]\n")
+    seconds = perf_counter() - started
+    return {
+        "exported": count,
+        "seconds": seconds,
+        "rows_per_second": count / seconds if seconds else 0,
+    }
+
+
+def main():
+    basicConfig(
+        level=getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    parser = ArgumentParser(prog="python -m src.catalogue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ["import", "export"]:
+        command = commands.add_parser(name)
+        command.add_argument("path", help="- for stdin or stdout")
+        command.add_argument("--format", choices=["jsonl", "csv", "json"])
+        command.add_argument("--batch-size", type=int, default=5000)
+        command.add_argument(
+            "--audio-dir", help="Where audio files named by music_id are"
+        )
+        command.add_argument(
+            "--link", action="store_true", help="Hard link audio files, not copy"
+        )
+        command.add_argument("--workers", type=int, default=8)
+    commands.choices["import"].add_argument(
+        "--mode", choices=["upsert", "skip"], default="upsert"
+    )
+    commands.choices["import"].add_argument(
+        "--rejects", help="Write rejected rows here, as JSON Lines"
+    )
+    args = parser.parse_args()
+
+    format = args.format or detect_format(args.path)
+    options = {
+        "format": format,
+        "batch_size": args.batch_size,
+        "audio_dir": args.audio_dir,
+        "hard_link": args.link,
+        "workers": args.workers,
+    }
+    if args.command == "import":
+        f = stdin if args.path == "-" else open(args.path, newline="")
+        rejects = open(args.rejects, "w") if args.rejects else None
+        try:
+            result = import_catalogue(f, mode=args.mode, rejects=rejects, **options)
+        finally:
+            if f is not stdin:
+                f.close()
+            if rejects is not None:
+                rejects.close()
+    else:
+        f = stdout if args.path == "-" else open(args.path, "w", newline="")
+        try:
+            result = export_catalogue(f, **options)
+        finally:
+            if f is not stdout:
+                f.close()
+    logger.info("%s", dumps(result))
+
+
+if __name__ == "__main__":
+    main()
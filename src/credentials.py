@@ -0,0 +1,103 @@
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import pbkdf2_hmac, scrypt
+from hmac import compare_digest
+from os import cpu_count, getenv, urandom
+
+from .miscellaneous import hasher
+
+# Password hashes are stored as "scheme$parameters$salt$hash", so the scheme and its cost can change without invalidating stored hashes: a hash made with older settings still verifies, and is replaced at the next login (see needs_rehash). Hashes from before this module are bare uppercase SHA-256 hex, and are migrated the same way
+
+scheme = getenv("PASSWORD_SCHEME", "scrypt")
+# scrypt uses 128 * n * r bytes of memory per hash, 16MB with these
+scrypt_n = int(getenv("SCRYPT_N", 2**14))
+scrypt_r = int(getenv("SCRYPT_R", 8))
+scrypt_p = int(getenv("SCRYPT_P", 1))
+pbkdf2_iterations = int(getenv("PBKDF2_ITERATIONS", 600_000))
+salt_size = 16
+
+# Hashing is meant to be slow, and hashlib releases the GIL while it runs. Running it on a small pool caps how many cores a burst of logins can take, so the other requests keep getting served
+hashing = ThreadPoolExecutor(
+    max_workers=int(getenv("HASH_WORKERS", max(1, (cpu_count() or 2) // 2))),
+    thread_name_prefix="hashing",
+)
+
+
+def b64(data: bytes) -> str:
+    return b64encode(data).decode("ascii").rstrip("=")
+
+
+def unb64(text: str) -> bytes:
+    return b64decode(text + "=" * (-len(text) % 4))
+
+
+def derive(password: str, salt: bytes, scheme: str, parameters: tuple) -> bytes:
+    if scheme == "scrypt":
+        n, r, p = parameters
+        return scrypt(
+            password.encode("utf-8"),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * r * (n + p),
+            dklen=32,
+        )
+    if scheme == "pbkdf2_sha256":
+        (iterations,) = parameters
+        return pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    raise ValueError(f"Unknown password scheme {scheme}")
+
+
+def current_parameters() -> tuple:
+    if scheme == "scrypt":
+        return (scrypt_n, scrypt_r, scrypt_p)
+    return (pbkdf2_iterations,)
+
+
+def hash_password(password: str) -> str:
+    parameters = current_parameters()
+    salt = urandom(salt_size)
+    return "$".join(
+        [
+            scheme,
+            ",".join(map(str, parameters)),
+            b64(salt),
+            b64(derive(password, salt, scheme, parameters)),
+        ]
+    )
+
+
+def parse(stored: str) -> tuple | None:
+    # (scheme, parameters, salt, hash) of a stored hash, or None for a legacy SHA-256 one
+    if "$" not in stored:
+        return None
+    stored_scheme, parameters, salt, digest = stored.split("$")
+    return (
+        stored_scheme,
+        tuple(map(int, parameters.split(","))),
+        unb64(salt),
+        unb64(digest),
+    )
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    Checks password against a stored hash of any scheme this module has used, in constant time.
+    """
+    parsed = parse(stored)
+    if parsed is None:
+        return compare_digest(hasher(password), stored)
+    stored_scheme, parameters, salt, digest = parsed
+    return compare_digest(derive(password, salt, stored_scheme, parameters), digest)
+
+
+def on_hashing_pool(fn, *args):
+    # Runs hash_password or verify_password on the hashing pool and waits for it. The caller's thread is held meanwhile, but at most HASH_WORKERS of them are hashing at once
+    return hashing.submit(fn, *args).result()
+
+
+def needs_rehash(stored: str) -> bool:
+    # True for legacy hashes, and for hashes made with a different scheme or cost than the current one
+    parsed = parse(stored)
+    return parsed is None or parsed[0] != scheme or parsed[1] != current_parameters()
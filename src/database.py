@@ -1,146 +1,464 @@
-from json import load
-from os import remove
-from os.path import dirname, splitext
+from contextlib import contextmanager
+from functools import cache
+from itertools import islice
+from logging import getLogger
+from os import getenv, register_at_fork, remove
+from os.path import exists, splitext
+from queue import Empty, Queue
+from re import findall
 from sqlite3 import connect
+from threading import Lock, local
+from weakref import WeakSet
 
-from .miscellaneous import hasher
+from . import credentials, metrics
+from .blacklist import Blacklist
+from .cache import make_cache
+from .miscellaneous import decode_cursor, encode_cursor, guess_audio_mimetype
+
+logger = getLogger(__name__)
 
 primary_keys = {
     "users": "username",
     "music": "music_id",
     "playlists": "playlist_id",
     "blacklist": "text",
+    "uploads": "upload_id",
+    "jobs": "job_id",
+    "song_media": "music_id",
+    "audio_analysis": "sha256",
+    "playback_state": "username",
+}
+
+song_columns = (
+    "music_id",
+    "name",
+    "artist",
+    "album",
+    "genre",
+    "year",
+    "lyrics",
+    "owner",
+)
+# Everything but the lyrics, which can be long and are only needed for the song that is playing
+song_listing_columns = tuple(c for c in song_columns if c != "lyrics")
+
+music_listing_sql = ", ".join(f"music.{column}" for column in song_listing_columns)
+
+# Columns songs can be listed by. Every key is paired with music_id in the ORDER BY, so that the order is total and a page can be resumed from the last row of the previous page
+song_sort_keys = {
+    "name": "name",
+    "artist": "artist",
+    "album": "album",
+    "year": "year",
 }
 
 
+# Built from the blacklist table on first use, see blacklisted_terms
+blacklist = Blacklist()
+
+# Read through caches for the rows looked up on every login and every play. Set CACHE_URL (e.g. redis://localhost:6379/0) to share them between workers, so that an invalidation in one worker is seen by all of them
+# A user or song that does not exist is only cached for CACHE_MISS_TTL seconds: without CACHE_URL, a signup or upload only invalidates the cache of the worker that handled it, and the others would go on saying it does not exist
+song_cache = make_cache(
+    "songs",
+    getenv("CACHE_URL"),
+    ttl=float(getenv("CACHE_TTL", 300)),
+    miss_ttl=float(getenv("CACHE_MISS_TTL", 5)),
+)
+user_cache = make_cache(
+    "users",
+    getenv("CACHE_URL"),
+    ttl=float(getenv("CACHE_TTL", 300)),
+    miss_ttl=float(getenv("CACHE_MISS_TTL", 5)),
+)
+
+
+# SQL text is built once per table and projection. sqlite3 caches compiled statements per connection keyed by their text, so identical text means the statement is only prepared once per connection
+@cache
+def select_sql(table: str, columns: tuple | None = None, by_key: bool = False) -> str:
+    sql = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+    return f"{sql} WHERE {primary_keys[table]}=?" if by_key else sql
+
+
+@cache
+def insert_sql(table: str, count: int) -> str:
+    return f"INSERT INTO {table} VALUES ({','.join('?' * count)})"
+
+
+# Every SqliteWrapper in this process, for forget_connections
+wrappers = WeakSet()
+
+
 class SqliteWrapper:
-    def __init__(self, path):
-        self.db = connect(path, check_same_thread=False)
+    """
+    A small pool of SQLite connections. Every thread checks out its own connection for the duration of a call (or a transaction), so threaded workers do not serialize on one shared connection. Connections are opened lazily, in WAL mode, so readers are never blocked by a writer.
+
+    Statements outside transaction() run in autocommit mode. Use transaction() to group several statements into one atomic commit.
+
+    Safe to create before a fork (gunicorn --preload): the child starts with an empty pool, see forget_connections.
+    """
+
+    def __init__(
+        self,
+        path,
+        pool_size: int = 8,
+        timeout: float = 30,
+        cached_statements: int = 256,
+    ):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = Queue()
+        self.opened = 0
+        self.lock = Lock()
+        self.local = local()
+        self.inherited = []
+        wrappers.add(self)
+
+    def forget_connections(self):
+        # SQLite connections must not be used, or even closed, across a fork: the child would share the parent's file locks and WAL index. So a child keeps the ones it inherited open and untouched until it exits, and opens its own
+        self.inherited.append((self.pool, getattr(self.local, "con", None)))
+        self.pool = Queue()
+        self.opened = 0
+        self.lock = Lock()
+        self.local = local()
+
+    def connect(self):
+        con = connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=self.timeout,
+            cached_statements=self.cached_statements,
+        )
+        con.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints. A power cut can lose the last few commits, but never corrupts the database
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA mmap_size=268435456")
+        con.execute("PRAGMA cache_size=-16000")
+        con.execute("PRAGMA temp_store=MEMORY")
+        return con
+
+    def checkout(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.opened < self.pool_size:
+                self.opened += 1
+                return self.connect()
+        return self.pool.get(timeout=self.timeout)
+
+    @contextmanager
+    def connection(self):
+        # Re-entrant, so that calls made inside a transaction() use the connection that the transaction is on
+        con = getattr(self.local, "con", None)
+        if con is not None:
+            yield con
+            return
+
+        con = self.checkout()
+        self.local.con = con
+        try:
+            yield con
+        finally:
+            self.local.con = None
+            if con.in_transaction:
+                con.rollback()
+            self.pool.put(con)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as con:
+            if con.in_transaction:
+                # Nested, the outermost transaction commits
+                yield con
+                return
+            # IMMEDIATE takes the write lock up front, so two transactions cannot both read and then deadlock upgrading to write
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.rollback()
+                raise
+            con.commit()
+
+    def stats(self) -> dict:
+        return {"open": self.opened, "idle": self.pool.qsize()}
+
+    def close(self):
+        # Closes the idle connections. Connections checked out right now are closed when they come back
+        with self.lock:
+            while True:
+                try:
+                    self.pool.get_nowait().close()
+                except Empty:
+                    break
+                self.opened -= 1
 
     def execute(self, query, *params):
-        cur = self.db.cursor()
-        cur.execute(query, *params)
-        self.db.commit()
+        with self.connection() as con, metrics.QuerySpan(query):
+            con.execute(query, *params)
 
     def insert(self, table, *params):
-        self.execute(
-            f"INSERT INTO {table} VALUES ({('?,'*len(*params)).strip(", ")})", *params
-        )
+        self.execute(insert_sql(table, len(*params)), *params)
 
-    def fetchone(self, table, *params):
-        cur = self.db.cursor()
-        res = cur.execute(
-            f"SELECT * FROM {table} WHERE {primary_keys[table]}=?", *params
-        )
-        data = res.fetchone()
-        cur.close()
-        return data
+    def insert_many(self, table, rows, batch_size: int = 10000) -> int:
+        """
+        Inserts an iterable of rows with executemany, batch_size rows per transaction. Returns the number of rows inserted.
+        """
+        count = 0
+        rows = iter(rows)
+        while batch := list(islice(rows, batch_size)):
+            sql = insert_sql(table, len(batch[0]))
+            with self.transaction() as con, metrics.QuerySpan(sql):
+                con.executemany(sql, batch)
+            count += len(batch)
+        return count
+
+    def fetchone(self, table, *params, columns: tuple | None = None):
+        sql = select_sql(table, columns, True)
+        with self.connection() as con, metrics.QuerySpan(sql):
+            return con.execute(sql, *params).fetchone()
+
+    def fetchall(self, table, columns: tuple | None = None):
+        sql = select_sql(table, columns)
+        with self.connection() as con, metrics.QuerySpan(sql):
+            return con.execute(sql).fetchall()
 
-    def fetchall(self, table):
-        cur = self.db.cursor()
-        res = cur.execute(f"SELECT * FROM {table}")
-        data = res.fetchall()
-        cur.close()
-        return data
+    def query(self, query, *params):
+        with self.connection() as con, metrics.QuerySpan(query):
+            return con.execute(query, *params).fetchall()
 
     def exists(self, table, key) -> bool:
         return self.fetchone(table, (key,)) != None
 
-    def like(self, table: str, key: str) -> bool:
-        cur = self.db.cursor()
-        res = cur.execute(
-            f"SELECT * FROM {table} WHERE {primary_keys[table]} LIKE '%{str(key).casefold()}%'",
-        )
-        data = res.fetchall()
-        cur.close()
-        return bool(data)
-
     def insert_if_not_exists(self, table, key, *params):
-        if not self.exists(table, key):
-            self.insert(table, (key,) + params)
-            return True
-        return False
+        with self.transaction():
+            if not self.exists(table, key):
+                self.insert(table, (key,) + params)
+                return True
+            return False
+
+
+def forget_connections():
+    for wrapper in list(wrappers):
+        wrapper.forget_connections()
+
+
+register_at_fork(after_in_child=forget_connections)
+
+
+def fetch_user_row(username: str) -> tuple | None:
+    # Cached until create_user invalidates it. Users that do not exist only for CACHE_MISS_TTL seconds, since another worker may have just created them
+    return user_cache.get_or_set(username, lambda: db.fetchone("users", (username,)))
 
 
 def check_user_exists(username: str) -> bool:
-    return bool(db.fetchone("users", (username,)))
+    return bool(fetch_user_row(username))
 
 
 def fetch_user_details(username: str) -> list:
-    row = db.fetchone("users", (username,))
+    row = fetch_user_row(username)
     return row if row else []
 
 
+def check_credentials(row: tuple, entered_password: str) -> bool:
+    """
+    Verifies a password against a row from fetch_user_row, so a login reads the user once. A correct password whose hash was made with an older scheme or cost is rehashed with the current one.
+    """
+    stored = row[1]
+    if not credentials.on_hashing_pool(
+        credentials.verify_password, entered_password, stored
+    ):
+        return False
+    if credentials.needs_rehash(stored):
+        db.execute(
+            "UPDATE users SET password=? WHERE username=? AND password=?",
+            (
+                credentials.on_hashing_pool(
+                    credentials.hash_password, entered_password
+                ),
+                row[0],
+                stored,
+            ),
+        )
+        user_cache.delete(row[0])
+    return True
+
+
 def check_password(username: str, entered_password: str) -> bool:
-    row = db.fetchone("users", (username,))
-    return hasher(entered_password) == row[1] if row else False
+    row = fetch_user_row(username)
+    return check_credentials(row, entered_password) if row else False
 
 
 def create_user(username: str, password: str, name: str, type: int) -> bool:
-    return db.insert_if_not_exists("users", username, hasher(password), name, type)
+    created = db.insert_if_not_exists(
+        "users",
+        username,
+        credentials.on_hashing_pool(credentials.hash_password, password),
+        name,
+        type,
+    )
+    user_cache.delete(username)
+    return created
 
 
 def add_to_blacklist(text: str) -> bool:
+    # The insert bumps the blacklist's version, so the next check reloads the automaton with it
     return db.insert_if_not_exists("blacklist", text)
 
 
+def blacklisted_terms(*texts: str) -> set[str]:
+    """
+    Returns the blacklisted terms that occur in any of the texts. The automaton is reloaded when any worker has changed the blacklist since it was built.
+    """
+    # Read before the terms, so a term added while they are read makes the next call load them again rather than be missed
+    rows = db.query("SELECT value FROM counters WHERE name = 'version:blacklist'")
+    version = rows[0][0] if rows else 0
+    if version != blacklist.version:
+        blacklist.load(map(lambda x: x[0], db.fetchall("blacklist")), version)
+    return blacklist.search(*texts)
+
+
+def scan_catalogue_for_blacklisted(batch_size: int = 1000) -> dict[str, set[str]]:
+    """
+    Scans every song (name, artist, album and lyrics) against the blacklist, a batch at a time, and returns the offending music_ids with the terms they matched.
+    """
+    blacklisted_terms()
+    flagged = {}
+    last = 0
+    while rows := db.query(
+        "SELECT rowid, music_id, name, artist, album, lyrics FROM music WHERE rowid > ? ORDER BY rowid LIMIT ?",
+        (last, batch_size),
+    ):
+        for rowid, music_id, *texts in rows:
+            if terms := blacklist.search(*texts):
+                flagged[music_id] = terms
+        last = rows[-1][0]
+    return flagged
+
+
+@cache
+def row_order(columns: tuple) -> tuple:
+    # For each of song_columns, its index in columns, or None if it was not selected
+    return tuple(
+        columns.index(column) if column in columns else None for column in song_columns
+    )
+
+
 class Song:
-    def __init__(self, db_row: list):
-        self.music_id = db_row[0]
-        self.name = db_row[1]
-        self.artist = db_row[2]
-        self.album = db_row[3]
-        self.genre = db_row[4]
-        self.year = db_row[5]
-        self.lyrics = db_row[6]
-        self.owner = db_row[7]
-        self.search_data = [
-            self.music_id.casefold(),
-            self.name.casefold(),
-            self.artist.casefold(),
-            self.album.casefold(),
-            self.genre.casefold(),
-            str(self.year),
-        ]
+    # Slots instead of a __dict__ per song, since listings build one Song per row
+    __slots__ = song_columns
+
+    def __init__(self, db_row: list, columns: tuple = song_columns):
+        # columns is the order of the values in db_row. Columns that were not selected are None
+        if columns is not song_columns:
+            db_row = [db_row[i] if i is not None else None for i in row_order(columns)]
+        (
+            self.music_id,
+            self.name,
+            self.artist,
+            self.album,
+            self.genre,
+            self.year,
+            self.lyrics,
+            self.owner,
+        ) = db_row
 
     def search(self, query: str) -> bool:
+        # Substring match, for small lists of songs already in memory. Use search_songs for the catalogue
         q = query.casefold().strip()
-        for data in self.search_data:
-            if q in data:
+        for data in (
+            self.music_id,
+            self.name,
+            self.artist,
+            self.album,
+            self.genre,
+            str(self.year),
+        ):
+            if q in data.casefold():
                 return True
         return False
 
-    def to_json(self) -> dict:
-        return self.__dict__
+    def to_json(self, columns: tuple = song_columns) -> dict:
+        return {column: getattr(self, column) for column in columns}
 
     def __str__(self) -> str:
-        return self.__dict__.__str__()
+        return self.to_json().__str__()
 
     def __repr__(self) -> str:
         return self.__str__()
 
 
 class Playlist:
-    def __init__(self, db_row: list):
+    def __init__(self, db_row: list, music_ids: list[str] | None = None):
+        # db_row[3] is the legacy comma separated music_ids column, tracks now live in playlist_tracks
         self.playlist_id = db_row[0]
         self.name = db_row[1]
         self.owner = db_row[2]
-        self.music_ids = db_row[3].split(",")
+        self.music_ids = music_ids if music_ids is not None else []
         self.privacy = db_row[4]
-        self.music = list(
-            map(lambda x: Song(db.fetchone("music", (x,))), self.music_ids)
+        self._music = None
+
+    @property
+    def music(self) -> list[Song]:
+        # Songs are only materialized when something asks for them, since pages listing playlists only need the track count
+        if self._music is None:
+            load_playlist_music([self])
+        return self._music
+
+
+def load_playlist_music(playlists: list[Playlist], batch_size: int = 500):
+    """
+    Fetches the songs of all the given playlists with one query per batch_size playlists (instead of one query per track), and sets them on each playlist in playlist order.
+    """
+    by_id = {playlist.playlist_id: playlist for playlist in playlists}
+    for playlist in playlists:
+        playlist._music = []
+
+    ids = list(by_id)
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i : i + batch_size]
+        rows = db.query(
+            f"""SELECT playlist_tracks.playlist_id, {music_listing_sql} FROM playlist_tracks
+                JOIN music ON music.music_id = playlist_tracks.music_id
+                WHERE playlist_tracks.playlist_id IN ({",".join("?" * len(batch))})
+                ORDER BY playlist_tracks.playlist_id, playlist_tracks.position
+            """,
+            batch,
         )
+        for row in rows:
+            by_id[row[0]]._music.append(Song(row[1:], song_listing_columns))
+        metrics.constructed("Song", len(rows))
 
 
 def add_song_to_db(song: Song, music_file) -> bool:
-    # Add to database and save mp4 into the static/audio folder, with the music_id.mp4 as the file name
+    # Add to database and store the file (see storage.py), hashing it as it is written
     # Also check if it exists in blacklist
+    from . import storage
 
-    if db.like("blacklist", song.name) or db.like("blacklist", song.artist):
+    if blacklisted_terms(song.name, song.artist, song.album, song.lyrics):
         return False
-    music_file.save(dirname(__file__) + f"/../static/audio/{song.music_id}")
-    print(f"Saved file {song.music_id}")
-    return db.insert_if_not_exists(
+    path, digest = storage.receive(music_file.stream)
+    try:
+        with db.transaction() as con:
+            if not insert_song(song):
+                return False
+            storage.add_media(
+                con, song.music_id, path, digest, guess_audio_mimetype(path)
+            )
+    finally:
+        if exists(path):
+            remove(path)
+    logger.info("Saved file %s as %s", song.music_id, digest)
+    return True
+
+
+def insert_song(song: Song) -> bool:
+    # Add the row for a song, without its file
+    inserted = db.insert_if_not_exists(
         "music",
         song.music_id,
         song.name,
@@ -151,56 +469,192 @@ def add_song_to_db(song: Song, music_file) -> bool:
         song.lyrics,
         song.owner,
     )
+    song_cache.delete(song.music_id)
+    return inserted
 
 
 def delete_song_from_db(music_id: str) -> bool:
-    # Delete song from the database and from the static/audio folder
+    # Delete song from the database, and its file if no other song uses it
+    from . import storage
+
     try:
-        if db.exists("music", music_id):
-            remove(dirname(__file__) + f"/../static/audio/{music_id}")
+        with db.transaction() as con:
+            if not db.exists("music", music_id):
+                return False
             db.execute("DELETE FROM music WHERE music_id=?", (music_id,))
-            return True
-    except Exception as e:
-        print(e)
+            db.execute("DELETE FROM song_media WHERE music_id=?", (music_id,))
+            # If the file cannot be removed, the rows are rolled back with it
+            storage.release_unreferenced(con)
+        # Invalidated after the commit, so that no other request can cache the old row again in between
+        song_cache.delete(music_id)
+        return True
+    except Exception:
+        logger.exception("Could not delete song %s", music_id)
     return False
 
 
+def songs_from_rows(rows: list, columns: tuple = song_listing_columns) -> list[Song]:
+    # Counted per list rather than in Song.__init__, which would cost more than building the Song does
+    songs = [Song(row, columns) for row in rows]
+    metrics.constructed("Song", len(songs))
+    return songs
+
+
 def get_available_songs() -> list[Song]:
-    return list(map(lambda x: Song(x), db.fetchall("music")))
+    return songs_from_rows(db.fetchall("music", song_listing_columns))
+
+
+def list_songs(
+    owner: str | None = None,
+    genre: str | None = None,
+    year: int | None = None,
+    sort: str = "name",
+    cursor: str | None = None,
+    limit: int = 50,
+    columns: tuple = song_listing_columns,
+) -> tuple[list[Song], str | None]:
+    """
+    Returns one page of songs, filtered and sorted in SQL, along with the cursor for the next page (None on the last page). columns must include music_id and the sort key.
+
+    Pages are keyset paginated: instead of an OFFSET, the cursor holds the sort key and music_id of the last song shown, and the next page starts right after it. Every page is an index range scan, however deep into the catalogue it is.
+    """
+    column = song_sort_keys.get(sort, "name")
+    conditions, params = [], []
+
+    if owner is not None:
+        conditions.append("owner=?")
+        params.append(owner)
+    if genre is not None:
+        conditions.append("genre=?")
+        params.append(genre)
+    if year is not None:
+        conditions.append("year=?")
+        params.append(year)
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if len(after) != 2:
+            raise ValueError("Malformed cursor")
+        conditions.append(f"({column}, music_id) > (?, ?)")
+        params.extend(after)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = db.query(
+        f"{select_sql('music', columns)} {where} ORDER BY {column}, music_id LIMIT ?",
+        (*params, limit + 1),
+    )
+
+    songs = songs_from_rows(rows[:limit], columns)
+    if len(rows) <= limit:
+        return songs, None
+    last = songs[-1]
+    return songs, encode_cursor([getattr(last, column), last.music_id])
+
+
+def fts_query(query: str) -> str:
+    """
+    Converts free text typed by the user into an FTS5 MATCH expression. Every word is quoted (so FTS5 operators typed by the user are treated as text) and prefix matched, so that "arij sin" finds "Arijit Singh".
+    """
+    return " ".join(f'"{word}"*' for word in findall(r"\w+", query.casefold()))
+
+
+def search_songs(
+    query: str, limit: int = 50, offset: int = 0, columns: tuple = song_listing_columns
+) -> list[Song]:
+    # Search the music_fts index, best matches first. Matches in the name weigh more than matches in the artist, album, etc.
+    match = fts_query(query)
+    if not match:
+        return []
+    return songs_from_rows(
+        db.query(
+            f"""SELECT {", ".join(f"music.{column}" for column in columns)} FROM music_fts
+                JOIN music ON music.rowid = music_fts.rowid
+                WHERE music_fts MATCH ?
+                ORDER BY bm25(music_fts, 1.0, 10.0, 5.0, 3.0, 2.0, 1.0)
+                LIMIT ? OFFSET ?
+            """,
+            (match, limit, offset),
+        ),
+        columns,
+    )
 
 
 def get_available_playlists(username: str) -> list[Playlist]:
-    '''
-    Fetch all playlists that have a privacy of 0 or if have been created by the user
-    ""CREATE TABLE IF NOT EXISTS playlists
-               (
-                    playlist_id VARCHAR(20) PRIMARY KEY NOT NULL,
-                    name VARCHAR(20) NOT NULL,
-                    owner VARCHAR(20) NOT NULL,
-                    music_ids VARCHAR(20) NOT NULL,
-                    privacy INT NOT NULL DEFAULT 0,
-                    FOREIGN KEY (owner) REFERENCES users(username)
-               )
     """
-    '''
+    Fetch all playlists that have a privacy of 0 or have been created by the user, or every playlist for an admin. Takes two queries however many playlists and tracks there are: one for the playlists and one for the music_ids of all of them. The songs themselves are loaded lazily, see Playlist.music.
+    """
     # Check if admin, user_type 0
     if fetch_user_details(username)[3] == 0:
-        return list(map(lambda x: Playlist(x), db.fetchall("playlists")))
-
-    return list(
-        map(
-            lambda x: Playlist(x),
-            filter(
-                lambda x: x[4] == 0 or x[2] == username,
-                db.fetchall("playlists"),
-            ),
-        )
+        condition, params = "", ()
+    else:
+        condition, params = "WHERE privacy=0 OR owner=?", (username,)
+
+    playlists = db.query(f"SELECT * FROM playlists {condition}", params)
+    music_ids = {playlist[0]: [] for playlist in playlists}
+    for playlist_id, music_id in db.query(
+        f"""SELECT playlist_tracks.playlist_id, playlist_tracks.music_id FROM playlist_tracks
+            JOIN playlists ON playlists.playlist_id = playlist_tracks.playlist_id
+            {condition}
+            ORDER BY playlist_tracks.playlist_id, playlist_tracks.position
+        """,
+        params,
+    ):
+        music_ids[playlist_id].append(music_id)
+
+    metrics.constructed("Playlist", len(playlists))
+    return list(map(lambda x: Playlist(x, music_ids[x[0]]), playlists))
+
+
+def migrate_playlist_tracks():
+    """
+    One time migration of playlists from the old comma separated music_ids column into playlist_tracks. The column is emptied once a playlist has been copied, so running this again does nothing.
+    """
+    with db.transaction():
+        for playlist_id, music_ids in db.query(
+            "SELECT playlist_id, music_ids FROM playlists WHERE music_ids != ''"
+        ):
+            for position, music_id in enumerate(filter(None, music_ids.split(","))):
+                db.execute(
+                    "INSERT OR IGNORE INTO playlist_tracks VALUES (?,?,?)",
+                    (playlist_id, position, music_id.strip()),
+                )
+            db.execute(
+                "UPDATE playlists SET music_ids='' WHERE playlist_id=?", (playlist_id,)
+            )
+
+
+def song_exists(music_id: str) -> bool:
+    return (
+        song_cache.get_or_set(music_id, lambda: db.fetchone("music", (music_id,)))
+        is not None
     )
 
 
 def fetch_song_details_from_db(music_id: str) -> Song:
-    # Fetch song details from the db and return it as a Song object
-    return Song(db.fetchone("music", (music_id,)))
+    # Fetch song details from the cache or the db and return it as a Song object
+    metrics.constructed("Song")
+    return Song(
+        song_cache.get_or_set(music_id, lambda: db.fetchone("music", (music_id,)))
+    )
+
+
+def fetch_songs(
+    music_ids: list[str], columns: tuple = song_listing_columns, batch_size: int = 500
+) -> list[Song]:
+    """
+    Looks up many songs at once, with one query per batch_size music_ids, selecting only columns (which must include music_id). Returns them in the order they were asked for, leaving out the ones that do not exist.
+    """
+    by_id = {}
+    for i in range(0, len(music_ids), batch_size):
+        batch = music_ids[i : i + batch_size]
+        for song in songs_from_rows(
+            db.query(
+                f"{select_sql('music', columns)} WHERE music_id IN ({','.join('?' * len(batch))})",
+                batch,
+            ),
+            columns,
+        ):
+            by_id[song.music_id] = song
+    return [by_id[music_id] for music_id in music_ids if music_id in by_id]
 
 
 def update_song_details_in_db(music_id: str, *params) -> bool:
@@ -209,20 +663,19 @@ def update_song_details_in_db(music_id: str, *params) -> bool:
         "UPDATE music SET name=?, artist=?, album=?, genre=?, year=?, lyrics=? WHERE music_id=?",
         params + (music_id,),
     )
+    song_cache.delete(music_id)
     return True
 
 
-def get_number_of_listeners() -> int:
-    return len(list(filter(lambda x: x[3] == 1, db.fetchall("users"))))
-
+def cache_stats() -> list[dict]:
+    return [song_cache.stats(), user_cache.stats()]
 
-def get_number_of_creators() -> int:
-    return len(list(filter(lambda x: x[3] == 2, db.fetchall("users"))))
 
+def pool_stats() -> dict:
+    return db.stats()
 
-if __name__ in {"database", "src.database", "__main__"}:
-    db = SqliteWrapper("music-app.db")
 
+def create_tables():
     # user_type 0 = admin; 1 = user; 2 = creator
     db.execute(
         """CREATE TABLE IF NOT EXISTS users
@@ -257,13 +710,178 @@ if __name__ in {"database", "src.database", "__main__"}:
                     playlist_id VARCHAR(20) PRIMARY KEY NOT NULL,
                     name VARCHAR(20) NOT NULL,
                     owner VARCHAR(20) NOT NULL,
-                    music_ids VARCHAR(20) NOT NULL,-- Comma separated list of music_ids
+                    music_ids VARCHAR(20) NOT NULL,-- Legacy comma separated list of music_ids, emptied by migrate_playlist_tracks
                     privacy INT NOT NULL DEFAULT 0,
                     FOREIGN KEY (owner) REFERENCES users(username)
                )
     """
     )
 
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS playlist_tracks
+            (
+                playlist_id VARCHAR(20) NOT NULL,
+                position INT NOT NULL,
+                music_id VARCHAR(20) NOT NULL,
+                PRIMARY KEY (playlist_id, position),
+                FOREIGN KEY (playlist_id) REFERENCES playlists(playlist_id),
+                FOREIGN KEY (music_id) REFERENCES music(music_id)
+            )
+        """
+    )
+
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS playlist_tracks_music_id ON playlist_tracks (music_id)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS playlists_owner ON playlists (owner)")
+    db.execute("CREATE INDEX IF NOT EXISTS playlists_privacy ON playlists (privacy)")
+
+    # Chunked uploads in progress, see uploads.py. received is how many bytes of size have been written to the partial file
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS uploads
+            (
+                upload_id VARCHAR(36) PRIMARY KEY NOT NULL,
+                owner VARCHAR(20) NOT NULL,
+                size INT NOT NULL,
+                received INT NOT NULL DEFAULT 0,
+                sha256 VARCHAR(64),
+                created_at INT NOT NULL,
+                FOREIGN KEY (owner) REFERENCES users(username)
+            )
+        """
+    )
+
+    # Background jobs. status is one of queued, running, done or failed, and result is JSON
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS jobs
+            (
+                job_id VARCHAR(36) PRIMARY KEY NOT NULL,
+                kind VARCHAR(20) NOT NULL,
+                owner VARCHAR(20) NOT NULL,
+                status VARCHAR(10) NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at INT NOT NULL,
+                updated_at INT NOT NULL
+            )
+        """
+    )
+
+    # What is known about a song's audio file, filled in when an upload is processed
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS song_media
+            (
+                music_id VARCHAR(20) PRIMARY KEY NOT NULL,
+                size INT NOT NULL,
+                sha256 VARCHAR(64) NOT NULL,
+                mimetype VARCHAR(40) NOT NULL,
+                duration REAL,
+                bitrate INT,
+                FOREIGN KEY (music_id) REFERENCES music(music_id)
+            )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS song_media_sha256 ON song_media (sha256)")
+
+    # How many songs use each stored audio file, see storage.py. Kept by the triggers below, and a file is deleted when its count reaches 0
+    blobs_exist = bool(
+        db.query(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='audio_blobs'"
+        )
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS audio_blobs
+            (
+                sha256 VARCHAR(64) PRIMARY KEY NOT NULL,
+                size INT NOT NULL,
+                refcount INT NOT NULL
+            )
+        """
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS audio_blobs_unreferenced ON audio_blobs (sha256) WHERE refcount <= 0"
+    )
+    reference = "INSERT INTO audio_blobs VALUES (new.sha256, new.size, 1) ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1;"
+    dereference = (
+        "UPDATE audio_blobs SET refcount = refcount - 1 WHERE sha256 = old.sha256;"
+    )
+    db.execute(
+        f"CREATE TRIGGER IF NOT EXISTS song_media_reference AFTER INSERT ON song_media BEGIN {reference} END"
+    )
+    db.execute(
+        f"CREATE TRIGGER IF NOT EXISTS song_media_dereference AFTER DELETE ON song_media BEGIN {dereference} END"
+    )
+    db.execute(
+        f"CREATE TRIGGER IF NOT EXISTS song_media_rereference AFTER UPDATE OF sha256 ON song_media WHEN old.sha256 != new.sha256 BEGIN {dereference}{reference} END"
+    )
+    if not blobs_exist:
+        # Count the songs uploaded before the table was
+        db.execute(
+            "INSERT INTO audio_blobs SELECT sha256, MAX(size), COUNT(*) FROM song_media GROUP BY sha256"
+        )
+
+    # What the ingest stage (analysis.py) works out from each stored file's audio. peaks is one byte per slice of the track
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS audio_analysis
+            (
+                sha256 VARCHAR(64) PRIMARY KEY NOT NULL,
+                duration REAL NOT NULL,
+                loudness REAL,
+                peaks BLOB NOT NULL,
+                analysed_at INT NOT NULL,
+                FOREIGN KEY (sha256) REFERENCES audio_blobs(sha256)
+            )
+        """
+    )
+    # The fingerprint index: every landmark hash of every file, and the frame it starts at. Looked up by hash, so finding a file's near duplicates costs an index lookup per hash whatever the size of the catalogue
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS fingerprints
+            (
+                hash INT NOT NULL,
+                sha256 VARCHAR(64) NOT NULL,
+                frame INT NOT NULL,
+                FOREIGN KEY (sha256) REFERENCES audio_blobs(sha256)
+            )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS fingerprints_sha256 ON fingerprints (sha256)"
+    )
+    db.execute(
+        """CREATE TRIGGER IF NOT EXISTS audio_blobs_delete AFTER DELETE ON audio_blobs
+            BEGIN
+                DELETE FROM audio_analysis WHERE sha256 = old.sha256;
+                DELETE FROM fingerprints WHERE sha256 = old.sha256;
+            END
+        """
+    )
+
+    # Each user's play queue and where they are in it, see playback.py
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS play_queue
+            (
+                username VARCHAR(20) NOT NULL,
+                position INT NOT NULL,
+                music_id VARCHAR(20) NOT NULL,
+                PRIMARY KEY (username, position),
+                FOREIGN KEY (username) REFERENCES users(username),
+                FOREIGN KEY (music_id) REFERENCES music(music_id)
+            )
+        """
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS playback_state
+            (
+                username VARCHAR(20) PRIMARY KEY NOT NULL,
+                position INT NOT NULL,
+                seconds REAL NOT NULL DEFAULT 0,
+                updated_at INT NOT NULL,
+                FOREIGN KEY (username) REFERENCES users(username)
+            )
+        """
+    )
+
     db.execute(
         f"""CREATE TABLE IF NOT EXISTS blacklist
         (
@@ -272,24 +890,149 @@ if __name__ in {"database", "src.database", "__main__"}:
         """
     )
 
-    create_user("admin", "admin", "Admin", 0)  # Admin
-    create_user("user", "user", "Vishal N", 1)  # Normal user
-    create_user("creator", "creator", "Arijit Singh", 2)  # Creator user
-
-    with open("data.json", "r") as f:
-        data = load(f)
-        for song in data:
-            db.insert_if_not_exists(
-                "music",
-                song["music_id"],
-                song["name"],
-                song["artist"],
-                song["album"],
-                song["genre"],
-                song["year"],
-                song["lyrics"],
-                song["added_by"],
+    # Indexes for list_songs. One per sort key, and one per filter for the default sort by name
+    for columns in [
+        "name, music_id",
+        "artist, music_id",
+        "album, music_id",
+        "year, music_id",
+        "owner, name, music_id",
+        "genre, name, music_id",
+        "year, name, music_id",
+    ]:
+        db.execute(
+            f"CREATE INDEX IF NOT EXISTS music_{columns.replace(', ', '_')} ON music ({columns})"
+        )
+
+    # Full text index over the searchable columns of music. It is an external content table, so the text is not stored twice, and the triggers below keep it in sync with every INSERT, UPDATE and DELETE on music
+    fts_exists = bool(
+        db.query(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='music_fts'"
+        )
+    )
+    db.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS music_fts USING fts5
+            (
+                music_id, name, artist, album, genre, year,
+                content='music',
+                content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
             )
+        """
+    )
+
+    db.execute(
+        """CREATE TRIGGER IF NOT EXISTS music_fts_insert AFTER INSERT ON music
+            BEGIN
+                INSERT INTO music_fts (rowid, music_id, name, artist, album, genre, year)
+                VALUES (new.rowid, new.music_id, new.name, new.artist, new.album, new.genre, new.year);
+            END
+        """
+    )
+
+    db.execute(
+        """CREATE TRIGGER IF NOT EXISTS music_fts_delete AFTER DELETE ON music
+            BEGIN
+                INSERT INTO music_fts (music_fts, rowid, music_id, name, artist, album, genre, year)
+                VALUES ('delete', old.rowid, old.music_id, old.name, old.artist, old.album, old.genre, old.year);
+            END
+        """
+    )
+
+    db.execute(
+        """CREATE TRIGGER IF NOT EXISTS music_fts_update AFTER UPDATE ON music
+            BEGIN
+                INSERT INTO music_fts (music_fts, rowid, music_id, name, artist, album, genre, year)
+                VALUES ('delete', old.rowid, old.music_id, old.name, old.artist, old.album, old.genre, old.year);
+                INSERT INTO music_fts (rowid, music_id, name, artist, album, genre, year)
+                VALUES (new.rowid, new.music_id, new.name, new.artist, new.album, new.genre, new.year);
+            END
+        """
+    )
+
+    if not fts_exists:
+        # Index songs that were added before the index existed
+        db.execute("INSERT INTO music_fts (music_fts) VALUES ('rebuild')")
+
+    db.execute("CREATE INDEX IF NOT EXISTS users_user_type ON users (user_type)")
+
+    # Row counts for the admin dashboard (see stats.py). Triggers keep them up to date on every write, so reading one is a primary key lookup instead of a COUNT(*) over the table
+    counters_exist = bool(
+        db.query(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='counters'"
+        )
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS counters
+            (
+                name VARCHAR(40) PRIMARY KEY NOT NULL,
+                value INT NOT NULL DEFAULT 0
+            )
+        """
+    )
+
+    # For each table, the counters a row counts towards ({row} is new or old in the triggers), and the columns those depend on
+    counted = {
+        "music": (
+            [
+                "'songs'",
+                "'genre:' || {row}.genre",
+                "'year:' || {row}.year",
+                "'owner:' || {row}.owner",
+            ],
+            "genre, year, owner",
+        ),
+        "users": (["'users:' || {row}.user_type"], "user_type"),
+        "playlists": (["'playlists'"], None),
+    }
+    for table, (keys, columns) in counted.items():
+
+        def bump(row: str, delta: int) -> str:
+            return "".join(
+                f"INSERT INTO counters VALUES ({key.format(row=row)}, {delta}) ON CONFLICT (name) DO UPDATE SET value = value + {delta};"
+                for key in keys
+            )
+
+        db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table} BEGIN {bump('new', 1)} END"
+        )
+        db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table} BEGIN {bump('old', -1)} END"
+        )
+        if columns:
+            db.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_count_update AFTER UPDATE OF {columns} ON {table} BEGIN {bump('old', -1)}{bump('new', 1)} END"
+            )
+        if not counters_exist:
+            # Count the rows that were there before the counters were
+            for key in keys:
+                db.execute(
+                    f"INSERT INTO counters SELECT {key.format(row=table)}, COUNT(*) FROM {table} GROUP BY 1"
+                )
+
+    # Versions of the data pages show, bumped by every write to it (see pages.py). Unlike the counters above they only ever go up, so one version never stands for two different states of the data
+    for table, version, events in [
+        ("music", "catalogue", ["INSERT", "DELETE", "UPDATE"]),
+        ("playlists", "playlists", ["INSERT", "DELETE", "UPDATE"]),
+        ("playlist_tracks", "playlists", ["INSERT", "DELETE", "UPDATE"]),
+        # Not on password changes, which no page shows
+        ("users", "users", ["INSERT", "DELETE", "UPDATE OF name, user_type"]),
+        # Not shown on pages, but tells each worker when to rebuild its blacklist automaton (see blacklisted_terms)
+        ("blacklist", "blacklist", ["INSERT", "DELETE", "UPDATE"]),
+    ]:
+        for event in events:
+            db.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{event.split()[0].lower()} AFTER {event} ON {table}
+                    BEGIN
+                        INSERT INTO counters VALUES ('version:{version}', 1) ON CONFLICT (name) DO UPDATE SET value = value + 1;
+                    END
+                """
+            )
+
 
-    # print(db.fetchall("users"))
-    # print(db.fetchall("music"))
+# Connections are opened on first use, so importing this module does no I/O. The tables are created and the sample data added by python -m src.migrate, once per deploy, not by every worker (see migrate.py)
+db = SqliteWrapper(
+    getenv("DATABASE_PATH", "music-app.db"),
+    pool_size=int(getenv("DB_POOL_SIZE", 8)),
+)
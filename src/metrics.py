@@ -0,0 +1,424 @@
+from collections import Counter
+from contextvars import ContextVar
+from logging import getLogger
+from os import getpid
+from sys import _current_frames
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+logger = getLogger(__name__)
+
+# Request timing and hot path counters, kept per process. Each gunicorn worker reports its own numbers, so scrape every worker (or add up what they each report) to see the whole server
+
+# Upper bounds of the histogram buckets
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+query_count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Statements past this many distinct SQL texts are counted under "other", so the label set stays bounded
+max_statements = 200
+
+# The span of the request being handled, in this thread or task
+current = ContextVar("span", default=None)
+lock = Lock()
+
+
+class Span:
+    """
+    Where one request spent its time: database statements (how many, how long and which), template rendering, and objects constructed.
+    """
+
+    __slots__ = (
+        "endpoint",
+        "method",
+        "start",
+        "status",
+        "queries",
+        "query_seconds",
+        "statements",
+        "render_start",
+        "render_seconds",
+        "templates",
+        "objects",
+    )
+
+    def __init__(self, endpoint: str, method: str):
+        self.endpoint = endpoint
+        self.method = method
+        self.start = perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.query_seconds = 0.0
+        # SQL text: [times run, seconds]
+        self.statements = {}
+        self.render_start = None
+        self.render_seconds = 0.0
+        self.templates = {}
+        self.objects = Counter()
+
+
+class Histogram:
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.sum += value
+
+
+# Totals since the process started, keyed by their labels
+requests = Counter()
+request_durations = {}
+queries_per_request = {}
+query_totals = {}
+statements = {}
+renders = {}
+objects = Counter()
+
+
+class QuerySpan:
+    """
+    Times one statement run by SqliteWrapper:
+        with QuerySpan(sql):
+            con.execute(sql, params)
+    """
+
+    __slots__ = ("sql", "start")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.start
+        span = current.get()
+        if span is None:
+            # Outside a request, e.g. a background job. Straight into the totals
+            with lock:
+                add_statement(self.sql, 1, seconds)
+            return
+        span.queries += 1
+        span.query_seconds += seconds
+        entry = span.statements.get(self.sql)
+        if entry is None:
+            span.statements[self.sql] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def add_statement(sql: str, count: int, seconds: float):
+    if sql not in statements and len(statements) >= max_statements:
+        sql = "other"
+    entry = statements.setdefault(sql, [0, 0.0])
+    entry[0] += count
+    entry[1] += seconds
+
+
+def constructed(kind: str, n: int = 1):
+    # Counts objects built for the current request, e.g. Song rows
+    span = current.get()
+    if span is not None:
+        span.objects[kind] += n
+    else:
+        with lock:
+            objects[kind] += n
+
+
+def start_request(endpoint: str, method: str) -> Span:
+    span = Span(endpoint, method)
+    current.set(span)
+    return span
+
+
+def start_render():
+    span = current.get()
+    if span is not None:
+        span.render_start = perf_counter()
+
+
+def finish_render(template: str):
+    span = current.get()
+    if span is not None and span.render_start is not None:
+        seconds = perf_counter() - span.render_start
+        span.render_start = None
+        span.render_seconds += seconds
+        entry = span.templates.setdefault(template, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def finish_request(span: Span, slow_seconds: float, repeated_queries: int) -> float:
+    """
+    Adds the request's span to the totals, and logs it if it was slow or ran one statement many times over (the N+1 pattern). Returns how long the request took.
+    """
+    seconds = perf_counter() - span.start
+    current.set(None)
+    with lock:
+        requests[(span.endpoint, span.method, span.status)] += 1
+        request_durations.setdefault(
+            span.endpoint, Histogram(duration_buckets)
+        ).observe(seconds)
+        queries_per_request.setdefault(
+            span.endpoint, Histogram(query_count_buckets)
+        ).observe(span.queries)
+        totals = query_totals.setdefault(span.endpoint, [0, 0.0])
+        totals[0] += span.queries
+        totals[1] += span.query_seconds
+        for sql, (count, query_seconds) in span.statements.items():
+            add_statement(sql, count, query_seconds)
+        for template, (count, render_seconds) in span.templates.items():
+            entry = renders.setdefault(template, [0, 0.0])
+            entry[0] += count
+            entry[1] += render_seconds
+        objects.update(span.objects)
+
+    repeated = [
+        (count, sql)
+        for sql, (count, _) in span.statements.items()
+        if count >= repeated_queries
+    ]
+    if seconds >= slow_seconds or repeated:
+        logger.warning(
+            "%s %s took %.1fms: %d queries in %.1fms, rendering %.1fms, built %s%s",
+            span.method,
+            span.endpoint,
+            seconds * 1000,
+            span.queries,
+            span.query_seconds * 1000,
+            span.render_seconds * 1000,
+            dict(span.objects) or "nothing",
+            "".join(
+                f"\n  ran {count} times: {' '.join(sql.split())}"
+                for count, sql in sorted(repeated, reverse=True)
+            ),
+        )
+    return seconds
+
+
+def server_timing(span: Span) -> str:
+    # For the Server-Timing response header, which browser developer tools show alongside the request
+    return ", ".join(
+        [
+            f'db;dur={span.query_seconds * 1000:.2f};desc="{span.queries} queries"',
+            f"render;dur={span.render_seconds * 1000:.2f}",
+            f"total;dur={(perf_counter() - span.start) * 1000:.2f}",
+        ]
+    )
+
+
+def label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**kwargs) -> str:
+    return "{" + ",".join(f'{k}="{label(v)}"' for k, v in kwargs.items()) + "}"
+
+
+def histogram_lines(name: str, histograms: dict, key: str) -> list[str]:
+    lines = []
+    for value, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append(
+                f"{name}_bucket{labels(**{key: value, 'le': bound})} {cumulative}"
+            )
+        lines.append(f"{name}_sum{labels(**{key: value})} {histogram.sum}")
+        lines.append(f"{name}_count{labels(**{key: value})} {cumulative}")
+    return lines
+
+
+def render(caches: list[dict], pool: dict, plays: dict) -> str:
+    """
+    Every metric in the Prometheus text exposition format. caches is database.cache_stats(), pool the open and idle connections of the database pool, plays the stats of this worker's PlayLog.
+    """
+    out = []
+
+    def metric(name: str, kind: str, help: str, lines: list[str]):
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(lines)
+
+    with lock:
+        metric(
+            "http_requests_total",
+            "counter",
+            "Requests handled, by endpoint, method and status",
+            [
+                f"http_requests_total{labels(endpoint=e, method=m, status=s)} {n}"
+                for (e, m, s), n in sorted(requests.items())
+            ],
+        )
+        metric(
+            "http_request_duration_seconds",
+            "histogram",
+            "Time to handle a request, by endpoint",
+            histogram_lines(
+                "http_request_duration_seconds", request_durations, "endpoint"
+            ),
+        )
+        metric(
+            "db_queries_per_request",
+            "histogram",
+            "Statements run per request, by endpoint. A high count on a simple page is usually an N+1 pattern",
+            histogram_lines("db_queries_per_request", queries_per_request, "endpoint"),
+        )
+        metric(
+            "db_query_seconds_total",
+            "counter",
+            "Time spent running statements, by endpoint",
+            [
+                f"db_query_seconds_total{labels(endpoint=e)} {s}"
+                for e, (_, s) in sorted(query_totals.items())
+            ],
+        )
+        metric(
+            "db_statement_calls_total",
+            "counter",
+            "Times each SQL statement was run",
+            [
+                f"db_statement_calls_total{labels(sql=' '.join(sql.split()))} {n}"
+                for sql, (n, _) in sorted(statements.items())
+            ],
+        )
+        metric(
+            "db_statement_seconds_total",
+            "counter",
+            "Time spent running each SQL statement",
+            [
+                f"db_statement_seconds_total{labels(sql=' '.join(sql.split()))} {s}"
+                for sql, (_, s) in sorted(statements.items())
+            ],
+        )
+        metric(
+            "template_renders_total",
+            "counter",
+            "Templates rendered",
+            [
+                f"template_renders_total{labels(template=t)} {n}"
+                for t, (n, _) in sorted(renders.items())
+            ],
+        )
+        metric(
+            "template_render_seconds_total",
+            "counter",
+            "Time spent rendering each template",
+            [
+                f"template_render_seconds_total{labels(template=t)} {s}"
+                for t, (_, s) in sorted(renders.items())
+            ],
+        )
+        metric(
+            "objects_constructed_total",
+            "counter",
+            "Objects built from database rows, by type",
+            [
+                f"objects_constructed_total{labels(type=k)} {n}"
+                for k, n in sorted(objects.items())
+            ],
+        )
+
+    for name, kind, help, key in [
+        ("cache_hits_total", "counter", "Cache lookups that hit", "hits"),
+        ("cache_misses_total", "counter", "Cache lookups that missed", "misses"),
+        ("cache_entries", "gauge", "Entries in the cache", "size"),
+    ]:
+        metric(
+            name,
+            kind,
+            help,
+            [f"{name}{labels(cache=c['name'])} {c[key]}" for c in caches],
+        )
+    metric(
+        "db_pool_connections",
+        "gauge",
+        "Connections in the database pool, open and idle",
+        [f"db_pool_connections{labels(state=k)} {v}" for k, v in pool.items()],
+    )
+    for name, kind, help, key in [
+        ("plays_buffered", "gauge", "Plays waiting to be written", "buffered"),
+        ("plays_written_total", "counter", "Plays written", "written"),
+        (
+            "plays_write_failures_total",
+            "counter",
+            "Writes of plays that failed",
+            "failures",
+        ),
+        (
+            "plays_dropped_total",
+            "counter",
+            "Plays dropped because writes kept failing and the buffer was full",
+            "dropped",
+        ),
+    ]:
+        metric(name, kind, help, [f"{name} {plays[key]}"])
+    metric("process_id", "gauge", "Process these numbers are from", [str(getpid())])
+    return "\n".join(out) + "\n"
+
+
+class Profiler:
+    """
+    Samples the stack of every thread every interval seconds, while it is running. dump() returns the samples in the collapsed stack format that flamegraph.pl and speedscope read. Off unless started, since sampling costs a little of every request.
+    """
+
+    def __init__(self, max_stacks: int = 10000):
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.stop_event = Event()
+        self.thread = None
+        self.lock = Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval: float = 0.01):
+        with self.lock:
+            if self.running:
+                return
+            self.stop_event.clear()
+            self.thread = Thread(
+                target=self.sample, args=(interval,), name="profiler", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample(self, interval: float):
+        me = get_ident()
+        while not self.stop_event.wait(interval):
+            for thread_id, frame in _current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                with self.lock:
+                    if key in self.stacks or len(self.stacks) < self.max_stacks:
+                        self.stacks[key] += 1
+
+    def dump(self, clear: bool = False) -> str:
+        with self.lock:
+            lines = [f"{stack} {n}" for stack, n in self.stacks.most_common()]
+            if clear:
+                self.stacks.clear()
+        return "\n".join(lines) + "\n"
+
+
+profiler = Profiler()
@@ -0,0 +1,71 @@
+from argparse import ArgumentParser
+from logging import basicConfig, getLogger
+from os import getenv
+from os.path import isdir
+
+from dotenv import load_dotenv
+
+from . import database, plays, sessions, storage
+from .catalogue import import_catalogue
+from .database import SqliteWrapper, check_user_exists, create_user
+
+logger = getLogger(__name__)
+
+# Creates the tables of every database the app uses and brings old ones up to date, then adds the sample users and songs. Run once per deploy, before the workers start:
+#     python -m src.migrate
+# Workers never do any of this themselves, so importing the app does no I/O and a worker boots without waiting on the write lock or reading data.json. Every step is safe to run again: tables and indexes are only created if they do not exist, migrations only touch rows still in the old shape, and sample rows that are there already are skipped
+
+sample_users = [
+    ("admin", "admin", "Admin", 0),
+    ("user", "user", "Vishal N", 1),
+    ("creator", "creator", "Arijit Singh", 2),
+]
+
+
+def migrate():
+    with database.db.transaction():
+        database.create_tables()
+    database.migrate_playlist_tracks()
+    with plays.log.db.transaction():
+        plays.create_tables(plays.log.db)
+    if not getenv("SESSION_URL"):
+        sessions.create_tables(
+            SqliteWrapper(getenv("SESSION_DATABASE_PATH", "sessions.db"))
+        )
+
+
+def seed(catalogue: str = "data.json"):
+    """
+    Adds the sample users and the songs in catalogue, with their audio from data/, and stores any files left in static/audio by versions that stored them by music_id.
+    """
+    for username, password, name, user_type in sample_users:
+        # Checked first, so running this again does not hash the passwords for nothing
+        if not check_user_exists(username):
+            create_user(username, password, name, user_type)
+    with open(catalogue, "r") as f:
+        import_catalogue(f, "json", mode="skip")
+    storage.adopt("data", "link")
+    if isdir(storage.default_folder):
+        storage.adopt(storage.default_folder)
+
+
+def main():
+    load_dotenv()
+    basicConfig(
+        level=getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    parser = ArgumentParser(prog="python -m src.migrate")
+    parser.add_argument(
+        "--no-seed", action="store_true", help="Do not add the sample users and songs"
+    )
+    args = parser.parse_args()
+
+    migrate()
+    logger.info("Databases are up to date")
+    if not args.no_seed:
+        seed()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,57 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha256
+from json import dumps, loads
+
+# Leading bytes of the audio formats accepted by upload_song. Audio files are stored by hash without an extension (see storage.py), so this is how the Content-Type the streaming route sends is worked out when a file is stored
+audio_signatures = [
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"\xff\xfb", "audio/mpeg"),
+    (0, b"\xff\xf3", "audio/mpeg"),
+    (0, b"\xff\xf2", "audio/mpeg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"RIFF", "audio/wav"),
+    (0, b"\xff\xf1", "audio/aac"),
+    (0, b"\xff\xf9", "audio/aac"),
+    (0, b"0&\xb2u\x8ef\xcf\x11", "audio/x-ms-wma"),
+    (4, b"ftyp", "audio/mp4"),
+]
+
+
 def hasher(text: str) -> str:
     """
-    Takes a UTF-8 encoded piece of text of any length, and returns the SHA-256 hash of the text as a string object, in uppercase.
+    Takes a UTF-8 encoded piece of text of any length, and returns the SHA-256 hash of the text as a string object, in uppercase. Unsalted, so only used to check password hashes from before credentials.py
     """
-    from hashlib import sha256
-
     return sha256(bytes(text, "utf-8")).hexdigest().upper()
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Packs the sort key values of the last row on a page into an opaque, URL safe string that can be handed back to fetch the next page.
+    """
+    return urlsafe_b64encode(dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Inverse of encode_cursor. Raises ValueError if the cursor has been tampered with.
+    """
+    try:
+        values = loads(urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("Malformed cursor")
+    return values
+
+
+def guess_audio_mimetype(path: str) -> str:
+    """
+    Guesses the MIME type of an audio file from its first few bytes. Falls back to application/octet-stream, and lets the browser sniff it.
+    """
+    with open(path, "rb") as f:
+        head = f.read(16)
+    for offset, signature, mimetype in audio_signatures:
+        if head[offset : offset + len(signature)] == signature:
+            return mimetype
+    return "application/octet-stream"
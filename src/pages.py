@@ -0,0 +1,63 @@
+from hashlib import sha256
+from os import getenv, makedirs
+from os.path import dirname
+
+from jinja2 import FileSystemBytecodeCache
+
+from . import database, plays
+from .cache import LRUCache
+
+# Catalogue pages change far less often than they are loaded. Triggers keep a version counter per kind of data a page shows (see database.create_tables), so that a page can tell whether anything it shows has changed with one primary key lookup, before doing any other work:
+#     - a page whose versions (and viewer, and query string) are the ones the client already has is answered with 304 Not Modified
+#     - the rendered list of songs is cached under the catalogue version, so it is only rendered again after the catalogue changes. Old versions are never invalidated, they just stop being asked for and age out of the cache
+
+# Rendered song lists, keyed by (template, versions of what they show, whose songs, query string)
+fragment_cache = LRUCache(
+    "fragments",
+    int(getenv("FRAGMENT_CACHE_SIZE", 1024)),
+    float(getenv("FRAGMENT_CACHE_TTL", 3600)),
+)
+
+# Compiled templates, shared by every worker and kept across restarts, so a fresh worker does not parse and compile them again
+template_cache_folder = getenv(
+    "TEMPLATE_CACHE_FOLDER", dirname(__file__) + "/../cache/templates"
+)
+
+
+def bytecode_cache() -> FileSystemBytecodeCache:
+    makedirs(template_cache_folder, exist_ok=True)
+    return FileSystemBytecodeCache(template_cache_folder)
+
+
+def warm_templates(env) -> str:
+    """
+    Compiles every template now instead of on the first request for it, and returns a hash of their sources. It goes into every ETag, so deploying changed templates invalidates the pages clients have.
+    """
+    digest = sha256()
+    for name in sorted(env.list_templates()):
+        env.get_template(name)
+        source, _, _ = env.loader.get_source(env, name)
+        digest.update(name.encode() + b"\0" + source.encode())
+    return digest.hexdigest()[:16]
+
+
+def versions(*names: str) -> tuple[int, ...]:
+    # The current version of each kind of data: catalogue, playlists or users, or plays, the play counts as of the last rollup (see plays.py)
+    keys = [f"version:{name}" for name in names if name != "plays"]
+    found = (
+        dict(
+            database.db.query(
+                f"SELECT name, value FROM counters WHERE name IN ({','.join('?' * len(keys))})",
+                keys,
+            )
+        )
+        if keys
+        else {}
+    )
+    if "plays" in names:
+        found["version:plays"] = plays.log.version()
+    return tuple(found.get(f"version:{name}", 0) for name in names)
+
+
+def etag(*parts) -> str:
+    return sha256(repr(parts).encode()).hexdigest()[:32]
@@ -0,0 +1,145 @@
+from os import getenv
+from time import time
+
+from . import database, recommend
+from .database import fetch_songs, song_columns, song_listing_columns, songs_from_rows
+
+# Each user's play queue and where they are in it, kept in the database so it survives logging out and follows them across devices and workers. Queue positions only ever grow (appending adds after the last one, trimming drops the first ones), so playback_state can point at a position that stays put while the queue changes around it
+
+# Most tracks a queue holds. Appending past it drops the oldest
+queue_limit = int(getenv("QUEUE_LIMIT", 500))
+# Tracks after the current one the player is told to pre-buffer
+prefetch_count = 1
+# Songs like the current one the player shows under it, see recommend.py
+suggestion_count = 5
+
+music_sql = ", ".join(f"music.{column}" for column in song_columns)
+
+
+def current_state(username: str) -> tuple[int, float]:
+    # (queue position, seconds into that track)
+    row = database.db.query(
+        "SELECT position, seconds FROM playback_state WHERE username=?", (username,)
+    )
+    return row[0] if row else (0, 0.0)
+
+
+def save_state(username: str, position: int, offset: float = 0.0):
+    database.db.execute(
+        """INSERT INTO playback_state VALUES (?, ?, ?, ?)
+            ON CONFLICT (username) DO UPDATE SET position=excluded.position, seconds=excluded.seconds, updated_at=excluded.updated_at
+        """,
+        (username, position, max(offset, 0.0), int(time())),
+    )
+
+
+def save_seconds(username: str, position: int, seconds: float):
+    # How far into the track at position the user is. Does nothing if they have moved on from it since, so a late save cannot land on the next track
+    database.db.execute(
+        "UPDATE playback_state SET seconds=?, updated_at=? WHERE username=? AND position=?",
+        (max(seconds, 0.0), int(time()), username, position),
+    )
+
+
+def replace_queue(username: str, music_ids: list[str], start: int = 0):
+    # The queue becomes music_ids, playing from music_ids[start]
+    music_ids = music_ids[:queue_limit]
+    with database.db.transaction():
+        database.db.execute("DELETE FROM play_queue WHERE username=?", (username,))
+        database.db.insert_many(
+            "play_queue",
+            (
+                (username, position, music_id)
+                for position, music_id in enumerate(music_ids)
+            ),
+        )
+        save_state(username, min(max(start, 0), max(len(music_ids) - 1, 0)))
+
+
+def append_to_queue(username: str, music_ids: list[str]):
+    with database.db.transaction():
+        last = database.db.query(
+            "SELECT MAX(position) FROM play_queue WHERE username=?", (username,)
+        )[0][0]
+        first = 0 if last is None else last + 1
+        database.db.insert_many(
+            "play_queue",
+            (
+                (username, first + i, music_id)
+                for i, music_id in enumerate(music_ids[-queue_limit:])
+            ),
+        )
+        database.db.execute(
+            "DELETE FROM play_queue WHERE username=? AND position<?",
+            (username, first + min(len(music_ids), queue_limit) - queue_limit),
+        )
+        if last is None:
+            save_state(username, first)
+
+
+def move(username: str, step: int) -> int:
+    """
+    Moves step tracks forward (or back, if negative) in the queue, and returns the new position. Moving past the last track leaves the queue finished, with nothing up next.
+    """
+    position, _ = current_state(username)
+    if step > 0:
+        row = database.db.query(
+            "SELECT position FROM play_queue WHERE username=? AND position>? ORDER BY position LIMIT 1 OFFSET ?",
+            (username, position, step - 1),
+        )
+        if row:
+            position = row[0][0]
+        else:
+            last = database.db.query(
+                "SELECT MAX(position) FROM play_queue WHERE username=?", (username,)
+            )[0][0]
+            position = max(position, -1 if last is None else last) + 1
+    elif step < 0:
+        row = database.db.query(
+            "SELECT position FROM play_queue WHERE username=? AND position<? ORDER BY position DESC LIMIT 1 OFFSET ?",
+            (username, position, -step - 1),
+        )
+        position = row[0][0] if row else position
+    save_state(username, position)
+    return position
+
+
+def up_next(username: str, n: int = 5) -> dict:
+    """
+    The current track and the ones after it, n in all, with everything the player shows for them (lyrics included), in one query. prefetch is the stream URLs the player should start buffering now, so the next track starts without a round trip. suggestions is songs like the current one that are not in those tracks.
+    """
+    position, offset = current_state(username)
+    rows = database.db.query(
+        f"""SELECT play_queue.position, {music_sql} FROM play_queue
+            JOIN music ON music.music_id = play_queue.music_id
+            WHERE play_queue.username=? AND play_queue.position>=?
+            ORDER BY play_queue.position LIMIT ?
+        """,
+        (username, position, n),
+    )
+    songs = songs_from_rows([row[1:] for row in rows], song_columns)
+    tracks = [
+        song.to_json() | {"position": row[0], "url": f"/stream/{song.music_id}"}
+        for row, song in zip(rows, songs)
+    ]
+    return {
+        "position": position,
+        # Only resume part way through if the current track is still there
+        "offset": offset if tracks and tracks[0]["position"] == position else 0.0,
+        "tracks": tracks,
+        "prefetch": [track["url"] for track in tracks[1 : 1 + prefetch_count]],
+        "suggestions": (
+            [
+                song.to_json(song_listing_columns) | {"url": f"/stream/{song.music_id}"}
+                for song in fetch_songs(
+                    recommend.suggest(
+                        tracks[0]["music_id"],
+                        suggestion_count,
+                        {track["music_id"] for track in tracks},
+                    )
+                )
+            ]
+            if tracks
+            else []
+        ),
+    }
@@ -0,0 +1,268 @@
+from atexit import register
+from collections import Counter
+from logging import getLogger
+from os import getenv
+from threading import Event, Lock, Thread
+from time import time
+
+from .database import SqliteWrapper
+
+logger = getLogger(__name__)
+
+# Plays are counted by the player once a track has played for a while (see player.js). They arrive far more often than anything else is written, so they never go through the main database one at a time:
+#     - a play is appended to an in-memory buffer, and a background thread writes the buffer to the plays table in one transaction once it holds batch_size plays, or flush_seconds after the last write, whichever comes first. If the database falls so far behind that max_buffered plays are waiting, the request that records the next one writes them itself. If writes are failing instead, the oldest plays past max_buffered are dropped (and counted, see stats), and the background thread keeps retrying the rest, so memory stays bounded either way
+#     - the plays table is in its own SQLite database, so its writes never wait for catalogue writes or the other way round. It is only ever appended to, and id only ever grows, so readers (the rollups below, and the recommender, see recommend.py) track what they have read by id alone
+#     - every rollup_seconds, the plays added since the last rollup are counted into song_plays (per song), daily_plays (per song and day) and day_plays (per day), and the id they were counted up to saved in the rollups table. Dashboards only read those, and use that id as the version of what they show (see pages.versions)
+# A worker that exits writes what it has buffered. One that crashes loses at most that, which for counting plays is an acceptable trade for not taking the write lock on every one
+
+batch_size = int(getenv("PLAYS_BATCH_SIZE", 500))
+flush_seconds = float(getenv("PLAYS_FLUSH_SECONDS", 5))
+max_buffered = batch_size * 20
+rollup_seconds = float(getenv("PLAYS_ROLLUP_SECONDS", 60))
+day = 60 * 60 * 24
+
+
+class PlayLog:
+    """
+    Thread safe, append only buffer of plays, as (username, music_id, played_at), in front of the plays database at path.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = batch_size,
+        flush_seconds: float = flush_seconds,
+        rollup_seconds: float = rollup_seconds,
+    ):
+        # The tables are created by python -m src.migrate, see create_tables
+        self.db = SqliteWrapper(path)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.rollup_seconds = rollup_seconds
+        self.buffer = []
+        self.lock = Lock()
+        # Held while a batch is written, so batches go in in the order they were taken from the buffer
+        self.write_lock = Lock()
+        self.wake = Event()
+        self.thread = None
+        self.last_rollup = time()
+        # Plays written, failed writes and plays dropped because writes kept failing, since this worker started
+        self.written = 0
+        self.failures = 0
+        self.dropped = 0
+        # Whether the last write failed. While it has, requests leave retrying to the background thread rather than each waiting on a write that will likely fail too
+        self.failing = False
+
+    def record(self, username: str, music_id: str, played_at: int | None = None):
+        with self.lock:
+            self.buffer.append(
+                (username, music_id, int(time() if played_at is None else played_at))
+            )
+            if self.failing:
+                self.trim()
+            buffered = len(self.buffer)
+        # While writes are failing, the background thread retries on its own timer
+        if not self.failing:
+            if buffered >= max_buffered:
+                self.flush()
+            elif buffered >= self.batch_size:
+                self.wake.set()
+        self.start()
+
+    def start(self):
+        # Started on first use rather than at import, so that each worker (forked after import under gunicorn --preload) runs its own
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name="plays", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+            if time() - self.last_rollup >= self.rollup_seconds:
+                self.last_rollup = time()
+                try:
+                    self.roll_up()
+                except Exception:
+                    logger.exception("Could not roll up plays")
+
+    def flush(self) -> int:
+        # Writes the buffered plays, and returns how many were written. If the write fails they are put back, to go with the next batch, less the oldest of them if that takes the buffer past max_buffered
+        with self.write_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            if not batch:
+                return 0
+            try:
+                self.db.insert_many(
+                    "plays", ((None,) + play for play in batch), batch_size=len(batch)
+                )
+            except Exception:
+                logger.exception("Could not write %d plays", len(batch))
+                self.failures += 1
+                self.failing = True
+                with self.lock:
+                    self.buffer[:0] = batch
+                    dropped = self.trim()
+                # Logged here rather than in record, which drops one at a time, so an outage logs once per retry rather than once per play
+                if dropped:
+                    logger.warning("Dropped %d plays, the buffer is full", dropped)
+                return 0
+            self.failing = False
+            self.written += len(batch)
+            return len(batch)
+
+    def trim(self) -> int:
+        # Drops the oldest plays past max_buffered, and returns how many. Called with self.lock held
+        excess = max(len(self.buffer) - max_buffered, 0)
+        del self.buffer[:excess]
+        self.dropped += excess
+        return excess
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+    def roll_up(self) -> int:
+        """
+        Counts the plays written since the last rollup (by any worker) into the rollup tables, and returns how many there were. One transaction, so the counts and the id they go up to never disagree.
+        """
+        with self.db.transaction() as con:
+            done = rolled_up(con)
+            last = con.execute("SELECT MAX(id) FROM plays").fetchone()[0]
+            if last is None or last <= done:
+                return 0
+            groups = con.execute(
+                f"SELECT music_id, played_at / {day}, COUNT(*) FROM plays WHERE id > ? AND id <= ? GROUP BY 1, 2",
+                (done, last),
+            ).fetchall()
+            songs, days = Counter(), Counter()
+            for music_id, d, count in groups:
+                songs[music_id] += count
+                days[d] += count
+            con.executemany(
+                """INSERT INTO daily_plays VALUES (?, ?, ?)
+                    ON CONFLICT (music_id, day) DO UPDATE SET plays = plays + excluded.plays
+                """,
+                groups,
+            )
+            con.executemany(
+                """INSERT INTO song_plays VALUES (?, ?)
+                    ON CONFLICT (music_id) DO UPDATE SET plays = plays + excluded.plays
+                """,
+                songs.items(),
+            )
+            con.executemany(
+                """INSERT INTO day_plays VALUES (?, ?)
+                    ON CONFLICT (day) DO UPDATE SET plays = plays + excluded.plays
+                """,
+                days.items(),
+            )
+            con.execute(
+                "INSERT INTO rollups VALUES ('plays', ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                (last,),
+            )
+            return sum(songs.values())
+
+    def version(self) -> int:
+        # The id of the last play the rollups count. Goes up with every rollup that counted anything
+        with self.db.connection() as con:
+            return rolled_up(con)
+
+    def totals(self, music_ids: list[str]) -> dict[str, int]:
+        # Plays of each of music_ids, as of the last rollup. Songs never played are left out
+        if not music_ids:
+            return {}
+        return dict(
+            self.db.query(
+                f"SELECT music_id, plays FROM song_plays WHERE music_id IN ({','.join('?' * len(music_ids))})",
+                music_ids,
+            )
+        )
+
+    def per_day(self, music_id: str | None = None, days: int = 30) -> list[tuple]:
+        # (day, plays) for each of the last days days with any plays, of one song or of all of them. Days are numbered from the epoch, in UTC
+        since = int(time()) // day - days + 1
+        if music_id is None:
+            return self.db.query(
+                "SELECT day, plays FROM day_plays WHERE day >= ? ORDER BY day",
+                (since,),
+            )
+        return self.db.query(
+            "SELECT day, plays FROM daily_plays WHERE music_id = ? AND day >= ? ORDER BY day",
+            (music_id, since),
+        )
+
+    def most_played(self, limit: int = 10) -> list[tuple[str, int]]:
+        return self.db.query(
+            "SELECT music_id, plays FROM song_plays ORDER BY plays DESC, music_id LIMIT ?",
+            (limit,),
+        )
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+
+def rolled_up(con) -> int:
+    row = con.execute("SELECT value FROM rollups WHERE name = 'plays'").fetchone()
+    return row[0] if row else 0
+
+
+def create_tables(db: SqliteWrapper):
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS plays
+            (
+                id INTEGER PRIMARY KEY,
+                username VARCHAR(20) NOT NULL,
+                music_id VARCHAR(20) NOT NULL,
+                played_at INT NOT NULL
+            )
+        """
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS song_plays
+            (
+                music_id VARCHAR(20) PRIMARY KEY NOT NULL,
+                plays INT NOT NULL
+            )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS song_plays_plays ON song_plays (plays)")
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS daily_plays
+            (
+                music_id VARCHAR(20) NOT NULL,
+                day INT NOT NULL,
+                plays INT NOT NULL,
+                PRIMARY KEY (music_id, day)
+            ) WITHOUT ROWID
+        """
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS day_plays
+            (
+                day INT PRIMARY KEY NOT NULL,
+                plays INT NOT NULL
+            )
+        """
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS rollups
+            (
+                name VARCHAR(20) PRIMARY KEY NOT NULL,
+                value INT NOT NULL
+            )
+        """
+    )
+
+
+log = PlayLog(getenv("PLAYS_DATABASE_PATH", "plays.db"))
+register(log.flush)
@@ -0,0 +1,233 @@
+from collections import Counter, defaultdict, deque
+from functools import cache
+from logging import getLogger
+from math import sqrt
+from os import getenv
+from threading import Lock, Thread
+from time import perf_counter, time
+
+from . import plays
+
+logger = getLogger(__name__)
+
+# "Up next" suggestions, by item to item co-occurrence over the plays table (see plays.py). Two songs co-occur when a user plays one within window plays (and session_gap seconds) of the other, and a song's neighbours are the songs it co-occurs with most, as counts divided by the square root of the product of both songs' play counts (cosine similarity), so hits everyone plays do not top every list
+# Each worker keeps the top_n neighbours of every song in memory, so a suggestion is one dict lookup. They are retrained incrementally: every refresh_seconds, on a background thread, the plays added since the last refresh are paired with each user's last window plays before them, their counts added to the co-occurrence matrix, and the neighbours of the songs they touched ranked again. A song's list is only re-ranked when it is played again, so scores of songs that are not can go slightly stale as their neighbours' play counts grow
+# The matrix is a SciPy sparse matrix, and plays are paired with NumPy a batch at a time. Without them both it is a dict of Counters, filled in a play at a time. They are imported by the first refresh rather than at the top, so a worker that never suggests anything does not spend its startup importing them
+
+top_n = int(getenv("RECOMMEND_TOP_N", 20))
+window = 5
+session_gap = 60 * 60
+refresh_seconds = float(getenv("RECOMMEND_REFRESH_SECONDS", 60))
+# Plays read per query while catching up
+read_batch = 100000
+
+
+@cache
+def scipy_modules() -> tuple:
+    # (numpy, scipy.sparse), or (None, None) if either is not installed
+    try:
+        import numpy
+        from scipy import sparse
+    except ImportError:
+        return None, None
+    return numpy, sparse
+
+
+class CoOccurrence:
+    """
+    The co-occurrence matrix and the neighbours ranked from it. vectorized=False counts in plain Python even if NumPy and SciPy are installed.
+    """
+
+    def __init__(self, top_n: int = top_n, vectorized: bool = True):
+        self.top_n = top_n
+        # The last window plays of each user, as (music_id, played_at), for the next plays to pair up with
+        self.tails = {}
+        self.neighbours = {}
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self.thread = None
+        self.lock = Lock()
+        # Held by a refresh, so two cannot add the same plays twice
+        self.training = Lock()
+        self.vectorized = vectorized
+        # Made by the first add, see start
+        self.matrix = None
+
+    def start(self):
+        # Imports NumPy and SciPy if they are to be used, and makes the empty matrix
+        self.np, self.sparse = scipy_modules() if self.vectorized else (None, None)
+        if self.sparse is not None:
+            self.rows = {}
+            self.ids = []
+            self.counts = self.np.zeros(0)
+            self.matrix = self.sparse.csr_matrix((0, 0), dtype=self.np.float32)
+        else:
+            self.counts = Counter()
+            self.matrix = defaultdict(Counter)
+
+    def row(self, music_id: str) -> int:
+        row = self.rows.get(music_id)
+        if row is None:
+            row = self.rows[music_id] = len(self.ids)
+            self.ids.append(music_id)
+        return row
+
+    def add(self, batch: list) -> list[str]:
+        """
+        Counts a batch of plays, (username, music_id, played_at) oldest first, into the matrix. Returns the songs that co-occur with something new, whose neighbours need ranking again.
+        """
+        if self.matrix is None:
+            self.start()
+        np, sparse = self.np, self.sparse
+        if sparse is None:
+            return self.add_slowly(batch)
+        if not batch:
+            return []
+
+        users = {}
+        for username, _, _ in batch:
+            users.setdefault(username, len(users))
+        # Each user's last plays before these come first, so the new plays pair up with them too
+        old = [
+            (user, music_id, played_at)
+            for username, user in users.items()
+            for music_id, played_at in self.tails.get(username, ())
+        ]
+        sequence = old + [
+            (users[username], music_id, played_at)
+            for username, music_id, played_at in batch
+        ]
+        user = np.fromiter((s[0] for s in sequence), np.int64, len(sequence))
+        item = np.fromiter((self.row(s[1]) for s in sequence), np.int64, len(sequence))
+        at = np.fromiter((s[2] for s in sequence), np.int64, len(sequence))
+        new = np.arange(len(sequence)) >= len(old)
+        # Grouped by user, in the order they played
+        order = np.argsort(user, kind="stable")
+        user, item, at, new = user[order], item[order], at[order], new[order]
+
+        # Every new play, paired with each of the window plays before it by the same user
+        before, after = [], []
+        for lag in range(1, window + 1):
+            paired = (
+                new[lag:]
+                & (user[lag:] == user[:-lag])
+                & (at[lag:] - at[:-lag] <= session_gap)
+                & (item[lag:] != item[:-lag])
+            )
+            before.append(item[:-lag][paired])
+            after.append(item[lag:][paired])
+        before, after = np.concatenate(before), np.concatenate(after)
+
+        n = len(self.ids)
+        self.counts = np.concatenate([self.counts, np.zeros(n - len(self.counts))])
+        self.counts += np.bincount(item[new], minlength=n)
+        self.matrix.resize((n, n))
+        self.matrix = self.matrix + sparse.csr_matrix(
+            (
+                np.ones(2 * len(before), dtype=np.float32),
+                (np.concatenate([before, after]), np.concatenate([after, before])),
+            ),
+            shape=(n, n),
+        )
+
+        for username, music_id, played_at in batch:
+            self.tails.setdefault(username, deque(maxlen=window)).append(
+                (music_id, played_at)
+            )
+        return [self.ids[i] for i in np.union1d(before, after).tolist()]
+
+    def add_slowly(self, batch: list) -> list[str]:
+        changed = set()
+        for username, music_id, played_at in batch:
+            tail = self.tails.setdefault(username, deque(maxlen=window))
+            for other, other_at in tail:
+                if other != music_id and played_at - other_at <= session_gap:
+                    self.matrix[music_id][other] += 1
+                    self.matrix[other][music_id] += 1
+                    changed.update((music_id, other))
+            tail.append((music_id, played_at))
+            self.counts[music_id] += 1
+        return list(changed)
+
+    def rank(self, music_ids: list[str]):
+        # Works out the top_n neighbours of each of music_ids again. Each list is replaced whole, so a reader sees the old one or the new one
+        if self.matrix is None:
+            self.start()
+        np = self.np
+        if self.sparse is None:
+            for music_id in music_ids:
+                row = self.matrix[music_id]
+                scores = {
+                    other: count / sqrt(self.counts[music_id] * self.counts[other])
+                    for other, count in row.items()
+                }
+                self.neighbours[music_id] = tuple(
+                    sorted(scores, key=scores.get, reverse=True)[: self.top_n]
+                )
+            return
+
+        indptr, indices, data = (
+            self.matrix.indptr,
+            self.matrix.indices,
+            self.matrix.data,
+        )
+        for music_id in music_ids:
+            i = self.rows[music_id]
+            others = indices[indptr[i] : indptr[i + 1]]
+            scores = data[indptr[i] : indptr[i + 1]] / np.sqrt(
+                self.counts[i] * self.counts[others]
+            )
+            if len(others) > self.top_n:
+                best = np.argpartition(-scores, self.top_n)[: self.top_n]
+                others, scores = others[best], scores[best]
+            self.neighbours[music_id] = tuple(
+                self.ids[j] for j in others[np.argsort(-scores, kind="stable")].tolist()
+            )
+
+    def refresh(self) -> int:
+        """
+        Trains on the plays added since the last refresh, and returns how many there were.
+        """
+        with self.training:
+            start = perf_counter()
+            changed = set()
+            read = 0
+            while rows := plays.log.db.query(
+                "SELECT id, username, music_id, played_at FROM plays WHERE id>? ORDER BY id LIMIT ?",
+                (self.last_id, read_batch),
+            ):
+                changed.update(self.add([row[1:] for row in rows]))
+                self.last_id = rows[-1][0]
+                read += len(rows)
+            self.rank(list(changed))
+            self.refreshed_at = time()
+        if read:
+            logger.info(
+                "Trained on %d plays, ranked %d songs again in %.2fs",
+                read,
+                len(changed),
+                perf_counter() - start,
+            )
+        return read
+
+    def refresh_soon(self):
+        # Starts a refresh on a background thread if the last one is refresh_seconds old, so no request waits for one
+        if time() - self.refreshed_at < refresh_seconds:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = Thread(target=self.refresh, name="recommend", daemon=True)
+            self.thread.start()
+
+    def similar(self, music_id: str) -> tuple:
+        return self.neighbours.get(music_id, ())
+
+
+model = CoOccurrence()
+
+
+def suggest(music_id: str, n: int = 5, exclude=()) -> list[str]:
+    # Up to n songs to play after music_id, leaving out the ones in exclude
+    model.refresh_soon()
+    return [other for other in model.similar(music_id) if other not in exclude][:n]
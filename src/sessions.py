@@ -0,0 +1,184 @@
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from .cache import MISSING, LRUCache, redis_client
+from .database import SqliteWrapper
+
+# Server side sessions. The cookie holds "<sid>.<version>", and the version goes up every time the session is written. A worker caches the sessions it has read or written by sid, and only uses a cached one if its version is the one in the cookie, so a session changed by another worker is never read stale, and an unchanged one costs no read at all. A session is only written when it has changed (including in place changes, like appending to a list in it), or when half its lifetime has passed, to keep it alive
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(
+        self,
+        initial=None,
+        sid: str | None = None,
+        version: int = 0,
+        expires: int = 0,
+        stored: str | None = None,
+    ):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or token_urlsafe(32)
+        self.version = version
+        self.expires = expires
+        # The serialized session as it was stored, to tell at the end of the request whether anything changed
+        self.stored = stored
+        self.modified = False
+
+
+class SqliteSessionStore:
+    """
+    Sessions in their own SQLite database (in WAL mode, like the main one), so session writes never wait for catalogue writes or the other way round.
+    """
+
+    def __init__(self, path: str, sweep_interval: float = 600):
+        # The table is created by python -m src.migrate, see create_tables
+        self.db = SqliteWrapper(path)
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.lock = Lock()
+
+    def load(self, sid: str) -> tuple | None:
+        # (version, data, expires), or None if there is no such session or it has expired
+        row = self.db.query(
+            "SELECT version, data, expires FROM sessions WHERE sid=? AND expires>?",
+            (sid, int(time())),
+        )
+        return row[0] if row else None
+
+    def save(self, sid: str, version: int, data: str, expires: int):
+        self.db.execute(
+            """INSERT INTO sessions VALUES (?, ?, ?, ?)
+                ON CONFLICT (sid) DO UPDATE SET version=excluded.version, data=excluded.data, expires=excluded.expires
+            """,
+            (sid, version, data, expires),
+        )
+        self.sweep()
+
+    def delete(self, sid: str):
+        self.db.execute("DELETE FROM sessions WHERE sid=?", (sid,))
+
+    def sweep(self):
+        # Deletes expired sessions, at most once every sweep_interval seconds per process
+        now = time()
+        with self.lock:
+            if now - self.last_sweep < self.sweep_interval:
+                return
+            self.last_sweep = now
+        self.db.execute("DELETE FROM sessions WHERE expires<=?", (int(now),))
+
+
+def create_tables(db: SqliteWrapper):
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS sessions
+            (
+                sid VARCHAR(43) PRIMARY KEY NOT NULL,
+                version INT NOT NULL,
+                data TEXT NOT NULL,
+                expires INT NOT NULL
+            )
+        """
+    )
+
+
+class RedisSessionStore:
+    """
+    Sessions in a Redis compatible server, for deployments with more than one machine. The server expires them itself.
+    """
+
+    def __init__(self, url: str):
+        self.redis = redis_client(url, "SESSION_URL")
+        self.prefix = "music-app:session:"
+
+    def load(self, sid: str) -> tuple | None:
+        data = self.redis.get(self.prefix + sid)
+        if data is None:
+            return None
+        version, expires, data = data.decode().split(":", 2)
+        return int(version), data, int(expires)
+
+    def save(self, sid: str, version: int, data: str, expires: int):
+        self.redis.set(
+            self.prefix + sid,
+            f"{version}:{expires}:{data}",
+            ex=max(1, expires - int(time())),
+        )
+
+    def delete(self, sid: str):
+        self.redis.delete(self.prefix + sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, cache_size: int = 10000, cache_ttl: float = 300):
+        self.store = store
+        # sid: (version, data, expires), as stored
+        self.cache = LRUCache("sessions", cache_size, cache_ttl)
+
+    def open_session(self, app, request) -> ServerSession:
+        sid, _, version = request.cookies.get(
+            app.config["SESSION_COOKIE_NAME"], ""
+        ).partition(".")
+        if not sid or not version.isdigit():
+            return ServerSession()
+
+        entry = self.cache.get(sid)
+        if entry is MISSING or entry[0] != int(version):
+            entry = self.store.load(sid)
+            if entry is None:
+                return ServerSession()
+            self.cache.set(sid, entry)
+
+        stored_version, data, expires = entry
+        if expires <= time():
+            return ServerSession()
+        return ServerSession(
+            serializer.loads(data), sid, stored_version, expires, stored=data
+        )
+
+    def save_session(self, app, session: ServerSession, response):
+        name = app.config["SESSION_COOKIE_NAME"]
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+
+        if not session:
+            if session.stored is not None:
+                # Cleared, e.g. by /logout
+                self.store.delete(session.sid)
+                self.cache.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        data = serializer.dumps(dict(session))
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        now = int(time())
+        if data == session.stored and session.expires - now > lifetime / 2:
+            return
+
+        version, expires = session.version + 1, now + lifetime
+        self.store.save(session.sid, version, data, expires)
+        self.cache.set(session.sid, (version, data, expires))
+        response.set_cookie(
+            name,
+            f"{session.sid}.{version}",
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def make_session_interface(url: str | None, path: str) -> ServerSessionInterface:
+    # Redis when a server URL is configured, otherwise a SQLite database at path
+    if url:
+        return ServerSessionInterface(RedisSessionStore(url))
+    return ServerSessionInterface(SqliteSessionStore(path))
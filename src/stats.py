@@ -0,0 +1,66 @@
+from datetime import date, timedelta
+
+from . import database, plays
+
+# Statistics for the admin dashboard, read from the counters table that triggers on music, users and playlists keep up to date (see database.create_tables). Every function here costs a primary key lookup or a short range scan, however big the tables get. Play counts come from the rollups in the plays database (see plays.py)
+
+
+def counter(name: str) -> int:
+    row = database.db.query("SELECT value FROM counters WHERE name=?", (name,))
+    return row[0][0] if row else 0
+
+
+def counters(prefix: str) -> dict[str, int]:
+    # All non zero counters named prefix + something, keyed by the something. A range on the primary key, so only those rows are read
+    return {
+        name[len(prefix) :]: value
+        for name, value in database.db.query(
+            "SELECT name, value FROM counters WHERE name >= ? AND name < ? AND value > 0",
+            (prefix, prefix + "\U0010ffff"),
+        )
+    }
+
+
+def number_of_songs() -> int:
+    return counter("songs")
+
+
+def number_of_playlists() -> int:
+    return counter("playlists")
+
+
+def number_of_admins() -> int:
+    return counter("users:0")
+
+
+def number_of_listeners() -> int:
+    return counter("users:1")
+
+
+def number_of_creators() -> int:
+    return counter("users:2")
+
+
+def songs_per_genre() -> list[tuple[str, int]]:
+    return sorted(counters("genre:").items(), key=lambda x: (-x[1], x[0]))
+
+
+def songs_per_year() -> list[tuple[str, int]]:
+    return sorted(counters("year:").items())
+
+
+def uploads_per_creator(limit: int = 10) -> list[tuple[str, int]]:
+    return sorted(counters("owner:").items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+
+def plays_per_day(days: int = 7) -> list[tuple[str, int]]:
+    return [
+        ((date(1970, 1, 1) + timedelta(days=day)).isoformat(), count)
+        for day, count in plays.log.per_day(days=days)
+    ]
+
+
+def most_played(limit: int = 10) -> list[tuple[str, int]]:
+    top = dict(plays.log.most_played(limit))
+    songs = database.fetch_songs(list(top), ("music_id", "name"))
+    return [(song.name, top[song.music_id]) for song in songs]
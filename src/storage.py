@@ -0,0 +1,366 @@
+from argparse import ArgumentParser
+from errno import EXDEV
+from hashlib import sha256
+from logging import basicConfig, getLogger
+from os import getenv, link, listdir, makedirs, remove, replace, stat
+from os.path import dirname, exists, getsize, isdir, isfile, join
+from shutil import copyfile
+from tempfile import gettempdir
+from time import time
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+from . import database
+from .miscellaneous import guess_audio_mimetype
+
+logger = getLogger(__name__)
+
+# Audio files are stored under the SHA-256 of their content rather than under a music_id, so a file uploaded as two songs (by two creators, say) is stored once. song_media maps every song to the hash of its file, and triggers keep a reference count per hash in audio_blobs (see database.create_tables). A file is deleted in the same transaction that drops its last reference, which holds the write lock, so an upload of the same file in between cannot be left pointing at nothing.
+# Where the files live is up to the store, chosen by AUDIO_STORAGE_URL:
+#     (unset)                       static/audio
+#     file:///srv/audio             a local folder
+#     s3://bucket/prefix            an S3 bucket, with boto3. ?endpoint=http://localhost:9000 for MinIO, moto or another S3 compatible server
+# Local files are sharded two levels deep by hash (static/audio/ab/cd/abcd...), so no folder holds more than a few hundred files even with millions of songs
+
+default_folder = dirname(__file__) + "/../static/audio"
+# Files written to a store but never referenced (an upload that failed after its file was stored, a song skipped by an import) are deleted by sweep() once they are this old
+orphan_expiry = 60 * 60 * 24
+
+# Sets a song's file, replacing the one it had. The triggers move the reference from the old file to the new one
+media_upsert_sql = """INSERT INTO song_media VALUES (?,?,?,?,?,?)
+    ON CONFLICT (music_id) DO UPDATE SET size=excluded.size, sha256=excluded.sha256, mimetype=excluded.mimetype, duration=excluded.duration, bitrate=excluded.bitrate
+"""
+
+
+def place_file(source: str, destination: str, mode: str = "copy"):
+    """
+    Puts source at destination by moving, hard linking or copying it (mode). Written under a temporary name first, so a reader never sees a half copied file. Moves and links across filesystems fall back to copying.
+    """
+    partial = f"{destination}.{uuid4().hex}.part"
+    try:
+        if mode == "move":
+            replace(source, destination)
+            return
+        if mode == "link":
+            link(source, partial)
+            replace(partial, destination)
+            return
+    except OSError as e:
+        if e.errno != EXDEV:
+            raise
+    try:
+        copyfile(source, partial)
+        replace(partial, destination)
+    finally:
+        if exists(partial):
+            remove(partial)
+    if mode == "move":
+        remove(source)
+
+
+def hash_file(path: str) -> str:
+    h = sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            h.update(block)
+    return h.hexdigest()
+
+
+def receive(stream, block_size: int = 1024 * 64) -> tuple[str, str]:
+    """
+    Writes stream to a new file in the store's incoming folder, hashing it as it is written so it is never read twice. Returns (path, sha256). The caller removes the file if it does not store it.
+    """
+    makedirs(store.incoming, exist_ok=True)
+    path = join(store.incoming, uuid4().hex + ".part")
+    h = sha256()
+    with open(path, "wb") as f:
+        while block := stream.read(block_size):
+            f.write(block)
+            h.update(block)
+    return path, h.hexdigest()
+
+
+def shard(digest: str) -> str:
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+class LocalStore:
+    """
+    Files in a folder on this machine, which the stream route sends itself (or through the web server's X-Accel-Redirect or X-Sendfile).
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        # On the same filesystem, so storing a received file is a rename
+        self.incoming = join(folder, "incoming")
+
+    def local_path(self, digest: str) -> str:
+        return join(self.folder, shard(digest))
+
+    def exists(self, digest: str) -> bool:
+        return isfile(self.local_path(digest))
+
+    def put(
+        self,
+        source: str,
+        digest: str,
+        mode: str = "copy",
+        mimetype: str | None = None,
+    ):
+        # source must already be known to hash to digest. A file that is stored already is left as it is
+        destination = self.local_path(digest)
+        if exists(destination):
+            if mode == "move":
+                remove(source)
+            return
+        makedirs(dirname(destination), exist_ok=True)
+        place_file(source, destination, mode)
+
+    def get(self, digest: str, destination: str, hard_link: bool = False):
+        place_file(
+            self.local_path(digest), destination, "link" if hard_link else "copy"
+        )
+
+    def delete(self, digest: str):
+        try:
+            remove(self.local_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def url(self, digest: str, mimetype: str) -> str | None:
+        return None
+
+    def list(self):
+        # (digest, modified time) of every stored file
+        for first in listdir(self.folder):
+            if len(first) != 2 or not isdir(join(self.folder, first)):
+                continue
+            for second in listdir(join(self.folder, first)):
+                for name in listdir(join(self.folder, first, second)):
+                    if len(name) == 64:
+                        yield name, stat(
+                            join(self.folder, first, second, name)
+                        ).st_mtime
+
+
+class S3Store:
+    """
+    Files in an S3 bucket. Clients are redirected to a presigned URL for them instead of being streamed them by a worker, and no renditions are made, since ffmpeg needs a local file.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint: str | None = None):
+        # Imported here rather than at the top, since boto3 takes longer to import than the rest of the app and only this store uses it
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError(
+                "AUDIO_STORAGE_URL is an s3:// URL, but the boto3 package is not installed"
+            ) from None
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint)
+        self.url_expiry = int(getenv("AUDIO_URL_EXPIRY", 3600))
+        self.incoming = gettempdir()
+
+    def key(self, digest: str) -> str:
+        return self.prefix + shard(digest)
+
+    def local_path(self, digest: str) -> None:
+        return None
+
+    def exists(self, digest: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(digest))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in {"404", "NoSuchKey"}:
+                return False
+            raise
+        return True
+
+    def put(
+        self,
+        source: str,
+        digest: str,
+        mode: str = "copy",
+        mimetype: str | None = None,
+    ):
+        if not self.exists(digest):
+            self.client.upload_file(
+                source,
+                self.bucket,
+                self.key(digest),
+                ExtraArgs={"ContentType": mimetype} if mimetype else None,
+            )
+        if mode == "move":
+            remove(source)
+
+    def get(self, digest: str, destination: str, hard_link: bool = False):
+        partial = f"{destination}.{uuid4().hex}.part"
+        try:
+            self.client.download_file(self.bucket, self.key(digest), partial)
+            replace(partial, destination)
+        finally:
+            if exists(partial):
+                remove(partial)
+
+    def delete(self, digest: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(digest))
+
+    def url(self, digest: str, mimetype: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self.key(digest),
+                "ResponseContentType": mimetype,
+                "ResponseCacheControl": "public, max-age=31536000, immutable",
+            },
+            ExpiresIn=self.url_expiry,
+        )
+
+    def list(self):
+        pages = self.client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self.prefix
+        )
+        for page in pages:
+            for item in page.get("Contents", []):
+                yield item["Key"].rsplit("/", 1)[-1], item["LastModified"].timestamp()
+
+
+def make_store(url: str | None) -> LocalStore | S3Store:
+    if not url:
+        return LocalStore(default_folder)
+    parts = urlsplit(url)
+    if parts.scheme == "file":
+        return LocalStore(parts.path)
+    if parts.scheme == "s3":
+        endpoint = parse_qs(parts.query).get("endpoint", [None])[0]
+        return S3Store(parts.netloc, parts.path, endpoint)
+    raise ValueError(f"Unsupported AUDIO_STORAGE_URL {url}")
+
+
+store = make_store(getenv("AUDIO_STORAGE_URL"))
+
+
+def media(music_id: str) -> tuple[str, str] | None:
+    # (sha256, mimetype) of the song's file, or None if it has none
+    row = database.db.fetchone("song_media", (music_id,))
+    return None if row is None else (row[2], row[3])
+
+
+def add_media(
+    con,
+    music_id: str,
+    source: str,
+    digest: str,
+    mimetype: str,
+    mode: str = "move",
+    duration: float | None = None,
+    bitrate: int | None = None,
+):
+    """
+    Stores source as the song's file, replacing the file it had (which is deleted if no other song uses it). Call inside a transaction, on its connection.
+    """
+    con.execute(
+        media_upsert_sql,
+        (music_id, getsize(source), digest, mimetype, duration, bitrate),
+    )
+    store.put(source, digest, mode, mimetype)
+    release_unreferenced(con)
+
+
+def release_unreferenced(con):
+    """
+    Deletes the files no song uses any more. Call inside the transaction that dropped the references: if a file cannot be deleted, the transaction is rolled back with it.
+    """
+    unreferenced = [
+        digest
+        for (digest,) in con.execute(
+            "SELECT sha256 FROM audio_blobs WHERE refcount <= 0"
+        ).fetchall()
+    ]
+    for digest in unreferenced:
+        store.delete(digest)
+    if unreferenced:
+        con.execute("DELETE FROM audio_blobs WHERE refcount <= 0")
+
+
+def adopt(folder: str, mode: str = "move") -> int:
+    """
+    Stores the files in folder that are named after a song (the layout static/audio had before this store) as those songs' files, unless their file is stored already. Returns how many were adopted.
+    """
+    adopted = 0
+    for music_id in sorted(listdir(folder)):
+        source = join(folder, music_id)
+        if not isfile(source) or not database.db.exists("music", music_id):
+            continue
+        try:
+            digest = hash_file(source)
+            mimetype = guess_audio_mimetype(source)
+            with database.db.transaction() as con:
+                row = con.execute(
+                    "SELECT sha256 FROM song_media WHERE music_id=?", (music_id,)
+                ).fetchone()
+                # Songs uploaded before the store existed have a song_media row, but their file is still here
+                if row is not None and store.exists(row[0]):
+                    continue
+                add_media(con, music_id, source, digest, mimetype, mode)
+        except FileNotFoundError:
+            # Adopted by another worker in the meantime
+            continue
+        adopted += 1
+    if adopted:
+        logger.info("Adopted %d audio files from %s", adopted, folder)
+    return adopted
+
+
+def sweep(expiry: float = orphan_expiry) -> int:
+    """
+    Deletes stored files that no song uses and that are older than expiry seconds. Returns how many were deleted.
+    """
+    referenced = {
+        digest for (digest,) in database.db.query("SELECT sha256 FROM audio_blobs")
+    }
+    deleted = 0
+    for digest, modified in list(store.list()):
+        if digest in referenced or modified > time() - expiry:
+            continue
+        with database.db.transaction() as con:
+            # Checked again under the write lock, in case a song has started using it since
+            if con.execute(
+                "SELECT 1 FROM audio_blobs WHERE sha256=?", (digest,)
+            ).fetchone():
+                continue
+            store.delete(digest)
+        deleted += 1
+    return deleted
+
+
+def main():
+    basicConfig(
+        level=getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    parser = ArgumentParser(prog="python -m src.storage")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser(
+        "adopt", help="Store files named after songs, as static/audio used to have"
+    )
+    command.add_argument("folder", nargs="?", default=default_folder)
+    command.add_argument(
+        "--keep", action="store_true", help="Link or copy the files, not move them"
+    )
+    command = commands.add_parser("sweep", help="Delete files no song uses")
+    command.add_argument("--expiry", type=float, default=orphan_expiry)
+    args = parser.parse_args()
+
+    if args.command == "adopt":
+        logger.info(
+            "Adopted %d files", adopt(args.folder, "link" if args.keep else "move")
+        )
+    else:
+        logger.info("Deleted %d files", sweep(args.expiry))
+
+
+if __name__ == "__main__":
+    main()
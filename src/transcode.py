@@ -0,0 +1,163 @@
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from os import getenv, listdir, makedirs, remove, replace, stat, utime
+from os.path import dirname, exists, getsize, isdir, join
+from shutil import which
+from subprocess import run
+from threading import Lock
+from uuid import uuid4
+
+# The ladder of renditions made for every song, as AAC bitrates. Sources are never upscaled: a rendition is only used if it is smaller than the original
+renditions = {
+    "low": "64k",
+    "medium": "128k",
+    "high": "192k",
+}
+lossless_mimetypes = {"audio/flac", "audio/wav"}
+
+cache_folder = getenv(
+    "RENDITION_CACHE_FOLDER", dirname(__file__) + "/../cache/renditions"
+)
+cache_max_bytes = int(getenv("RENDITION_CACHE_BYTES", 1024 * 1024 * 1024 * 2))
+ffmpeg = getenv("FFMPEG") or which("ffmpeg")
+
+# Created on first use, so that importing this module does not fork
+pool = None
+pool_lock = Lock()
+# Renditions being encoded right now, so that a song played by many listeners at once is only encoded once
+pending = {}
+
+
+def encode(source: str, destination: str, bitrate: str):
+    """
+    Runs in the process pool. Encodes source to AAC in an MP4 container, with the index at the front so that playback can start before the download ends.
+    """
+    # Unique, since pending only stops this process encoding the same rendition twice: another worker may be writing to destination too
+    partial = f"{destination}.{uuid4().hex}.part"
+    try:
+        out = run(
+            [
+                ffmpeg,
+                "-v",
+                "error",
+                "-y",
+                "-i",
+                source,
+                "-vn",
+                "-c:a",
+                "aac",
+                "-b:a",
+                bitrate,
+                "-movflags",
+                "+faststart",
+                "-f",
+                "mp4",
+                partial,
+            ],
+            capture_output=True,
+            timeout=600,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.decode(errors="replace"))
+        replace(partial, destination)
+    finally:
+        if exists(partial):
+            remove(partial)
+
+
+def rendition_path(digest: str, rendition: str) -> str:
+    # Content addressed: the same source encoded the same way always lands at the same path, whichever music_id it belongs to
+    key = sha256(f"{digest}:aac:{renditions[rendition]}".encode()).hexdigest()
+    return join(cache_folder, key[:2], key + ".m4a")
+
+
+def choose_rendition(headers, args, mimetype: str) -> str | None:
+    """
+    Picks a rendition from ?quality=, then the Save-Data, ECT and Downlink client hints. Without any hints, lossless sources get the high rendition and lossy ones are sent as they are. None means the original.
+    """
+    quality = args.get("quality")
+    if quality in renditions:
+        return quality
+    if quality == "original":
+        return None
+
+    if headers.get("Save-Data", "").casefold() == "on":
+        return "low"
+    ect = headers.get("ECT", "").casefold()
+    if ect in {"slow-2g", "2g"}:
+        return "low"
+    if ect == "3g":
+        return "medium"
+    try:
+        downlink = float(headers.get("Downlink", ""))
+        if downlink < 1:
+            return "low"
+        if downlink < 5:
+            return "medium"
+    except ValueError:
+        pass
+
+    return "high" if mimetype in lossless_mimetypes else None
+
+
+def get_rendition(digest: str, source: str, rendition: str) -> str | None:
+    """
+    Returns the path of the cached rendition of the stored file source (whose sha256 is digest), or None if it is not ready. When it is not, it is queued for encoding and the caller should send the original this time.
+    """
+    if ffmpeg is None:
+        return None
+    path = rendition_path(digest, rendition)
+    if exists(path):
+        # Marks it as recently used for eviction
+        utime(path)
+        return path if getsize(path) < getsize(source) else None
+    queue_encode(source, path, renditions[rendition])
+    return None
+
+
+def queue_encode(source: str, path: str, bitrate: str):
+    global pool
+    with pool_lock:
+        if path in pending:
+            return
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=int(getenv("TRANSCODE_WORKERS", 2)))
+        makedirs(dirname(path), exist_ok=True)
+        future = pool.submit(encode, source, path, bitrate)
+        pending[path] = future
+    future.add_done_callback(lambda _: finish_encode(path))
+
+
+def finish_encode(path: str):
+    with pool_lock:
+        pending.pop(path, None)
+    evict()
+
+
+def evict():
+    """
+    Deletes the least recently used renditions until the cache fits in RENDITION_CACHE_BYTES.
+    """
+    if not isdir(cache_folder):
+        return
+    # Other workers evict from the same folder, so any file may be gone by the time it is looked at
+    files = []
+    for shard in listdir(cache_folder):
+        for name in listdir(join(cache_folder, shard)):
+            if name.endswith(".m4a"):
+                path = join(cache_folder, shard, name)
+                try:
+                    info = stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= cache_max_bytes:
+            break
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
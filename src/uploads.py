@@ -0,0 +1,324 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from json import dumps, loads
+from logging import getLogger
+from os import getenv, makedirs, remove
+from os.path import dirname, exists, getsize, join
+from shutil import which
+from subprocess import run
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from . import analysis, database, storage
+from .database import Song, blacklisted_terms, insert_song
+from .miscellaneous import guess_audio_mimetype
+
+logger = getLogger(__name__)
+
+upload_folder = getenv("UPLOAD_FOLDER", dirname(__file__) + "/../uploads")
+max_upload_size = int(getenv("MAX_UPLOAD_SIZE", 1024 * 1024 * 500))
+chunk_size = 1024 * 1024 * 4
+# Partial uploads untouched for this long are deleted
+upload_expiry = 60 * 60 * 24
+
+# Background jobs run on this pool, off the request path. Their status is kept in the jobs table, so any worker can answer a poll
+jobs = ThreadPoolExecutor(
+    max_workers=int(getenv("JOB_WORKERS", 2)), thread_name_prefix="jobs"
+)
+
+# Running SHA-256 of each upload this worker is receiving, as (bytes hashed, hash object). A chunk that lands on a different worker rehashes the partial file once
+hashes = {}
+hashes_lock = Lock()
+upload_locks = {}
+
+
+class UploadError(Exception):
+    def __init__(self, msg: str, status: int = 400):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+
+def partial_path(upload_id: str) -> str:
+    return join(upload_folder, upload_id + ".part")
+
+
+def fetch_upload(upload_id: str, owner: str) -> tuple:
+    row = database.db.fetchone("uploads", (upload_id,))
+    if row is None or row[1] != owner:
+        raise UploadError("No such upload", 404)
+    return row
+
+
+def begin_upload(owner: str, size: int, expected_sha256: str | None = None) -> str:
+    if not 0 < size <= max_upload_size:
+        raise UploadError(f"Uploads must be between 1 and {max_upload_size} bytes")
+    sweep_stale_uploads()
+    makedirs(upload_folder, exist_ok=True)
+    upload_id = str(uuid4())
+    open(partial_path(upload_id), "wb").close()
+    database.db.insert(
+        "uploads",
+        (
+            upload_id,
+            owner,
+            size,
+            0,
+            expected_sha256.lower() if expected_sha256 else None,
+            int(time()),
+        ),
+    )
+    return upload_id
+
+
+def running_hash(upload_id: str, received: int):
+    # The hash of the first received bytes of the upload, from memory if this worker received them, otherwise by reading the partial file
+    with hashes_lock:
+        state = hashes.get(upload_id)
+    if state is not None and state[0] == received:
+        return state[1]
+    h = sha256()
+    with open(partial_path(upload_id), "rb") as f:
+        while block := f.read(1024 * 64):
+            h.update(block)
+    return h
+
+
+def write_chunk(upload_id: str, owner: str, start: int, stream) -> int:
+    """
+    Appends the chunk in stream to the partial file, hashing it as it is written, and returns how many bytes have been received in total. start must be exactly the number of bytes received so far, so a client that lost track resumes from received.
+    """
+    upload = fetch_upload(upload_id, owner)
+    with hashes_lock:
+        lock = upload_locks.setdefault(upload_id, Lock())
+
+    with lock:
+        path = partial_path(upload_id)
+        received = getsize(path)
+        if start != received:
+            raise UploadError(f"Expected a chunk starting at byte {received}", 409)
+
+        # A copy, so that a chunk that fails half way leaves the saved hash at start
+        h = running_hash(upload_id, received).copy()
+        with open(path, "ab") as f:
+            try:
+                while block := stream.read(1024 * 64):
+                    received += len(block)
+                    if received > upload[2]:
+                        raise UploadError("Chunk goes past the declared size", 413)
+                    f.write(block)
+                    h.update(block)
+            except BaseException:
+                # Dropped connections included. Drop the partial chunk so the client can resend it from start
+                f.truncate(start)
+                raise
+
+        with hashes_lock:
+            hashes[upload_id] = (received, h)
+        database.db.execute(
+            "UPDATE uploads SET received=?, created_at=? WHERE upload_id=?",
+            (received, int(time()), upload_id),
+        )
+    return received
+
+
+def upload_status(upload_id: str, owner: str) -> dict:
+    upload = fetch_upload(upload_id, owner)
+    return {
+        "upload_id": upload_id,
+        "size": upload[2],
+        "received": getsize(partial_path(upload_id)),
+    }
+
+
+def complete_upload(upload_id: str, owner: str, song: Song) -> str:
+    """
+    Checks that the upload is whole and matches its checksum, and queues it for processing. Returns the job_id to poll, which is the upload_id. Completing an upload again returns the same job.
+    """
+    upload = fetch_upload(upload_id, owner)
+    if database.db.exists("jobs", upload_id):
+        return upload_id
+    received = getsize(partial_path(upload_id))
+    if received != upload[2]:
+        raise UploadError(f"Only {received} of {upload[2]} bytes received", 409)
+
+    digest = running_hash(upload_id, received).hexdigest()
+    if upload[4] and upload[4] != digest:
+        raise UploadError("Checksum does not match", 422)
+
+    with hashes_lock:
+        hashes.pop(upload_id, None)
+        upload_locks.pop(upload_id, None)
+    # The upload is kept until its job has run (see process_upload), so that if this worker dies before then, sweep_stale_uploads still finds its file and fails its job
+    database.db.execute(
+        "UPDATE uploads SET created_at=? WHERE upload_id=?", (int(time()), upload_id)
+    )
+    return submit_job(
+        "upload", owner, process_upload, upload_id, song, digest, job_id=upload_id
+    )
+
+
+def save_upload(owner: str, file, song: Song) -> str:
+    # For plain form uploads (upload_song), which arrive in one request: stream the file through the same path as a chunked upload
+    upload_id = begin_upload(owner, max_upload_size)
+    received = write_chunk(upload_id, owner, 0, file.stream)
+    database.db.execute(
+        "UPDATE uploads SET size=? WHERE upload_id=?", (received, upload_id)
+    )
+    return complete_upload(upload_id, owner, song)
+
+
+def sweep_stale_uploads():
+    """
+    Deletes uploads untouched for upload_expiry, with their partial files. An upload that was completed but whose job never finished (its worker was restarted) has its job failed.
+    """
+    for (upload_id,) in database.db.query(
+        "SELECT upload_id FROM uploads WHERE created_at < ?",
+        (int(time()) - upload_expiry,),
+    ):
+        database.db.execute("DELETE FROM uploads WHERE upload_id=?", (upload_id,))
+        database.db.execute(
+            "UPDATE jobs SET status='failed', error=?, updated_at=? WHERE job_id=? AND status IN ('queued', 'running')",
+            ("Interrupted, upload the file again", int(time()), upload_id),
+        )
+        with hashes_lock:
+            hashes.pop(upload_id, None)
+            upload_locks.pop(upload_id, None)
+        if exists(partial_path(upload_id)):
+            remove(partial_path(upload_id))
+
+
+def probe_audio(path: str) -> dict:
+    """
+    Duration, bitrate and tags of an audio file, read with ffprobe. Returns an empty dict if ffprobe is not installed.
+    """
+    ffprobe = getenv("FFPROBE") or which("ffprobe")
+    if ffprobe is None:
+        return {}
+    out = run(
+        [ffprobe, "-v", "quiet", "-print_format", "json", "-show_format", path],
+        capture_output=True,
+        timeout=120,
+    )
+    if out.returncode != 0:
+        raise ValueError("Not a readable audio file")
+    info = loads(out.stdout).get("format", {})
+    return {
+        "duration": float(info["duration"]) if "duration" in info else None,
+        "bitrate": int(info["bit_rate"]) if "bit_rate" in info else None,
+        "tags": {k.casefold(): v for k, v in info.get("tags", {}).items()},
+    }
+
+
+def process_upload(upload_id: str, song: Song, digest: str) -> dict:
+    """
+    Runs on the job pool: validates the file and its details, probes it, fills in details left blank from the file's tags, analyses it (see analysis.py), then adds the song and stores the file (see storage.py). Reports the songs it is a near duplicate of, without rejecting it.
+    """
+    path = partial_path(upload_id)
+    try:
+        mimetype = guess_audio_mimetype(path)
+        if mimetype == "application/octet-stream":
+            raise ValueError("Not a supported audio file")
+
+        probe = probe_audio(path)
+        tags = probe.get("tags", {})
+        for field, tag in [
+            ("name", "title"),
+            ("artist", "artist"),
+            ("album", "album"),
+            ("genre", "genre"),
+        ]:
+            if not getattr(song, field) and tags.get(tag):
+                setattr(song, field, tags[tag])
+        if not song.year and tags.get("date", "")[:4].isdigit():
+            song.year = int(tags["date"][:4])
+
+        if terms := blacklisted_terms(song.name, song.artist, song.album, song.lyrics):
+            raise ValueError(f"Blacklisted: {', '.join(sorted(terms))}")
+
+        # Decoded here, before the file goes into the store, whichever store that is. A file that is stored already was analysed when it was
+        analysed = None
+        if not database.db.exists("audio_analysis", digest):
+            try:
+                analysed = analysis.analyse(path)
+            except ValueError as e:
+                logger.info("Could not analyse %s: %s", song.music_id, e)
+        duration = probe.get("duration") or (analysed and analysed["duration"])
+
+        size = getsize(path)
+        with database.db.transaction() as con:
+            if not insert_song(song):
+                raise ValueError("A song with this music_id already exists")
+            # Stored by the hash computed while it was received. A file that is stored already (the same song uploaded again) is not stored twice
+            storage.add_media(
+                con,
+                song.music_id,
+                path,
+                digest,
+                mimetype,
+                "move",
+                duration,
+                probe.get("bitrate"),
+            )
+    finally:
+        if exists(path):
+            remove(path)
+        database.db.execute("DELETE FROM uploads WHERE upload_id=?", (upload_id,))
+
+    near_duplicates = []
+    if analysed is not None:
+        # Looked up before this file's own fingerprint is saved. Songs with the very same file are not near duplicates, they share it
+        matches = analysis.find_matches(analysed["fingerprint"], exclude=digest)
+        analysis.save(digest, analysed)
+        near_duplicates = analysis.songs_using([match for match, _ in matches])
+        if near_duplicates:
+            logger.info("%s is a near duplicate of %s", song.music_id, near_duplicates)
+
+    return {
+        "music_id": song.music_id,
+        "sha256": digest,
+        "size": size,
+        "duration": duration,
+        "bitrate": probe.get("bitrate"),
+        "near_duplicates": near_duplicates,
+    }
+
+
+def submit_job(kind: str, owner: str, fn, *args, job_id: str | None = None) -> str:
+    job_id = job_id or str(uuid4())
+    now = int(time())
+    database.db.insert("jobs", (job_id, kind, owner, "queued", None, None, now, now))
+    jobs.submit(run_job, job_id, fn, *args)
+    return job_id
+
+
+def run_job(job_id: str, fn, *args):
+    set_job_status(job_id, "running")
+    try:
+        result = fn(*args)
+    except Exception as e:
+        logger.warning("Job %s failed: %s", job_id, e)
+        set_job_status(job_id, "failed", error=str(e))
+    else:
+        set_job_status(job_id, "done", result=dumps(result))
+
+
+def set_job_status(job_id: str, status: str, result=None, error=None):
+    database.db.execute(
+        "UPDATE jobs SET status=?, result=?, error=?, updated_at=? WHERE job_id=?",
+        (status, result, error, int(time()), job_id),
+    )
+
+
+def job_status(job_id: str, owner: str) -> dict:
+    row = database.db.fetchone("jobs", (job_id,))
+    if row is None or row[2] != owner:
+        raise UploadError("No such job", 404)
+    return {
+        "job_id": job_id,
+        "kind": row[1],
+        "status": row[3],
+        "result": loads(row[4]) if row[4] else None,
+        "error": row[5],
+    }
@@ -3,45 +3,248 @@
 // When user clicks on the play button, the audio should start playing
 // When user clicks on the pause button, the audio should pause
 
-function playSong(music_id) {
+// The play queue lives on the server (see /queue). The player keeps the tracks the server last sent, the current one first, so moving to the next track needs no request before it starts playing
+
+// How many tracks of the queue to ask for at a time
+const QUEUE_WINDOW = 5;
+// How often to save how far into the current track the user is, in milliseconds
+const SAVE_INTERVAL = 15000;
+// A track counts as played (see /plays) once this many seconds of it have played, or half of it if it is shorter
+const PLAY_SECONDS = 30;
+
+let queue = [];
+// Peaks of the current track from 0 to 255, see /api/v1/songs/<music_id>/waveform. null until they arrive, or if the track has not been analysed
+let waveform = null;
+// An audio element buffering the next track, swapped in for the player when that track starts
+let prefetched = null;
+let lastSaved = 0;
+// Whether the current track has been counted as played yet
+let counted = false;
+
+function playSong(music_id, ids) {
+    // Plays music_id right away, and makes ids (by default the songs listed on the page) from music_id onwards the queue
+    if (ids == undefined) {
+        ids = Array.from(
+            document.querySelectorAll(".songs .song"),
+            (song) => song.id
+        );
+    }
+    const start = ids.indexOf(music_id);
+
+    startTrack({ music_id: music_id, url: "/stream/" + music_id }, 0);
+    sendQueue("/queue?n=" + QUEUE_WINDOW, {
+        music_ids: start == -1 ? [music_id] : ids,
+        start: Math.max(start, 0),
+    }).then(() => {
+        if (queue.length > 0) {
+            player().dataset.position = queue[0]["position"];
+        }
+    });
+}
+
+function sendQueue(url, body) {
+    return fetch(url, {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+        },
+        body: JSON.stringify(body),
+    })
+        .then((response) => response.json())
+        .then(applyQueue);
+}
+
+function applyQueue(data) {
+    // Takes the tracks the server sent, shows the details of the current one and starts buffering the next
+    queue = data["tracks"];
+    if (queue.length > 0) {
+        updateAudioDetails(queue[0]);
+        showSuggestions(data["suggestions"]);
+    }
+    prefetch(data["prefetch"][0]);
+}
+
+function showSuggestions(suggestions) {
+    // Songs like the current one, see recommend.py. Playing one makes the suggestions from it onwards the queue
+    const list = document.getElementById("up-next");
+    if (!list) {
+        // Not on this page
+        return;
+    }
+    const ids = suggestions.map((song) => song["music_id"]);
+    list.replaceChildren(
+        ...suggestions.map((song) => {
+            const button = document.createElement("button");
+            button.className = "btn";
+            button.innerText = song["name"] + " \u2022 " + song["artist"];
+            button.onclick = () => playSong(song["music_id"], ids);
+            return button;
+        })
+    );
+    list.style.display = suggestions.length > 0 ? "flex" : "none";
+}
+
+function prefetch(url) {
+    if (!url || (prefetched && prefetched.dataset.url == url)) {
+        return;
+    }
+    prefetched = new Audio();
+    prefetched.preload = "auto";
+    prefetched.dataset.url = url;
+    prefetched.src = url;
+}
+
+function player() {
+    return document.getElementById("audio-player");
+}
+
+function startTrack(track, seconds) {
     document.getElementById("audio-player-section").style.display = "flex";
-    d = document.getElementById("audio-player");
-    d.src = "/static/audio/" + music_id;
+    let d = player();
+    if (prefetched && prefetched.dataset.url == track["url"]) {
+        // Already buffered, put the buffering element in the player's place
+        prefetched.id = d.id;
+        prefetched.controls = true;
+        d.pause();
+        d.replaceWith(prefetched);
+        d = prefetched;
+        prefetched = null;
+    } else {
+        d.src = track["url"] + (seconds > 0 ? "#t=" + seconds : "");
+    }
+    d.dataset.position = track["position"];
+    d.onended = nextSong;
+    d.onpause = savePosition;
+    counted = false;
+    d.ontimeupdate = function () {
+        drawWaveform();
+        if (
+            !counted &&
+            d.currentTime >= Math.min(PLAY_SECONDS, d.duration / 2)
+        ) {
+            counted = true;
+            countPlay(track["music_id"]);
+        }
+        if (Date.now() - lastSaved > SAVE_INTERVAL) {
+            savePosition();
+        }
+    };
+    loadWaveform(track["music_id"]);
     d.play();
+    if (track["name"] != undefined) {
+        updateAudioDetails(track);
+    }
+}
 
-    // When the audio ends, the audio player should disappear
-    document
-        .getElementById("audio-player")
-        .addEventListener("ended", function () {
+function nextSong() {
+    // Starts the next track from what the server sent before, and tells the server in the background
+    queue.shift();
+    if (queue.length > 0) {
+        startTrack(queue[0], 0);
+    }
+    sendQueue("/queue/position?n=" + QUEUE_WINDOW, { step: 1 }).then(() => {
+        if (queue.length == 0) {
+            // When the queue ends, the audio player should disappear
             document.getElementById("audio-player-section").style.display =
                 "none";
-        });
+        } else if (player().dataset.position != queue[0]["position"]) {
+            startTrack(queue[0], 0);
+        }
+    });
+}
 
-    // Update the details of the song in the audio player
-    updateAudioDetails(music_id);
+function savePosition() {
+    const d = player();
+    if (d.dataset.position == undefined || d.dataset.position == "undefined") {
+        return;
+    }
+    lastSaved = Date.now();
+    fetch("/queue/position", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+            position: Number(d.dataset.position),
+            seconds: d.currentTime,
+        }),
+        // So the last save still goes out when the page is being closed
+        keepalive: true,
+    });
 }
-function updateAudioDetails(music_id) {
-    // Fetch song details from the db and update the audio player by sending a post request to /fetch_song_details/ with the music_id as a parameter.
 
-    fetch("/fetch_song_details", {
+function countPlay(music_id) {
+    fetch("/plays", {
         method: "POST",
         headers: {
             "Content-Type": "application/json",
         },
         body: JSON.stringify({ music_id: music_id }),
-    })
-        .then((response) => response.json())
+        keepalive: true,
+    });
+}
+
+function loadWaveform(music_id) {
+    waveform = null;
+    drawWaveform();
+    player().dataset.musicId = music_id;
+    const canvas = document.getElementById("waveform");
+    if (!canvas) {
+        // Not on this page
+        return;
+    }
+    canvas.onclick = function (event) {
+        const d = player();
+        if (d.duration) {
+            d.currentTime = (event.offsetX / canvas.clientWidth) * d.duration;
+        }
+    };
+    fetch("/api/v1/songs/" + music_id + "/waveform")
+        .then((response) => (response.ok ? response.json() : null))
         .then((data) => {
-            document.getElementById("current-song-name").innerText =
-                data["name"];
-            document.getElementById("current-song-artist").innerText =
-                data["artist"];
-            document.getElementById("current-song-album").innerText =
-                data["album"];
-            document.getElementById("current-song-lyrics").innerText =
-                data["lyrics"];
+            // Unless another track has started since
+            if (data && player().dataset.musicId == music_id) {
+                waveform = data["peaks"];
+                drawWaveform();
+            }
         });
 }
+
+function drawWaveform() {
+    // One bar per peak, the part already played lighter than the rest
+    const canvas = document.getElementById("waveform");
+    if (!canvas) {
+        return;
+    }
+    canvas.style.display = waveform ? "block" : "none";
+    if (!waveform) {
+        return;
+    }
+    const context = canvas.getContext("2d");
+    const d = player();
+    const played = d.duration ? d.currentTime / d.duration : 0;
+    const width = canvas.width / waveform.length;
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    waveform.forEach((peak, i) => {
+        const height = Math.max(1, (peak / 255) * canvas.height);
+        context.fillStyle = i < played * waveform.length ? "#ffffff" : "#9c8f8f";
+        context.fillRect(
+            i * width,
+            (canvas.height - height) / 2,
+            Math.max(width, 1),
+            height
+        );
+    });
+}
+
+function updateAudioDetails(track) {
+    // Show the details of the track, which came with the queue
+    document.getElementById("current-song-name").innerText = track["name"];
+    document.getElementById("current-song-artist").innerText = track["artist"];
+    document.getElementById("current-song-album").innerText = track["album"];
+    document.getElementById("current-song-lyrics").innerText = track["lyrics"];
+}
+
 function showLyrics() {
     if (
         document.getElementById("current-song-lyrics").style.display == "block"
@@ -53,6 +256,23 @@ function showLyrics() {
     }
 }
 
+function resumeQueue() {
+    // Picks up where the user left off, on this or another device. With nothing queued, plays the first song on the page
+    fetch("/queue?n=" + QUEUE_WINDOW)
+        .then((response) => response.json())
+        .then((data) => {
+            if (data["tracks"].length == 0) {
+                const first = document.querySelector(".songs .song");
+                if (first) {
+                    playSong(first.id);
+                }
+                return;
+            }
+            applyQueue(data);
+            startTrack(queue[0], data["offset"]);
+        });
+}
+
 async function autoPlay(music_id) {
     await new Promise((r) => setTimeout(r, 1000));
     playSong(music_id);
@@ -0,0 +1,90 @@
+// To be used in upload_song.html
+
+// Sends the file in chunks to /uploads instead of one big form post, so that a large file does not tie up a worker for the whole upload, and a dropped connection only resends the current chunk.
+
+async function uploadSong(event) {
+    event.preventDefault();
+    const form = event.target;
+    const file = document.getElementById("file").files[0];
+    const status = document.getElementById("upload-status");
+    if (!file) {
+        status.innerText = "Choose a file first";
+        return;
+    }
+
+    let body = new FormData();
+    body.append("size", file.size);
+    body.append("filename", file.name);
+    let response = await fetch("/uploads", { method: "POST", body: body });
+    let data = await response.json();
+    if (!response.ok) {
+        status.innerText = data["msg"];
+        return;
+    }
+    const uploadId = data["upload_id"];
+    const chunkSize = data["chunk_size"];
+
+    let received = 0;
+    let failures = 0;
+    while (received < file.size) {
+        const end = Math.min(received + chunkSize, file.size);
+        try {
+            response = await fetch("/uploads/" + uploadId, {
+                method: "PUT",
+                headers: {
+                    "Content-Range": `bytes ${received}-${end - 1}/${file.size}`,
+                },
+                body: file.slice(received, end),
+            });
+            data = await response.json();
+            if (response.ok) {
+                received = data["received"];
+                failures = 0;
+            } else if (response.status == 409) {
+                // Out of step with the server, resume from what it has
+                received = (await (await fetch("/uploads/" + uploadId)).json())[
+                    "received"
+                ];
+            } else {
+                status.innerText = data["msg"];
+                return;
+            }
+        } catch (error) {
+            if (++failures > 5) {
+                status.innerText = "Upload failed, check your connection";
+                return;
+            }
+            await new Promise((r) => setTimeout(r, 1000 * failures));
+            received = (await (await fetch("/uploads/" + uploadId)).json())[
+                "received"
+            ];
+        }
+        status.innerText = `Uploaded ${Math.floor((received * 100) / file.size)}%`;
+    }
+
+    body = new FormData(form);
+    body.delete("file");
+    response = await fetch("/uploads/" + uploadId + "/complete", {
+        method: "POST",
+        body: body,
+    });
+    data = await response.json();
+    if (!response.ok) {
+        status.innerText = data["msg"];
+        return;
+    }
+
+    status.innerText = "Processing";
+    while (true) {
+        await new Promise((r) => setTimeout(r, 1000));
+        const job = await (await fetch("/jobs/" + data["job_id"])).json();
+        if (job["status"] == "done") {
+            window.location = "/creator";
+            return;
+        }
+        if (job["status"] == "failed") {
+            status.innerText = "Could not upload song. " + job["error"];
+            return;
+        }
+    }
+}
@@ -1,3 +1,10 @@
-from src.app import app, port, debug
+from src.app import create_app, port, debug
 
-app.run(host="0.0.0.0", port=port, debug=debug)
+app = create_app()
+
+if __name__ == "__main__":
+    from src.migrate import migrate, seed
+
+    migrate()
+    seed()
+    app.run(host="0.0.0.0", port=port, debug=debug)